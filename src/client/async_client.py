@@ -0,0 +1,442 @@
+# AsyncChatClient: phiên bản asyncio của ChatClient, dùng socketio.AsyncClient
+# Mỗi phiên chỉ là vài coroutine nên một event loop chạy được hàng nghìn phiên
+# (bot thông báo, synthetic monitor, load generator).
+import asyncio
+import base64
+import inspect
+import os
+import sys
+from collections import deque
+
+import socketio
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+from src.common import protocol
+
+# Khớp với CHUNK_SIZE của web client (index.html)
+FILE_CHUNK_SIZE = 4096
+DEFAULT_TIMEOUT = 10.0
+# Số seq gần nhất client nhớ để bỏ tin đã có khi replay (OFFLINE_MESSAGES / SYNC_RESULT)
+SEEN_SEQS = 1000
+# Các frame mang seq của đúng một tin (SENT: tin phiên này vừa gửi)
+LIVE_SEQ_TYPES = (protocol.MSG_PRIVATE, protocol.MSG_GROUP, protocol.MSG_FILE, protocol.MSG_SENT)
+
+
+class ChatRequestError(Exception):
+    """Server trả về ERROR cho một request đang chờ phản hồi."""
+
+
+class AsyncChatClient:
+    def __init__(self, host='127.0.0.1', port=8000, request_timeout=DEFAULT_TIMEOUT, **sio_kwargs):
+        self.host = host
+        self.port = port
+        self.request_timeout = request_timeout
+        # handle_sigint=False: không để hàng nghìn client cùng cài signal handler
+        sio_kwargs.setdefault('handle_sigint', False)
+        self.sio = socketio.AsyncClient(**sio_kwargs)
+        self.username = None
+        self.running = False
+        # Callback giống ChatClient (có thể là hàm thường hoặc coroutine)
+        self.on_message_received = None
+        self.on_users_list_received = None
+        self.on_groups_list_received = None
+        self.on_server_response = None
+        # Handler tùy ý theo type: type -> [callback(payload)]
+        self._handlers = {}
+        # Correlation request/response: type -> deque[Future]
+        # Server không gửi kèm request id nên phản hồi được ghép theo thứ tự FIFO
+        self._waiters = {}
+        # Các future có thể bị ERROR kết thúc (theo thứ tự gửi)
+        self._error_waiters = deque()
+        # Dữ liệu lịch sử đang gom cho từng (history_type, target)
+        self._history_buffers = {}
+        # seq lớn nhất đã nhận, gửi lại khi đăng nhập lại để server replay tin bị lỡ
+        self.last_seq = 0
+        self._seen_seqs = deque(maxlen=SEEN_SEQS)
+        # Frame BOOTSTRAP gần nhất: friends, pending, sent, groups, group_ids, conversations, unread
+        self.bootstrap = None
+        self._register_events()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def on(self, msg_type, handler):
+        """Đăng ký handler cho một loại message server gửi xuống."""
+        self._handlers.setdefault(msg_type, []).append(handler)
+
+    def _register_events(self):
+        @self.sio.event
+        async def connect():
+            self.running = True
+
+        @self.sio.event
+        async def disconnect():
+            self.running = False
+            self._fail_waiters(ConnectionError("Disconnected from server."))
+
+        @self.sio.on('message')
+        async def on_message(data):
+            await self._dispatch(data)
+
+    async def _call(self, callback, *args):
+        result = callback(*args)
+        if inspect.isawaitable(result):
+            await result
+
+    async def _dispatch(self, data):
+        msg_type = data.get('type')
+        payload = data.get('payload')
+        if isinstance(payload, dict) and isinstance(payload.get('seq'), int):
+            self.last_seq = max(self.last_seq, payload['seq'])
+        self._drop_seen(msg_type, payload)
+
+        self._collect_history(msg_type, payload)
+
+        if msg_type == 'ERROR':
+            self._resolve_error(payload)
+        else:
+            self._resolve(msg_type, data)
+
+        for handler in self._handlers.get(msg_type, ()):
+            await self._call(handler, payload)
+
+        if msg_type == protocol.MSG_TEXT:
+            if self.on_message_received:
+                await self._call(self.on_message_received, payload)
+        elif msg_type == protocol.MSG_PRIVATE:
+            if self.on_message_received:
+                await self._call(self.on_message_received,
+                                 f"[Private] {payload.get('sender')}: {payload.get('content')}",
+                                 msg_type, payload.get('sender'))
+        elif msg_type == protocol.MSG_GROUP:
+            if self.on_message_received:
+                await self._call(self.on_message_received,
+                                 f"[Group {payload.get('group_id')}] {payload.get('sender')}: {payload.get('content')}",
+                                 msg_type, payload.get('group_id'))
+        elif msg_type == protocol.MSG_OFFLINE_MESSAGES:
+            if self.on_message_received:
+                for m in payload.get('messages', []):
+                    if m['message_type'] == 'group':
+                        await self._call(self.on_message_received,
+                                         f"[Group {m['receiver']}] {m['sender']}: {m['content']}",
+                                         protocol.MSG_GROUP, m['receiver'])
+                    else:
+                        # Tin riêng mình gửi từ phiên khác: cuộc trò chuyện là với người nhận
+                        peer = m['receiver'] if m['sender'] == self.username else m['sender']
+                        await self._call(self.on_message_received, f"[Private] {m['sender']}: {m['content']}",
+                                         protocol.MSG_PRIVATE, peer)
+            if payload.get('seq'):
+                await self.send(protocol.MSG_ACK, {'seq': payload['seq']})
+        elif msg_type == protocol.MSG_USERS_LIST:
+            if self.on_users_list_received:
+                await self._call(self.on_users_list_received, payload)
+        elif msg_type == protocol.MSG_GROUPS_LIST:
+            if self.on_groups_list_received:
+                await self._call(self.on_groups_list_received, payload)
+        elif msg_type == protocol.MSG_BOOTSTRAP:
+            self.bootstrap = payload
+            if self.on_groups_list_received:
+                await self._call(self.on_groups_list_received, payload['groups'])
+        elif msg_type in ['SUCCESS', 'ERROR']:
+            if self.on_server_response:
+                await self._call(self.on_server_response, msg_type, payload)
+
+    def _drop_seen(self, msg_type, payload):
+        """
+        Nhớ seq của các tin đã nhận (hoặc tự gửi); frame replay chỉ giữ lại các tin chưa có,
+        vì replay gồm cả tin của chính user và có thể trùng tin live tới ngay sau khi đăng nhập.
+        """
+        if msg_type in (protocol.MSG_OFFLINE_MESSAGES, protocol.MSG_SYNC_RESULT):
+            payload['messages'] = [m for m in payload.get('messages', []) if m['id'] not in self._seen_seqs]
+            self._seen_seqs.extend(m['id'] for m in payload['messages'])
+        elif msg_type in LIVE_SEQ_TYPES and isinstance(payload, dict) and isinstance(payload.get('seq'), int):
+            self._seen_seqs.append(payload['seq'])
+
+    # --- Request/response correlation ---
+
+    def _resolve(self, msg_type, data):
+        queue = self._waiters.get(msg_type)
+        while queue:
+            fut = queue.popleft()
+            if not fut.done():
+                fut.set_result(data)
+                return
+
+    def _resolve_error(self, payload):
+        while self._error_waiters:
+            fut = self._error_waiters.popleft()
+            if not fut.done():
+                fut.set_exception(ChatRequestError(payload))
+                return
+
+    def _fail_waiters(self, exc):
+        for queue in self._waiters.values():
+            while queue:
+                fut = queue.popleft()
+                if not fut.done():
+                    fut.set_exception(exc)
+        self._error_waiters.clear()
+
+    async def request(self, msg_type, payload, expect, timeout=None, accept_error=True):
+        """
+        Gửi message và chờ message phản hồi đầu tiên có type thuộc `expect`.
+        Nếu accept_error, một ERROR từ server sẽ kết thúc request bằng ChatRequestError.
+        Trả về toàn bộ message phản hồi ({'type', 'payload'}).
+        """
+        if isinstance(expect, str):
+            expect = (expect,)
+        fut = asyncio.get_running_loop().create_future()
+        # Đăng ký trước khi emit để không bỏ lỡ phản hồi đến sớm
+        for t in expect:
+            self._waiters.setdefault(t, deque()).append(fut)
+        if accept_error:
+            self._error_waiters.append(fut)
+        try:
+            await self.sio.emit('message', {'type': msg_type, 'payload': payload})
+            return await asyncio.wait_for(fut, timeout or self.request_timeout)
+        finally:
+            for t in expect:
+                queue = self._waiters.get(t)
+                if queue and fut in queue:
+                    queue.remove(fut)
+            if fut in self._error_waiters:
+                self._error_waiters.remove(fut)
+
+    async def wait_for(self, msg_type, timeout=None):
+        """Chờ message kế tiếp có type cho trước (không gửi gì)."""
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(msg_type, deque()).append(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout or self.request_timeout)
+        finally:
+            queue = self._waiters.get(msg_type)
+            if queue and fut in queue:
+                queue.remove(fut)
+
+    async def send(self, msg_type, payload):
+        """Gửi message không chờ phản hồi."""
+        if self.running:
+            await self.sio.emit('message', {'type': msg_type, 'payload': payload})
+
+    # --- Kết nối / xác thực ---
+
+    async def _ensure_connected(self):
+        if not self.sio.connected:
+            await self.sio.connect(self.url)
+
+    async def login(self, username, password='default'):
+        """Đăng nhập. Trả về (True, welcome) hoặc (False, lỗi)."""
+        if username != self.username:
+            self.last_seq = 0
+            self._seen_seqs.clear()
+        self.username = username
+        await self._ensure_connected()
+        payload = {'username': username, 'password': password, 'bootstrap': True}
+        if self.last_seq:
+            payload['since_seq'] = self.last_seq
+        try:
+            resp = await self.request(protocol.MSG_LOGIN, payload, expect='LOGIN_SUCCESS')
+            return True, resp['payload']
+        except ChatRequestError as e:
+            return False, str(e)
+
+    # Giữ tên giống ChatClient.connect
+    connect = login
+
+    async def register(self, username, password):
+        self.username = username
+        await self._ensure_connected()
+        try:
+            resp = await self.request(protocol.MSG_REGISTER, {'username': username, 'password': password},
+                                      expect='LOGIN_SUCCESS')
+            return True, resp['payload']
+        except ChatRequestError as e:
+            return False, str(e)
+
+    async def disconnect(self):
+        if self.sio.connected:
+            try:
+                await self.sio.emit('message', {'type': protocol.MSG_EXIT, 'payload': ''})
+            except Exception:
+                pass
+            await self.sio.disconnect()
+        self.running = False
+
+    # --- Gửi tin nhắn ---
+
+    async def send_message(self, message):
+        await self.send(protocol.MSG_TEXT, message)
+
+    async def send_private(self, receiver, message):
+        await self.send(protocol.MSG_PRIVATE, {'receiver': receiver, 'content': message})
+
+    async def send_group(self, group_id, message):
+        await self.send(protocol.MSG_GROUP, {'group_id': group_id, 'content': message})
+
+    async def get_conversations(self, limit=None, cursor=None):
+        """Một trang danh sách trò chuyện: {'conversations': [...], 'next_cursor': ...}."""
+        resp = await self.request(protocol.MSG_CONVERSATIONS, {'limit': limit, 'cursor': cursor},
+                                  expect=protocol.MSG_CONVERSATIONS_RESULT)
+        return resp['payload']
+
+    async def sync(self, since_seq=None, limit=None):
+        """
+        Xin lại các tin sau since_seq (mặc định: seq lớn nhất đã nhận):
+        {'messages': [...], 'seq': ..., 'more': bool, 'source': 'buffer' | 'db'}.
+        """
+        since = self.last_seq if since_seq is None else since_seq
+        resp = await self.request(protocol.MSG_SYNC, {'since_seq': since, 'limit': limit},
+                                  expect=protocol.MSG_SYNC_RESULT)
+        return resp['payload']
+
+    async def mark_read(self, kind, target):
+        """Đặt lại số chưa đọc của cuộc trò chuyện (kind 'private' | 'group')."""
+        await self.send(protocol.MSG_MARK_READ, {'type': kind, 'target': target})
+
+    async def send_typing(self, mode, target, typing=True):
+        msg_type = protocol.MSG_TYPING if typing else protocol.MSG_STOP_TYPING
+        await self.send(msg_type, {'mode': mode, 'target': target})
+
+    # --- Nhóm / bạn bè ---
+
+    async def create_group(self, group_name, members=None):
+        payload = {'name': group_name, 'members': list(members)} if members is not None else group_name
+        resp = await self.request(protocol.MSG_GROUP_CREATE, payload, expect='SUCCESS')
+        return resp['payload']
+
+    async def join_group(self, group_id):
+        resp = await self.request(protocol.MSG_GROUP_JOIN, group_id, expect='SUCCESS')
+        return resp['payload']
+
+    async def leave_group(self, group_id):
+        resp = await self.request(protocol.MSG_GROUP_LEAVE, group_id, expect='SUCCESS')
+        return resp['payload']
+
+    async def delete_group(self, group_id):
+        resp = await self.request('GROUP_DELETE', {'group_id': group_id}, expect='SUCCESS')
+        return resp['payload']
+
+    async def get_groups(self):
+        resp = await self.request('GROUPS_REQUEST', None, expect=protocol.MSG_GROUPS_LIST)
+        return resp['payload']
+
+    async def discover_groups(self, query=None, limit=20, cursor=None):
+        """Một trang nhóm chưa tham gia: {'groups': [...], 'next_cursor': ...}."""
+        resp = await self.request(protocol.MSG_GROUPS_DISCOVER,
+                                  {'query': query, 'limit': limit, 'cursor': cursor},
+                                  expect=protocol.MSG_GROUPS_DISCOVER_RESULT)
+        return resp['payload']
+
+    async def search(self, query, scope='all', cursor=None, limit=20):
+        """Tìm tin nhắn: {'results': [...], 'next_cursor': ...}; scope 'all', 'private:<user>', 'group:<id>'..."""
+        resp = await self.request(protocol.MSG_SEARCH,
+                                  {'query': query, 'scope': scope, 'cursor': cursor, 'limit': limit},
+                                  expect=protocol.MSG_SEARCH_RESULT)
+        return resp['payload']
+
+    async def get_group_members(self, group_id):
+        resp = await self.request(protocol.MSG_GROUP_MEMBERS, {'group_id': group_id},
+                                  expect=protocol.MSG_GROUP_MEMBERS_RESPONSE)
+        return resp['payload']['members']
+
+    async def get_friend_list(self):
+        resp = await self.request(protocol.MSG_FRIEND_LIST, None, expect=protocol.MSG_FRIEND_LIST)
+        return resp['payload']
+
+    async def request_friend(self, target):
+        resp = await self.request(protocol.MSG_FRIEND_REQUEST, {'target': target}, expect='SUCCESS')
+        return resp['payload']
+
+    async def accept_friend(self, requester):
+        resp = await self.request(protocol.MSG_FRIEND_ACCEPT, {'requester': requester}, expect='SUCCESS')
+        return resp['payload']
+
+    async def update_name(self, new_name):
+        resp = await self.request(protocol.MSG_UPDATE_NAME, {'new_name': new_name},
+                                  expect=protocol.MSG_UPDATE_NAME_SUCCESS)
+        return resp['payload']
+
+    # --- Lịch sử ---
+
+    def _collect_history(self, msg_type, payload):
+        # Gom các dòng lịch sử server gửi trước HISTORY_END
+        if not self._history_buffers or not isinstance(payload, dict):
+            return
+        if msg_type == protocol.MSG_GROUP:
+            key = ('group', str(payload.get('group_id')))
+        elif msg_type == protocol.MSG_PRIVATE:
+            key = ('private', None)
+        elif msg_type == protocol.MSG_FILE:
+            key = ('group', str(payload['group_id'])) if payload.get('group_id') is not None else ('private', None)
+        else:
+            return
+        if 'timestamp' not in payload:
+            # Tin nhắn real-time, không phải dòng lịch sử
+            return
+        for buf_key, rows in self._history_buffers.items():
+            if buf_key[0] == key[0] and (key[1] is None or buf_key[1] == key[1]):
+                rows.append(dict(payload, type=msg_type))
+                return
+
+    async def get_history(self, history_type, target, before_id=None, limit=50):
+        """
+        Lấy một trang lịch sử ('private' hoặc 'group').
+        Trả về (rows, next_before_id); next_before_id=None khi đã hết.
+        """
+        key = (history_type, str(target))
+        self._history_buffers[key] = rows = []
+        try:
+            resp = await self.request(protocol.MSG_HISTORY_REQUEST, {
+                'history_type': history_type,
+                'target': target,
+                'myName': self.username,
+                'before_id': before_id,
+                'limit': limit
+            }, expect=protocol.MSG_HISTORY_END)
+        finally:
+            self._history_buffers.pop(key, None)
+        return rows, resp['payload'].get('next_before_id')
+
+    async def iter_history(self, history_type, target, page_size=50):
+        """Duyệt ngược toàn bộ lịch sử theo từng trang."""
+        before_id = None
+        while True:
+            rows, before_id = await self.get_history(history_type, target, before_id, page_size)
+            if rows:
+                yield rows
+            if before_id is None:
+                return
+
+    # --- Gửi file ---
+
+    async def send_file(self, filepath, receiver=None, wait=True):
+        """
+        Gửi file theo giao thức FILE_REQUEST / FILE_CHUNK / FILE_END.
+        receiver: None (public), username (private) hoặc group_id (group).
+        Nếu wait, chờ server thông báo FILE để xác nhận file đã được lưu.
+        """
+        filename = os.path.basename(filepath)
+        filesize = os.path.getsize(filepath)
+        await self.send(protocol.MSG_FILE_REQUEST, {
+            'filename': filename,
+            'filesize': filesize,
+            'receiver': receiver
+        })
+        chunk_num = 0
+        with open(filepath, 'rb') as f:
+            while True:
+                chunk = f.read(FILE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await self.send(protocol.MSG_FILE_CHUNK, {
+                    'chunk_num': chunk_num,
+                    'data': base64.b64encode(chunk).decode('utf-8')
+                })
+                chunk_num += 1
+        if wait:
+            resp = await self.request(protocol.MSG_FILE_END, {'filename': filename}, expect=protocol.MSG_FILE)
+            return resp['payload']
+        await self.send(protocol.MSG_FILE_END, {'filename': filename})
+        return None
@@ -3,11 +3,15 @@
 import socketio
 import sys
 import os
+from collections import deque
 
 # Add project root to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 from src.common import protocol
 
+# Số seq gần nhất client nhớ để bỏ tin đã có khi replay (OFFLINE_MESSAGES)
+SEEN_SEQS = 1000
+
 class ChatClient:
     def __init__(self, host='127.0.0.1', port=8000):
         self.host = host
@@ -19,8 +23,13 @@ class ChatClient:
         self.on_login_response = None
         self.on_users_list_received = None
         self.on_groups_list_received = None
+        self.on_groups_discovered = None
+        self.on_conversations_received = None
         self.on_server_response = None
         self.waiting_for_login = False
+        # seq lớn nhất đã nhận, gửi lại khi đăng nhập lại để server replay tin bị lỡ
+        self.last_seq = 0
+        self._seen_seqs = deque(maxlen=SEEN_SEQS)
         self._register_events()
 
     def _register_events(self):
@@ -40,6 +49,10 @@ class ChatClient:
         def on_message(data):
             msg_type = data.get('type')
             payload = data.get('payload')
+            if isinstance(payload, dict) and isinstance(payload.get('seq'), int):
+                self.last_seq = max(self.last_seq, payload['seq'])
+                if msg_type in (protocol.MSG_PRIVATE, protocol.MSG_GROUP, protocol.MSG_FILE, protocol.MSG_SENT):
+                    self._seen_seqs.append(payload['seq'])
             if msg_type == 'ERROR':
                 print(f"[LOG][ERROR message] {payload} | context=on_message | username={self.username}")
             if self.waiting_for_login:
@@ -78,12 +91,45 @@ class ChatClient:
                     content = payload.get('content')
                     if self.on_message_received:
                         self.on_message_received(f"[Group {group_id}] {sender}: {content}", msg_type, group_id)
+                elif msg_type == protocol.MSG_OFFLINE_MESSAGES:
+                    # Tin nhận được lúc offline (hoặc bị lỡ khi mất kết nối), giao một lượt khi đăng nhập.
+                    # Replay gồm cả tin của chính mình: bỏ các seq đã nhận hoặc tự gửi từ phiên này
+                    for m in payload.get('messages', []):
+                        if m['id'] in self._seen_seqs:
+                            continue
+                        self._seen_seqs.append(m['id'])
+                        if self.on_message_received:
+                            if m['message_type'] == 'group':
+                                self.on_message_received(f"[Group {m['receiver']}] {m['sender']}: {m['content']}",
+                                                         protocol.MSG_GROUP, m['receiver'])
+                            else:
+                                peer = m['receiver'] if m['sender'] == self.username else m['sender']
+                                self.on_message_received(f"[Private] {m['sender']}: {m['content']}",
+                                                         protocol.MSG_PRIVATE, peer)
+                    if payload.get('seq'):
+                        self.sio.emit('message', {'type': protocol.MSG_ACK, 'payload': {'seq': payload['seq']}})
                 elif msg_type == protocol.MSG_USERS_LIST:
                     if self.on_users_list_received:
                         self.on_users_list_received(payload)
                 elif msg_type == protocol.MSG_GROUPS_LIST:
                     if self.on_groups_list_received:
                         self.on_groups_list_received(payload)
+                elif msg_type in (protocol.MSG_GROUP_ADDED, protocol.MSG_GROUP_REMOVED):
+                    # Server chỉ gửi delta; xin lại danh sách nhóm của mình (nhỏ) để vẽ lại
+                    self.request_groups()
+                elif msg_type == protocol.MSG_GROUPS_DISCOVER_RESULT:
+                    if self.on_groups_discovered:
+                        self.on_groups_discovered(payload)
+                elif msg_type == protocol.MSG_CONVERSATIONS_RESULT:
+                    if self.on_conversations_received:
+                        self.on_conversations_received(payload)
+                elif msg_type == protocol.MSG_BOOTSTRAP:
+                    # Nhóm và cuộc trò chuyện có sẵn ngay khi đăng nhập, không cần request riêng
+                    if self.on_groups_list_received:
+                        self.on_groups_list_received(payload['groups'])
+                    if self.on_conversations_received:
+                        self.on_conversations_received({'conversations': payload['conversations'],
+                                                        'next_cursor': payload['next_cursor']})
                 elif msg_type in ['SUCCESS', 'ERROR']:
                     if self.on_server_response:
                         self.on_server_response(msg_type, payload)
@@ -93,13 +139,18 @@ class ChatClient:
 
     def connect(self, username, password='default'):
         try:
+            if username != self.username:
+                self.last_seq = 0
+                self._seen_seqs.clear()
             self.username = username
             self.waiting_for_login = True
             self.sio.connect(f"http://{self.host}:{self.port}")
             login_msg = {
                 'type': protocol.MSG_LOGIN,
-                'payload': {'username': username, 'password': password}
+                'payload': {'username': username, 'password': password, 'bootstrap': True}
             }
+            if self.last_seq:
+                login_msg['payload']['since_seq'] = self.last_seq
             self.sio.emit('message', login_msg)
             return True
         except Exception as e:
@@ -163,6 +214,24 @@ class ChatClient:
                 'payload': group_id
             })
 
+    def request_groups(self):
+        if self.running:
+            self.sio.emit('message', {'type': 'GROUPS_REQUEST', 'payload': None})
+
+    def discover_groups(self, query=None, limit=20, cursor=None):
+        if self.running:
+            self.sio.emit('message', {
+                'type': protocol.MSG_GROUPS_DISCOVER,
+                'payload': {'query': query, 'limit': limit, 'cursor': cursor}
+            })
+
+    def request_conversations(self, limit=None, cursor=None):
+        if self.running:
+            self.sio.emit('message', {
+                'type': protocol.MSG_CONVERSATIONS,
+                'payload': {'limit': limit, 'cursor': cursor}
+            })
+
     def delete_group(self, group_id):
         if self.running:
             self.sio.emit('message', {
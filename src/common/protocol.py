@@ -18,6 +18,10 @@ MSG_GROUP_JOIN = "GROUP_JOIN"
 MSG_GROUP_LEAVE = "GROUP_LEAVE"
 MSG_USERS_LIST = "USERS_LIST"
 MSG_GROUPS_LIST = "GROUPS_LIST"
+MSG_GROUP_ADDED = "GROUP_ADDED"
+MSG_GROUP_REMOVED = "GROUP_REMOVED"
+MSG_GROUPS_DISCOVER = "GROUPS_DISCOVER"
+MSG_GROUPS_DISCOVER_RESULT = "GROUPS_DISCOVER_RESULT"
 MSG_FILE_REQUEST = "FILE_REQUEST"
 MSG_FILE_CHUNK = "FILE_CHUNK"
 MSG_FILE_END = "FILE_END"
@@ -33,6 +37,19 @@ MSG_FRIEND_LIST = "FRIEND_LIST"
 MSG_USER_STATUS = "USER_STATUS"
 MSG_GROUP_MEMBERS = "GROUP_MEMBERS"
 MSG_GROUP_MEMBERS_RESPONSE = "GROUP_MEMBERS_RESPONSE"
+MSG_HISTORY_REQUEST = "HISTORY_REQUEST"
+MSG_HISTORY_END = "HISTORY_END"
+MSG_SEARCH = "SEARCH"
+MSG_SEARCH_RESULT = "SEARCH_RESULT"
+MSG_OFFLINE_MESSAGES = "OFFLINE_MESSAGES"
+MSG_MARK_READ = "MARK_READ"
+MSG_SYNC = "SYNC"
+MSG_SYNC_RESULT = "SYNC_RESULT"
+MSG_ACK = "ACK"
+MSG_SENT = "SENT"
+MSG_CONVERSATIONS = "CONVERSATIONS"
+MSG_CONVERSATIONS_RESULT = "CONVERSATIONS_RESULT"
+MSG_BOOTSTRAP = "BOOTSTRAP"
 
 
 def send_json(socket, data):
@@ -0,0 +1,263 @@
+# Message bus tối giản cho chạy nhiều process server mà không cần Redis/RabbitMQ.
+#
+# Broker nhận frame từ mọi peer cùng channel và gửi lại cho tất cả peer (kể cả người gửi,
+# đúng như PubSubManager của python-socketio mong đợi). BusManager là client manager
+# của Socket.IO dùng broker này làm pub/sub backend.
+#
+#   python -m src.server.bus chatbus+unix:///tmp/chat-bus.sock     # chạy broker
+#   CHAT_MESSAGE_QUEUE=chatbus+unix:///tmp/chat-bus.sock python src/server/main.py
+#
+# Frame: 4 byte độ dài (big-endian) + JSON. Frame đầu tiên của mỗi kết nối là tên channel.
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import urllib.parse
+
+import socketio
+
+logger = logging.getLogger('chat.bus')
+
+SCHEMES = ('chatbus://', 'chatbus+unix://')
+MAX_FRAME = 16 * 1024 * 1024
+_HEADER = struct.Struct('>I')
+
+
+def is_bus_url(url):
+    return bool(url) and url.startswith(SCHEMES)
+
+
+def parse_bus_url(url):
+    """chatbus+unix:///path -> '/path'; chatbus://host:port -> (host, port)."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'chatbus+unix':
+        return parsed.path
+    if parsed.scheme == 'chatbus':
+        return (parsed.hostname or '127.0.0.1', parsed.port or 7001)
+    raise ValueError(f"Not a chatbus URL: {url}")
+
+
+def encode_frame(data):
+    body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return _HEADER.pack(len(body)) + body
+
+
+def _recv_exact(sock, n):
+    buf = b''
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return buf
+
+
+def read_frame(sock):
+    """Đọc một frame (bytes JSON); None khi kết nối đóng."""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError(f"Frame too large: {length}")
+    return _recv_exact(sock, length)
+
+
+# --- Broker ---
+
+class _Peer:
+    """Một kết nối tới broker; frame gửi đi qua hàng đợi riêng để peer chậm không chặn peer khác."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.outbox = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _write_loop(self):
+        while True:
+            frame = self.outbox.get()
+            if frame is None:
+                return
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                return
+
+    def close(self):
+        self.outbox.put(None)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        hello = read_frame(self.request)
+        if hello is None:
+            return
+        channel = json.loads(hello).get('channel', 'socketio')
+        peer = _Peer(self.request)
+        broker.join(channel, peer)
+        try:
+            while True:
+                body = read_frame(self.request)
+                if body is None:
+                    break
+                broker.publish(channel, _HEADER.pack(len(body)) + body)
+        except (OSError, ValueError) as e:
+            logger.debug("peer error", extra={'fields': {'error': str(e)}})
+        finally:
+            broker.leave(channel, peer)
+            peer.close()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class BusBroker:
+    """Broker fan-out: mỗi frame nhận được từ một peer được gửi tới mọi peer cùng channel."""
+
+    def __init__(self, url):
+        self.url = url
+        self.address = parse_bus_url(url)
+        self._channels = {}
+        self._lock = threading.Lock()
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.server = _UnixServer(self.address, _BrokerHandler)
+        else:
+            self.server = _TCPServer(self.address, _BrokerHandler)
+        self.server.broker = self
+        self._thread = None
+
+    def join(self, channel, peer):
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(peer)
+
+    def leave(self, channel, peer):
+        with self._lock:
+            self._channels.get(channel, set()).discard(peer)
+
+    def publish(self, channel, frame):
+        with self._lock:
+            peers = list(self._channels.get(channel, ()))
+        for peer in peers:
+            peer.outbox.put(frame)
+
+    def peer_count(self, channel='socketio'):
+        with self._lock:
+            return len(self._channels.get(channel, ()))
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        """Chạy broker trong thread nền (dùng cho test hoặc launcher)."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+# --- Client manager cho Socket.IO ---
+
+class BusManager(socketio.PubSubManager):
+    """PubSubManager dùng BusBroker; chạy được dưới eventlet mà không cần monkey patch."""
+    name = 'chatbus'
+
+    def __init__(self, url='chatbus://127.0.0.1:7001', channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.address = parse_bus_url(url)
+        self._pub_sock = None
+        self._pub_lock = None
+
+    def _green(self):
+        return self.server is not None and self.server.async_mode == 'eventlet'
+
+    def _connect(self):
+        if self._green():
+            from eventlet.green import socket as sock_mod
+        else:
+            sock_mod = socket
+        family = sock_mod.AF_UNIX if isinstance(self.address, str) else sock_mod.AF_INET
+        sock = sock_mod.socket(family, sock_mod.SOCK_STREAM)
+        sock.connect(self.address)
+        sock.sendall(encode_frame({'channel': self.channel}))
+        return sock
+
+    def _lock(self):
+        if self._pub_lock is None:
+            if self._green():
+                from eventlet.semaphore import Semaphore
+                self._pub_lock = Semaphore()
+            else:
+                self._pub_lock = threading.Lock()
+        return self._pub_lock
+
+    def _publish(self, data):
+        frame = encode_frame(data)
+        with self._lock():
+            for attempt in range(2):
+                try:
+                    if self._pub_sock is None:
+                        self._pub_sock = self._connect()
+                    self._pub_sock.sendall(frame)
+                    return
+                except OSError as e:
+                    if self._pub_sock is not None:
+                        self._pub_sock.close()
+                    self._pub_sock = None
+                    if attempt:
+                        logger.error("bus publish failed", extra={'fields': {'error': str(e)}})
+                        raise
+
+    def _listen(self):
+        retry = 1
+        while True:
+            try:
+                sock = self._connect()
+                retry = 1
+                while True:
+                    body = read_frame(sock)
+                    if body is None:
+                        break
+                    yield body
+                sock.close()
+            except (OSError, ValueError) as e:
+                logger.warning("bus connection lost", extra={'fields': {'error': str(e), 'retry_in': retry}})
+            self.server.sleep(retry)
+            retry = min(retry * 2, 30)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    url = argv[0] if argv else os.environ.get('CHAT_MESSAGE_QUEUE', 'chatbus://127.0.0.1:7001')
+    logging.basicConfig(level=logging.INFO)
+    broker = BusBroker(url)
+    logger.info("bus broker listening on %s", url)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
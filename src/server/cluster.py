@@ -0,0 +1,342 @@
+# Launcher production: một process master + N worker eventlet.
+#
+# Master giữ cổng public, accept kết nối rồi chuyển nguyên file descriptor (SCM_RIGHTS)
+# cho worker được chọn theo hash IP client. Nhờ vậy các request long-polling của cùng
+# một client Engine.IO luôn tới cùng worker (sticky), còn dữ liệu không đi qua master.
+# Các worker chia sẻ room/broadcast/presence qua message queue (mặc định master chạy
+# broker chatbus nội bộ; có thể dùng --message-queue redis://...).
+#
+#   python -m src.server.cluster --workers 16 --port 8000
+#   kill -HUP <master_pid>     # restart lần lượt từng worker (rolling), không mất cổng
+#   kill -TERM <master_pid>    # dừng êm: worker ngắt client rồi thoát
+#
+# Không dùng gunicorn vì worker eventlet của gunicorn không có sticky routing giữa các
+# worker, điều mà transport polling của Socket.IO bắt buộc.
+import argparse
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+# Add project root to path
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+logger = logging.getLogger('chat.cluster')
+
+READY = b'ready'
+# Số lần restart liên tiếp tối đa trước khi tăng thời gian chờ
+RESTART_BACKOFF_MAX = 30.0
+
+
+def route_slot(ip, n):
+    """Worker (0..n-1) cho một IP client; cùng IP luôn cho cùng kết quả."""
+    return zlib.crc32(ip.encode()) % n
+
+
+class WorkerProcess:
+    def __init__(self, slot, proc, channel):
+        self.slot = slot
+        self.proc = proc
+        self.channel = channel      # đầu master của socketpair, dùng gửi fd
+        self.started_at = time.monotonic()
+        self.stopping = False
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def send_connection(self, conn, addr):
+        socket.send_fds(self.channel, [json.dumps(addr).encode()], [conn.fileno()])
+
+    def stop(self, timeout):
+        """SIGTERM rồi đợi worker tự thoát; quá timeout thì SIGKILL."""
+        self.stopping = True
+        try:
+            self.channel.close()
+        except OSError:
+            pass
+        if not self.alive():
+            return
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("worker did not stop in time, killing", extra={'fields': {'pid': self.pid}})
+            self.proc.kill()
+            self.proc.wait()
+
+
+class Cluster:
+    def __init__(self, host='0.0.0.0', port=8000, workers=None, message_queue=None,
+                 graceful_timeout=30.0, ready_timeout=30.0, worker_env=None):
+        self.host = host
+        self.port = port
+        self.n = workers or os.cpu_count() or 1
+        self.message_queue = message_queue
+        self.graceful_timeout = graceful_timeout
+        self.ready_timeout = ready_timeout
+        self.worker_env = worker_env or {}
+        self.workers = [None] * self.n
+        self.broker = None
+        self.listener = None
+        self._tmpdir = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._recycle = threading.Event()
+        self._backoff = [0.0] * self.n
+
+    # --- Worker ---
+
+    def _spawn(self, slot):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        env = dict(os.environ, **self.worker_env)
+        env['CHAT_MESSAGE_QUEUE'] = self.message_queue
+        env['CHAT_WORKER_ID'] = str(slot)
+        cmd = [sys.executable, '-m', 'src.server.cluster', '--worker-fd', str(child.fileno())]
+        proc = subprocess.Popen(cmd, cwd=ROOT, env=env, pass_fds=(child.fileno(),))
+        child.close()
+        worker = WorkerProcess(slot, proc, parent)
+        parent.settimeout(self.ready_timeout)
+        try:
+            if parent.recv(16) != READY:
+                raise OSError("unexpected handshake")
+        except OSError as e:
+            logger.error("worker failed to start", extra={'fields': {'slot': slot, 'error': str(e)}})
+            worker.stop(1)
+            return None
+        finally:
+            parent.settimeout(None)
+        logger.info("worker ready", extra={'fields': {'slot': slot, 'pid': proc.pid}})
+        return worker
+
+    def _route(self, ip):
+        start = route_slot(ip, self.n)
+        for i in range(self.n):
+            worker = self.workers[(start + i) % self.n]
+            if worker is not None and not worker.stopping:
+                yield worker
+
+    # --- Accept ---
+
+    def _accept_loop(self):
+        while not self._stopping.is_set():
+            try:
+                conn, addr = self.listener.accept()
+            except OSError as e:
+                if self._stopping.is_set():
+                    return
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    time.sleep(0.1)
+                continue
+            try:
+                with self._lock:
+                    candidates = list(self._route(addr[0]))
+                for worker in candidates:
+                    try:
+                        worker.send_connection(conn, list(addr[:2]))
+                        break
+                    except OSError:
+                        continue
+                else:
+                    logger.warning("no live worker for connection", extra={'fields': {'client': addr[0]}})
+            finally:
+                conn.close()
+
+    # --- Vòng đời ---
+
+    def _start_broker(self):
+        from src.server.bus import BusBroker
+        self._tmpdir = tempfile.mkdtemp(prefix='chat-cluster-')
+        self.message_queue = f"chatbus+unix://{os.path.join(self._tmpdir, 'bus.sock')}"
+        self.broker = BusBroker(self.message_queue).start()
+
+    def start(self):
+        if not self.message_queue:
+            self._start_broker()
+        self.listener = socket.create_server((self.host, self.port), backlog=1024)
+        self.port = self.listener.getsockname()[1]
+        for slot in range(self.n):
+            self.workers[slot] = self._spawn(slot)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        logger.info("cluster listening", extra={'fields': {'port': self.port, 'workers': self.n,
+                                                           'queue': self.message_queue}})
+        return self
+
+    def recycle(self):
+        """Rolling restart: mỗi slot, khởi động worker mới rồi mới dừng worker cũ."""
+        for slot in range(self.n):
+            if self._stopping.is_set():
+                return
+            new = self._spawn(slot)
+            if new is None:
+                logger.error("rolling restart aborted: new worker failed", extra={'fields': {'slot': slot}})
+                return
+            with self._lock:
+                old, self.workers[slot] = self.workers[slot], new
+            if old is not None:
+                old.stop(self.graceful_timeout)
+        logger.info("rolling restart finished")
+
+    def _check_workers(self):
+        for slot, worker in enumerate(self.workers):
+            if worker is not None and (worker.alive() or worker.stopping):
+                continue
+            if worker is not None:
+                logger.error("worker exited", extra={'fields': {'slot': slot, 'pid': worker.pid,
+                                                               'code': worker.proc.returncode}})
+                uptime = time.monotonic() - worker.started_at
+                self._backoff[slot] = 0.0 if uptime > 60 else min(max(self._backoff[slot] * 2, 1.0),
+                                                                  RESTART_BACKOFF_MAX)
+                with self._lock:
+                    self.workers[slot] = None
+                time.sleep(self._backoff[slot])
+            new = self._spawn(slot)
+            with self._lock:
+                self.workers[slot] = new
+
+    def run(self):
+        """Vòng giám sát của master: restart worker chết, xử lý SIGHUP/SIGTERM."""
+        signal.signal(signal.SIGHUP, lambda *_: self._recycle.set())
+        signal.signal(signal.SIGTERM, lambda *_: self._stopping.set())
+        signal.signal(signal.SIGINT, lambda *_: self._stopping.set())
+        try:
+            while not self._stopping.is_set():
+                if self._recycle.is_set():
+                    self._recycle.clear()
+                    self.recycle()
+                self._check_workers()
+                self._stopping.wait(0.5)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stopping.set()
+        if self.listener is not None:
+            self.listener.close()
+        threads = [threading.Thread(target=w.stop, args=(self.graceful_timeout,))
+                   for w in self.workers if w is not None]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self.broker is not None:
+            self.broker.stop()
+            self.broker = None
+        if self._tmpdir:
+            try:
+                os.rmdir(self._tmpdir)
+            except OSError:
+                pass
+
+
+# --- Phía worker ---
+
+class FdListener:
+    """
+    "Listening socket" cho eventlet.wsgi.server: accept() nhận fd kết nối mà master gửi
+    qua socketpair thay vì tự accept trên cổng.
+    """
+    family = socket.AF_INET
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.channel.setblocking(False)
+        self.closed = False
+
+    def getsockname(self):
+        return ('0.0.0.0', int(os.environ.get('PORT', 0)))
+
+    def accept(self):
+        from eventlet import greenio
+        from eventlet.hubs import trampoline
+        while True:
+            if self.closed:
+                # ESHUTDOWN: eventlet.wsgi.server hiểu là dừng accept một cách bình thường
+                raise OSError(errno.ESHUTDOWN, "listener closed")
+            try:
+                data, fds, _flags, _addr = socket.recv_fds(self.channel, 1024, 1)
+            except BlockingIOError:
+                try:
+                    trampoline(self.channel, read=True, timeout=1.0, timeout_exc=socket.timeout)
+                except socket.timeout:
+                    pass
+                continue
+            if not fds:
+                # Master đóng kênh (recycle/shutdown)
+                self.closed = True
+                continue
+            addr = tuple(json.loads(data)) if data else ('', 0)
+            conn = socket.socket(fileno=fds[0])
+            return greenio.GreenSocket(conn), addr
+
+    def close(self):
+        self.closed = True
+
+
+def run_worker(channel_fd):
+    import eventlet
+    from eventlet import wsgi
+    from src.server.server import app, socketio, presence
+    from src.server.log import get_logger
+
+    log = get_logger('cluster.worker')
+    channel = socket.socket(fileno=channel_fd)
+    listener = FdListener(channel)
+
+    def graceful_stop():
+        """Ngừng nhận kết nối, ngắt các client (để chúng reconnect sang worker khác) rồi thoát."""
+        log.info("worker stopping", extra={'fields': {'pid': os.getpid()}})
+        listener.close()
+        rooms = socketio.server.manager.rooms.get('/', {})
+        for sid in list(rooms.get(None, ())):
+            try:
+                socketio.server.disconnect(sid, namespace='/', ignore_queue=True)
+            except Exception:
+                pass
+        if hasattr(presence, 'shutdown'):
+            presence.shutdown()
+        eventlet.sleep(0.2)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, lambda *_: eventlet.spawn(graceful_stop))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    channel.send(READY)
+    wsgi.server(listener, app, log_output=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the chat server with N worker processes")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('CHAT_WORKERS', 0)) or None,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument('--message-queue', default=os.environ.get('CHAT_MESSAGE_QUEUE'),
+                        help="shared queue URL; default runs an internal chatbus broker")
+    parser.add_argument('--graceful-timeout', type=float, default=30.0)
+    parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker_fd is not None:
+        run_worker(args.worker_fd)
+        return
+
+    from src.server.log import setup_logging
+    setup_logging()
+    Cluster(args.host, args.port, args.workers, args.message_queue, args.graceful_timeout).start().run()
+
+
+if __name__ == "__main__":
+    main()
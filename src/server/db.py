@@ -3,19 +3,538 @@ import os
 import hashlib
 from datetime import datetime
 from contextlib import contextmanager
+from collections import OrderedDict
 import json
+import logging
 import urllib.parse
+import time
+import re
+import threading
+import gzip
+import io
+import sys
 
 # Try importing psycopg2 for PostgreSQL support
 try:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    from psycopg2.extras import RealDictCursor, execute_values
 except ImportError:
     psycopg2 = None
 
-DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../data/chat.db'))
+logger = logging.getLogger('chat.db')
+
+DB_PATH = os.path.abspath(os.environ.get('CHAT_DB_PATH') or
+                          os.path.join(os.path.dirname(__file__), '../../../data/chat.db'))
+
+
+def query_op(query):
+    """Từ khoá đầu tiên của câu SQL, viết hoa (SELECT, INSERT, ...)."""
+    head = query.lstrip()[:16].split(None, 1)
+    return head[0].upper() if head else ''
+
+
+_STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(query):
+    """Chuẩn hoá câu SQL để gộp thống kê: bỏ khoảng trắng thừa, literal -> ?, IN (?, ?) -> IN (...)."""
+    q = _STRING_LITERAL_RE.sub('?', query)
+    q = _NUMBER_LITERAL_RE.sub('?', q)
+    q = _IN_LIST_RE.sub('IN (...)', q)
+    return _WHITESPACE_RE.sub(' ', q).strip()
+
+
+class QueryStatsEntry:
+    __slots__ = ('query', 'op', 'calls', 'errors', 'total', 'max', 'rows', 'slow', 'plan_logged_at')
+
+    def __init__(self, query, op):
+        self.query = query
+        self.op = op
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.slow = 0
+        self.plan_logged_at = 0.0
+
+    def as_dict(self):
+        return {
+            'query': self.query,
+            'op': self.op,
+            'calls': self.calls,
+            'errors': self.errors,
+            'total_ms': round(self.total * 1000, 3),
+            'mean_ms': round(self.total * 1000 / self.calls, 3) if self.calls else 0.0,
+            'max_ms': round(self.max * 1000, 3),
+            'rows': self.rows,
+            'rows_per_call': round(self.rows / self.calls, 2) if self.calls else 0.0,
+            'slow': self.slow,
+        }
+
+
+class QueryStats:
+    """
+    Bảng thống kê sống theo câu SQL đã chuẩn hoá (giống pg_stat_statements nhưng ở phía app).
+    Chi phí mỗi query: một lần tra dict (câu SQL gốc đã được cache bản chuẩn hoá) và vài phép cộng.
+    """
+    MAX_CACHED_TEXTS = 4096
+    # Không log plan của cùng một câu quá một lần trong khoảng này (giây)
+    PLAN_LOG_INTERVAL = 60.0
+
+    def __init__(self, slow_ms=200.0):
+        self.slow_seconds = slow_ms / 1000.0 if slow_ms and slow_ms > 0 else None
+        self._entries = {}
+        self._by_text = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def entry_for(self, query):
+        entry = self._by_text.get(query)
+        if entry is None:
+            normalized = normalize_query(query)
+            with self._lock:
+                entry = self._entries.get(normalized)
+                if entry is None:
+                    entry = self._entries[normalized] = QueryStatsEntry(normalized, query_op(query))
+                if len(self._by_text) < self.MAX_CACHED_TEXTS:
+                    self._by_text[query] = entry
+        return entry
+
+    def record(self, entry, seconds, error=False, rows=0):
+        with self._lock:
+            entry.calls += 1
+            entry.total += seconds
+            if seconds > entry.max:
+                entry.max = seconds
+            if error:
+                entry.errors += 1
+            if rows > 0:
+                entry.rows += rows
+
+    def add_rows(self, entry, n):
+        with self._lock:
+            entry.rows += n
+
+    def is_slow(self, seconds):
+        return self.slow_seconds is not None and seconds >= self.slow_seconds
+
+    def should_log_plan(self, entry):
+        now = time.monotonic()
+        with self._lock:
+            entry.slow += 1
+            if entry.plan_logged_at and now - entry.plan_logged_at < self.PLAN_LOG_INTERVAL:
+                return False
+            entry.plan_logged_at = now
+            return True
+
+    def snapshot(self, sort='total_ms', limit=None):
+        with self._lock:
+            rows = [e.as_dict() for e in self._entries.values()]
+        rows.sort(key=lambda r: r.get(sort, 0), reverse=True)
+        return rows[:limit] if limit else rows
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_text.clear()
+            self.started_at = time.time()
+
+    def format_table(self, sort='total_ms', limit=20, width=80):
+        """Bảng text để in ra console/log."""
+        header = f"{'calls':>8} {'total_ms':>10} {'mean_ms':>9} {'max_ms':>9} {'rows/call':>9} {'err':>4} {'slow':>4}  query"
+        lines = [header, '-' * len(header)]
+        for r in self.snapshot(sort, limit):
+            q = r['query'] if len(r['query']) <= width else r['query'][:width - 3] + '...'
+            lines.append(f"{r['calls']:>8} {r['total_ms']:>10.1f} {r['mean_ms']:>9.3f} {r['max_ms']:>9.3f} "
+                         f"{r['rows_per_call']:>9.1f} {r['errors']:>4} {r['slow']:>4}  {q}")
+        return '\n'.join(lines)
+
+
+class _TracedCursor:
+    """Bọc cursor để đếm số dòng thực sự được fetch cho thống kê; mọi thuộc tính khác đi thẳng vào cursor gốc."""
+    __slots__ = ('_cursor', '_stats', '_entry')
+
+    def __init__(self, cursor, stats, entry):
+        self._cursor = cursor
+        self._stats = stats
+        self._entry = entry
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.add_rows(self._entry, 1)
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        if rows:
+            self._stats.add_rows(self._entry, len(rows))
+        return rows
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        if rows:
+            self._stats.add_rows(self._entry, len(rows))
+        return rows
+
+    def __iter__(self):
+        n = 0
+        try:
+            for row in self._cursor:
+                n += 1
+                yield row
+        finally:
+            if n:
+                self._stats.add_rows(self._entry, n)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _LRUCache:
+    """
+    Phần chung của các cache trong process: các OrderedDict giới hạn max_users entry
+    (LRU), một lock, đếm hit/miss và hook publish(message) để gửi thay đổi sang process
+    khác; process nhận gọi apply(message).
+    """
+    name = 'cache'
+
+    def __init__(self, max_users=10000):
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.publish = None
+
+    def _touch(self, store, key):
+        value = store.get(key)
+        if value is not None:
+            store.move_to_end(key)
+        return value
+
+    def _put(self, store, key, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.max_users:
+            store.popitem(last=False)
+
+    def _lookup(self, store, key):
+        with self._lock:
+            value = self._touch(store, key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def _send(self, message):
+        if self.publish is None:
+            return
+        try:
+            self.publish(message)
+        except Exception as e:
+            logger.warning(f"{self.name} publish failed", extra={'fields': {'error': str(e)}})
+
+
+class FriendCache(_LRUCache):
+    """
+    Cache LRU của đồ thị bạn bè: username -> set bạn đã 'accepted', cùng profile
+    (display_name, last_login) của user. Nạp lười theo từng user, giới hạn số user
+    được giữ; accept_friend cập nhật trực tiếp các entry đang có trong cache.
+    """
+    name = 'friend cache'
+
+    def __init__(self, max_users=10000):
+        super().__init__(max_users)
+        self._friends = OrderedDict()
+        self._profiles = OrderedDict()
+
+    def friends(self, username):
+        return self._lookup(self._friends, username)
+
+    def put_friends(self, username, names):
+        with self._lock:
+            self._put(self._friends, username, set(names))
+
+    def add_edge(self, user1, user2, propagate=True):
+        """Hai user vừa thành bạn: chỉ sửa entry đã nạp, entry chưa nạp sẽ đọc từ DB sau."""
+        with self._lock:
+            for a, b in ((user1, user2), (user2, user1)):
+                names = self._friends.get(a)
+                if names is not None:
+                    names.add(b)
+        if propagate:
+            self._send({'op': 'edge', 'users': [user1, user2]})
+
+    def profile(self, username):
+        with self._lock:
+            return self._touch(self._profiles, username)
+
+    def put_profile(self, username, display_name, last_login):
+        with self._lock:
+            self._put(self._profiles, username, (display_name, last_login))
+
+    def invalidate_profile(self, username, propagate=True):
+        with self._lock:
+            self._profiles.pop(username, None)
+        if propagate:
+            self._send({'op': 'profile', 'user': username})
+
+    def clear(self):
+        with self._lock:
+            self._friends.clear()
+            self._profiles.clear()
+
+    def apply(self, message):
+        op = message.get('op')
+        if op == 'edge':
+            self.add_edge(*message['users'], propagate=False)
+        elif op == 'profile':
+            self.invalidate_profile(message['user'], propagate=False)
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._friends), 'profiles': len(self._profiles),
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class GroupCache(_LRUCache):
+    """
+    Cache membership nhóm theo hai chiều: group_id -> set(username) và
+    username -> set(group_id). Nạp lười từng entry; add/remove/drop_group chỉ sửa các
+    entry đang có trong cache (entry chưa nạp sẽ đọc từ DB sau) nên luôn khớp với DB.
+    """
+    name = 'group cache'
+
+    def __init__(self, max_users=10000):
+        super().__init__(max_users)
+        self._members = OrderedDict()
+        self._groups = OrderedDict()
+
+    def members(self, group_id):
+        return self._lookup(self._members, group_id)
+
+    def put_members(self, group_id, usernames):
+        with self._lock:
+            self._put(self._members, group_id, set(usernames))
+
+    def groups(self, username):
+        return self._lookup(self._groups, username)
+
+    def put_groups(self, username, group_ids):
+        with self._lock:
+            self._put(self._groups, username, set(group_ids))
+
+    def add(self, group_id, username, propagate=True):
+        with self._lock:
+            members = self._members.get(group_id)
+            if members is not None:
+                members.add(username)
+            groups = self._groups.get(username)
+            if groups is not None:
+                groups.add(group_id)
+        if propagate:
+            self._send({'op': 'add', 'group_id': group_id, 'user': username})
+
+    def remove(self, group_id, username, propagate=True):
+        with self._lock:
+            members = self._members.get(group_id)
+            if members is not None:
+                members.discard(username)
+            groups = self._groups.get(username)
+            if groups is not None:
+                groups.discard(group_id)
+        if propagate:
+            self._send({'op': 'remove', 'group_id': group_id, 'user': username})
+
+    def drop_group(self, group_id, propagate=True):
+        with self._lock:
+            self._members.pop(group_id, None)
+            for groups in self._groups.values():
+                groups.discard(group_id)
+        if propagate:
+            self._send({'op': 'drop', 'group_id': group_id})
+
+    def clear(self):
+        with self._lock:
+            self._members.clear()
+            self._groups.clear()
+
+    def apply(self, message):
+        op = message.get('op')
+        if op == 'add':
+            self.add(message['group_id'], message['user'], propagate=False)
+        elif op == 'remove':
+            self.remove(message['group_id'], message['user'], propagate=False)
+        elif op == 'drop':
+            self.drop_group(message['group_id'], propagate=False)
+
+    def stats(self):
+        with self._lock:
+            return {'groups': len(self._members), 'users': len(self._groups),
+                    'hits': self.hits, 'misses': self.misses}
+
+
+_SEARCH_TERM_RE = re.compile(r'\w+', re.UNICODE)
+# Số từ tối đa lấy từ một câu tìm kiếm
+SEARCH_MAX_TERMS = 8
+
+
+def search_terms(query):
+    """Các từ của câu tìm kiếm (chỉ chữ/số, nên ghép vào cú pháp FTS/tsquery là an toàn)."""
+    return _SEARCH_TERM_RE.findall(query or '')[:SEARCH_MAX_TERMS]
+
+
+def search_cursor(cursor):
+    """
+    (before_id, offset) từ cursor của search_messages: [before_id, offset] (before_id None =
+    cửa sổ mới nhất) hoặc một số offset. ValueError/TypeError nếu không hợp lệ.
+    """
+    if isinstance(cursor, (list, tuple)):
+        before, offset = cursor
+        before = None if before is None else int(before)
+    else:
+        before, offset = None, cursor
+    return before, max(int(offset), 0)
+
+
+# Các cột của một tin nhắn trong file export (NDJSON, mỗi dòng một object)
+MESSAGE_EXPORT_FIELDS = ('id', 'sender', 'receiver', 'content', 'message_type', 'timestamp')
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("file .zst cần gói zstandard (pip install zstandard)")
+    return zstandard
+
+
+@contextmanager
+def open_history(path, mode):
+    """
+    Mở file lịch sử để đọc ('r') hoặc ghi ('w') dạng text UTF-8, nén theo đuôi file:
+    .gz -> gzip, .zst -> zstandard. path '-' là stdin/stdout (để pipe export | import).
+    """
+    if path == '-':
+        raw, owned = (sys.stdin.buffer if mode == 'r' else sys.stdout.buffer), False
+    else:
+        raw, owned = open(path, mode + 'b'), True
+    binary = raw
+    text = None
+    try:
+        if path.endswith('.gz'):
+            binary = gzip.GzipFile(fileobj=raw, mode=mode + 'b', compresslevel=6)
+        elif path.endswith('.zst'):
+            zstandard = _zstandard()
+            if mode == 'r':
+                binary = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+            else:
+                binary = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        text = io.TextIOWrapper(binary, encoding='utf-8', newline='\n')
+        yield text
+    finally:
+        # detach() flush buffer của text mà không đóng binary/raw (stdout phải còn mở)
+        if text is not None:
+            text.detach()
+        if binary is not raw:
+            binary.close()
+        if owned:
+            raw.close()
+        elif mode == 'w':
+            raw.flush()
+
+
+def write_records(out, rows):
+    """Ghi các dòng messages ra file text, mỗi dòng một object JSON (định dạng export)."""
+    for row in rows:
+        record = {field: row[field] for field in MESSAGE_EXPORT_FIELDS}
+        if isinstance(record['timestamp'], datetime):
+            record['timestamp'] = record['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
+        out.write(json.dumps(record, ensure_ascii=False))
+        out.write('\n')
+
+
+_PARTITION_RE = re.compile(r'^messages(?:_archive)?_p(\d{4})(\d{2})$')
+
+
+def _month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def _add_months(dt, months):
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+_CONVERSATION_COLUMNS = ("(username, kind, target, unread_count, last_message_id, last_sender, "
+                         "last_preview, last_timestamp)")
+# Cộng dồn chưa đọc, thay tin cuối; excluded = dòng vừa định chèn (SQLite >= 3.24 và Postgres)
+_CONVERSATION_UPSERT = (" ON CONFLICT (username, kind, target) DO UPDATE SET "
+                        "unread_count = conversations.unread_count + excluded.unread_count, "
+                        "last_message_id = excluded.last_message_id, last_sender = excluded.last_sender, "
+                        "last_preview = excluded.last_preview, last_timestamp = excluded.last_timestamp")
+
+
+def _message_dicts(rows):
+    """Dòng messages -> dict MESSAGE_EXPORT_FIELDS, timestamp dạng chuỗi (gửi cho client)."""
+    result = []
+    for row in rows:
+        ts = row['timestamp']
+        if isinstance(ts, datetime):
+            ts = ts.strftime('%Y-%m-%d %H:%M:%S')
+        result.append(dict({field: row[field] for field in MESSAGE_EXPORT_FIELDS}, timestamp=ts))
+    return result
+
+
+def group_name_key(name):
+    """Tên nhóm đã chuẩn hoá (lưu ở groups.name_lower) để tìm kiếm/sắp xếp."""
+    return (name or '').lower()
+
+
+def group_cursor(group):
+    """Cursor keyset (name_lower, id) của một dòng get_discoverable_groups."""
+    return [group_name_key(group['name']), group['id']]
+
+
+def group_key(group_id):
+    """group_id dạng int (payload có thể gửi '12' hoặc 12); None nếu không hợp lệ."""
+    try:
+        return int(group_id)
+    except (TypeError, ValueError):
+        return None
+
 
 class Database:
+    # Callback observer(op, seconds, error) sau mỗi execute_query, op là từ khoá đầu
+    # của câu lệnh (SELECT/INSERT/...). Server gắn vào metrics; None = không đo.
+    query_observer = None
+    # Bật/tắt thống kê theo câu SQL (CHAT_QUERY_STATS=0 để tắt) và ngưỡng slow query (ms, 0 = tắt)
+    QUERY_STATS_ENABLED = os.environ.get('CHAT_QUERY_STATS', '1') not in ('0', 'false', 'no')
+    SLOW_QUERY_MS = float(os.environ.get('CHAT_SLOW_QUERY_MS', 200))
+    # Số user tối đa giữ trong cache bạn bè/profile
+    FRIEND_CACHE_SIZE = int(os.environ.get('CHAT_FRIEND_CACHE_SIZE', 10000))
+    # Số tin khớp mới nhất được xếp hạng mỗi lần tìm (SQLite FTS5)
+    SEARCH_CANDIDATES = int(os.environ.get('CHAT_SEARCH_CANDIDATES', 2000))
+    # Số dòng mỗi lô khi export/import lịch sử (mỗi lô import là một transaction)
+    TRANSFER_BATCH = int(os.environ.get('CHAT_TRANSFER_BATCH', 5000))
+    # Số tin mỗi lô archive (mỗi lô là một transaction, giữ ngắn để không chặn ghi)
+    ARCHIVE_BATCH = int(os.environ.get('CHAT_ARCHIVE_BATCH', 1000))
+    # Số nhóm / user tối đa giữ trong cache membership nhóm
+    GROUP_CACHE_SIZE = int(os.environ.get('CHAT_GROUP_CACHE_SIZE', 10000))
+    # Postgres: tạo messages mới dạng bảng partition theo tháng (CHAT_PG_PARTITION_MESSAGES=0 để tắt)
+    PARTITION_MESSAGES = os.environ.get('CHAT_PG_PARTITION_MESSAGES', '1') not in ('0', 'false', 'no')
+    # Số tháng partition được tạo trước
+    PARTITION_MONTHS_AHEAD = 2
+    # Số ký tự đầu của tin cuối lưu trong conversations (xem trước ở sidebar)
+    PREVIEW_CHARS = 100
+    # Số tin chờ giao tối đa mỗi frame OFFLINE_MESSAGES khi đăng nhập
+    PENDING_BATCH = int(os.environ.get('CHAT_PENDING_BATCH', 500))
+
     def get_all_groups(self):
         """
         Trả về tất cả các nhóm (trừ nhóm công khai nếu muốn).
@@ -43,21 +562,21 @@ class Database:
             # Check if user is creator
             cursor = self.execute_query("SELECT creator FROM groups WHERE id = ?", (group_id,))
             row = cursor.fetchone()
-            print(f"[DEBUG] Xóa nhóm: group_id={group_id}, username={username}, creator_trong_db={row['creator'] if row else None}", flush=True)
             if not row or row['creator'] != username:
-                print(f"[DEBUG] Không xóa được: username gửi lên='{username}', creator trong db='{row['creator'] if row else None}'", flush=True)
+                logger.debug("delete_group: not creator", extra={'fields': {'group_id': group_id, 'user': username, 'creator': row['creator'] if row else None}})
                 return False
             # Delete group members
             self.execute_query("DELETE FROM group_members WHERE group_id = ?", (group_id,))
+            self.execute_query("DELETE FROM conversations WHERE kind = 'group' AND target = ?", (str(group_id),))
             # Delete group messages
             self.execute_query("DELETE FROM messages WHERE message_type = 'group' AND receiver = ?", (str(group_id),))
             # Delete group
             self.execute_query("DELETE FROM groups WHERE id = ?", (group_id,))
             self.conn.commit()
-            print(f"[DEBUG] Đã xóa nhóm thành công: group_id={group_id}", flush=True)
+            self.group_cache.drop_group(group_key(group_id))
             return True
         except Exception as e:
-            print(f"Delete group error: {e}", flush=True)
+            logger.error(f"Delete group error: {e}")
             self.conn.rollback()
             return False
     def __init__(self):
@@ -65,20 +584,27 @@ class Database:
         self.db_url = os.environ.get('DATABASE_URL')
         self.conn = None
         self.db_type = 'sqlite'
+        self.query_stats = QueryStats(self.SLOW_QUERY_MS) if self.QUERY_STATS_ENABLED else None
+        self.friend_cache = FriendCache(self.FRIEND_CACHE_SIZE)
+        self.group_cache = GroupCache(self.GROUP_CACHE_SIZE)
+        # Backend tìm kiếm tin nhắn: 'fts5' | 'tsvector' | None (không hỗ trợ)
+        self.search_backend = None
+        # messages là bảng partition theo tháng (chỉ Postgres)
+        self.messages_partitioned = False
 
         if self.db_url and self.db_url.startswith('postgres'):
-            print(f"✅ DETECTED DATABASE_URL: Connecting to PostgreSQL...")
+            logger.info("DATABASE_URL detected: connecting to PostgreSQL...")
             if not psycopg2:
-                print(f"❌ ERROR: psycopg2 is missing despite DATABASE_URL being set.")
+                logger.error("psycopg2 is missing despite DATABASE_URL being set.")
                 raise ImportError("psycopg2 is required for PostgreSQL connection")
             self.db_type = 'postgres'
             self.connect_postgres()
-            print(f"✅ Connected to PostgreSQL successfully.")
+            logger.info("Connected to PostgreSQL successfully.")
         else:
-            print(f"⚠️ NO DATABASE_URL DETECTED: Utilizing local SQLite database.")
+            logger.info("No DATABASE_URL: using local SQLite database.")
             self.db_type = 'sqlite'
             self.connect_sqlite()
-            print(f"✅ Connected to SQLite successfully.")
+            logger.info("Connected to SQLite successfully.")
             
         self.create_tables()
 
@@ -88,16 +614,20 @@ class Database:
         data_dir = os.path.dirname(DB_PATH)
         if not os.path.exists(data_dir):
             os.makedirs(data_dir)
+        self.friend_cache.clear()
+        self.group_cache.clear()
         self.conn = sqlite3.connect(DB_PATH, check_same_thread=False)
         self.conn.execute("PRAGMA foreign_keys = ON")
         self.conn.row_factory = sqlite3.Row
 
     def connect_postgres(self):
         """Kết nối tới PostgreSQL"""
+        self.friend_cache.clear()
+        self.group_cache.clear()
         try:
             self.conn = psycopg2.connect(self.db_url, cursor_factory=RealDictCursor)
         except Exception as e:
-            print(f"[DB ERROR] Failed to connect to Postgres: {e}")
+            logger.error(f"Failed to connect to Postgres: {e}")
             # Fallback to SQLite if Postgres fails (optional, mostly for resilience)
             # For now we raise to fail fast
             raise e
@@ -115,7 +645,15 @@ class Database:
         if cursor is None:
             cursor = self.get_cursor()
             should_close_cursor = True
+        elif isinstance(cursor, _TracedCursor):
+            cursor = cursor._cursor
 
+        observer = self.query_observer
+        stats = self.query_stats
+        timed = observer is not None or stats is not None
+        start = time.perf_counter() if timed else 0.0
+        error = True
+        elapsed = 0.0
         try:
             # Chuyển đổi placeholder nếu là Postgres
             final_query = query
@@ -124,20 +662,61 @@ class Database:
                 final_query = query.replace('?', '%s')
             
             cursor.execute(final_query, params)
+            error = False
+            if timed:
+                elapsed = time.perf_counter() - start
             
             # Nếu là lệnh SELECT, trả về cursor (để fetch)
             # Nếu là lệnh INSERT/UPDATE, trả về cursor (để commit hoặc lấy lastrowid)
+            if stats is not None:
+                entry = stats.entry_for(query)
+                stats.record(entry, elapsed, rows=cursor.rowcount if entry.op != 'SELECT' else 0)
+                if stats.is_slow(elapsed):
+                    self._log_slow_query(entry, final_query, params, elapsed)
+                if entry.op == 'SELECT':
+                    return _TracedCursor(cursor, stats, entry)
             return cursor
         except Exception as e:
-            print(f"[DB ERROR] Query failed: {final_query} | Params: {params} | Error: {e}")
+            logger.error("Query failed", extra={'fields': {'query': final_query, 'params': params, 'error': str(e)}})
+            if error and stats is not None:
+                stats.record(stats.entry_for(query), time.perf_counter() - start, error=True)
             raise e
         finally:
+            if observer:
+                observer(query_op(query), elapsed or time.perf_counter() - start, error)
             if should_close_cursor and self.db_type == 'postgres':
                 # Postgres cursor nên được đóng nếu không dùng tiếp? 
                 # Thực ra với context manager thì ta handle ở ngoài. 
                 # Ở đây ta return cursor nên k đóng vội nếu là SELECT
                 pass
 
+    def _log_slow_query(self, entry, final_query, params, elapsed):
+        """Log slow query, kèm query plan (tối đa một lần mỗi PLAN_LOG_INTERVAL cho mỗi câu)."""
+        plan = None
+        if self.query_stats.should_log_plan(entry) and entry.op in ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH'):
+            plan = self.explain(final_query, params)
+        logger.warning("Slow query", extra={'fields': {
+            'ms': round(elapsed * 1000, 2), 'query': entry.query, 'params': params, 'plan': plan}})
+
+    def explain(self, final_query, params=()):
+        """Query plan của câu lệnh (đã đổi placeholder), dạng list dòng text; None nếu không lấy được."""
+        try:
+            cursor = self.get_cursor()
+            if self.db_type == 'sqlite':
+                cursor.execute(f"EXPLAIN QUERY PLAN {final_query}", params)
+                return [row['detail'] for row in cursor.fetchall()]
+            cursor.execute(f"EXPLAIN {final_query}", params)
+            return [row['QUERY PLAN'] for row in cursor.fetchall()]
+        except Exception as e:
+            logger.debug("explain failed", extra={'fields': {'error': str(e)}})
+            return None
+
+    def dump_query_stats(self, sort='total_ms', limit=20):
+        """Bảng thống kê query hiện tại dạng text (rỗng nếu tắt CHAT_QUERY_STATS)."""
+        if self.query_stats is None:
+            return ''
+        return self.query_stats.format_table(sort, limit)
+
     def create_tables(self):
         """Tạo các bảng trong database"""
         cursor = self.get_cursor()
@@ -160,6 +739,8 @@ class Database:
             ''', cursor=cursor)
             
             # Bảng messages
+            if self.db_type == 'postgres' and self.PARTITION_MESSAGES and not self._table_exists(cursor, 'messages'):
+                self._create_partitioned_messages(cursor)
             self.execute_query(f'''
                 CREATE TABLE IF NOT EXISTS messages (
                     id {id_type},
@@ -179,7 +760,9 @@ class Database:
                 CREATE TABLE IF NOT EXISTS groups (
                     id {id_type},
                     name TEXT NOT NULL,
+                    name_lower TEXT{self._binary_collate},
                     creator TEXT NOT NULL,
+                    member_count INTEGER NOT NULL DEFAULT 0,
                     created_at {datetime_def} DEFAULT CURRENT_TIMESTAMP
                 )
             ''', cursor=cursor)
@@ -194,31 +777,81 @@ class Database:
                 )
             ''', cursor=cursor)
 
-            # Bảng friends
+            # Bảng friend_edges: mỗi quan hệ bạn bè lưu 2 dòng có hướng, (A, B) và (B, A)
             # status: 'pending', 'accepted'
+            # direction: 'out' = owner gửi lời mời, 'in' = owner nhận lời mời
+            # Mọi truy vấn đều lọc theo owner nên là index seek: PK (owner, peer) cho are_friends,
+            # idx_friend_edges_owner cho danh sách bạn / lời mời đến / lời mời đã gửi.
             self.execute_query(f'''
-                CREATE TABLE IF NOT EXISTS friends (
-                    user1 TEXT,
-                    user2 TEXT,
-                    status TEXT DEFAULT 'pending',
+                CREATE TABLE IF NOT EXISTS friend_edges (
+                    owner TEXT NOT NULL,
+                    peer TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    direction TEXT NOT NULL,
                     created_at {datetime_def} DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (user1, user2)
+                    PRIMARY KEY (owner, peer)
                 )
             ''', cursor=cursor)
+            self.execute_query('CREATE INDEX IF NOT EXISTS idx_friend_edges_owner ON friend_edges(owner, status, direction, peer)', cursor=cursor)
 
             
             # Indexes
             self.execute_query('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)', cursor=cursor) # PG defaults default to desc? or just timestamp
             self.execute_query('CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender)', cursor=cursor)
             self.execute_query('CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages(receiver)', cursor=cursor)
+            # Archiver tìm tin cũ theo từng loại
+            self.execute_query('CREATE INDEX IF NOT EXISTS idx_messages_type_ts ON messages(message_type, timestamp)', cursor=cursor)
+
+            # Bảng messages_archive: tin đã quá hạn lưu trữ (cùng cột với messages, id giữ nguyên)
+            self.execute_query(f'''
+                CREATE TABLE IF NOT EXISTS messages_archive (
+                    id INTEGER PRIMARY KEY,
+                    sender TEXT NOT NULL,
+                    receiver TEXT,
+                    content TEXT NOT NULL,
+                    message_type TEXT DEFAULT 'public',
+                    timestamp {datetime_def}
+                )
+            ''', cursor=cursor)
+
+            # Bảng pending_deliveries: tin riêng gửi lúc người nhận offline, giao một lượt khi họ đăng nhập
+            self.execute_query('''
+                CREATE TABLE IF NOT EXISTS pending_deliveries (
+                    username TEXT NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    PRIMARY KEY (username, message_id)
+                )
+            ''', cursor=cursor)
+
+            # Bảng conversations: danh sách cuộc trò chuyện của mỗi user (tin cuối + số chưa đọc),
+            # cập nhật cùng transaction với save_message để sidebar chỉ cần một truy vấn
+            # kind: 'private' (target = username người kia) | 'group' (target = group id)
+            new_conversations = not self._table_exists(cursor, 'conversations')
+            self.execute_query(f'''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    username TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    unread_count INTEGER NOT NULL DEFAULT 0,
+                    last_message_id INTEGER,
+                    last_sender TEXT,
+                    last_preview TEXT,
+                    last_timestamp {datetime_def},
+                    PRIMARY KEY (username, kind, target)
+                )
+            ''', cursor=cursor)
             
             self.conn.commit()
             
             # Migration check only for local sqlite usually, but can check columns simply
             self._check_migrations(cursor)
+            self._migrate_conversations(cursor, backfill=new_conversations)
+            self._create_search_index(cursor)
+            if self.db_type == 'postgres':
+                self._check_partitions(cursor)
             
         except Exception as e:
-            print(f"[DB INIT ERROR] {e}")
+            logger.error(f"DB init error: {e}")
             self.conn.rollback()
 
     def _check_migrations(self, cursor):
@@ -229,7 +862,7 @@ class Database:
                 cursor.execute("PRAGMA table_info(messages)")
                 cols = [r['name'] for r in cursor.fetchall()]
                 if 'receiver' not in cols:
-                    print("Migrating messages table...")
+                    logger.info("Migrating messages table...")
                     self.execute_query("ALTER TABLE messages ADD COLUMN receiver TEXT", cursor=cursor)
                     self.execute_query("ALTER TABLE messages ADD COLUMN message_type TEXT DEFAULT 'public'", cursor=cursor)
                     self.conn.commit()
@@ -238,7 +871,7 @@ class Database:
                 cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name='messages'")
                 cols = [row['column_name'] for row in cursor.fetchall()]
                 if 'receiver' not in cols:
-                     print("Migrating messages table (PG)...")
+                     logger.info("Migrating messages table (PG)...")
                      self.execute_query("ALTER TABLE messages ADD COLUMN receiver TEXT", cursor=cursor)
                      self.execute_query("ALTER TABLE messages ADD COLUMN message_type TEXT DEFAULT 'public'", cursor=cursor)
                      self.conn.commit()
@@ -248,19 +881,320 @@ class Database:
                 cursor.execute("PRAGMA table_info(users)")
                 cols = [r['name'] for r in cursor.fetchall()]
                 if 'display_name' not in cols:
-                    print("Migrating users table (add display_name)...")
+                    logger.info("Migrating users table (add display_name)...")
                     self.execute_query("ALTER TABLE users ADD COLUMN display_name TEXT", cursor=cursor)
                     self.conn.commit()
             else:
                  cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name='users'")
                  cols = [row['column_name'] for row in cursor.fetchall()]
                  if 'display_name' not in cols:
-                     print("Migrating users table (PG add display_name)...")
+                     logger.info("Migrating users table (PG add display_name)...")
                      self.execute_query("ALTER TABLE users ADD COLUMN display_name TEXT", cursor=cursor)
                      self.conn.commit()
 
+            self._migrate_friends(cursor)
+            self._migrate_groups(cursor)
+
+        except Exception as e:
+            logger.warning(f"Migration check warning: {e}")
+
+    @property
+    def _binary_collate(self):
+        # name_lower so sánh theo byte ở cả hai DB (SQLite mặc định BINARY), để range
+        # prefix và thứ tự keyset giống nhau, không phụ thuộc locale của Postgres
+        return '' if self.db_type == 'sqlite' else ' COLLATE "C"'
+
+    def _columns(self, cursor, table):
+        if self.db_type == 'sqlite':
+            cursor.execute(f"PRAGMA table_info({table})")
+            return {r['name'] for r in cursor.fetchall()}
+        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table,))
+        return {r['column_name'] for r in cursor.fetchall()}
+
+    def _migrate_groups(self, cursor):
+        """Thêm groups.name_lower / member_count cho database cũ, rồi tạo index cho discovery."""
+        cols = self._columns(cursor, 'groups')
+        if 'name_lower' not in cols:
+            logger.info("Migrating groups table (add name_lower, member_count)...")
+            self.execute_query(f"ALTER TABLE groups ADD COLUMN name_lower TEXT{self._binary_collate}", cursor=cursor)
+            self.execute_query("ALTER TABLE groups ADD COLUMN member_count INTEGER NOT NULL DEFAULT 0", cursor=cursor)
+            self._backfill_groups(cursor)
+        self.execute_query('CREATE INDEX IF NOT EXISTS idx_groups_name_lower ON groups(name_lower, id)', cursor=cursor)
+        # group_members có PK (group_id, username); tra theo user cần index riêng
+        self.execute_query('CREATE INDEX IF NOT EXISTS idx_group_members_username ON group_members(username, group_id)', cursor=cursor)
+        self.conn.commit()
+        if self.db_type == 'postgres':
+            self._create_trigram_index(cursor)
+
+    def _backfill_groups(self, cursor):
+        """Tính lại name_lower (bằng Python, LOWER của SQLite chỉ hiểu ASCII) và member_count."""
+        cursor.execute("SELECT id, name FROM groups WHERE name_lower IS NULL")
+        rows = [(group_name_key(r['name']), r['id']) for r in cursor.fetchall()]
+        update = "UPDATE groups SET name_lower = ? WHERE id = ?"
+        if self.db_type == 'postgres':
+            update = update.replace('?', '%s')
+        cursor.executemany(update, rows)
+        self.execute_query('''
+            UPDATE groups SET member_count = (SELECT COUNT(*) FROM group_members gm WHERE gm.group_id = groups.id)
+        ''', cursor=cursor)
+        self.conn.commit()
+
+    def _create_trigram_index(self, cursor):
+        """Index pg_trgm cho tìm nhóm theo chuỗi con; bỏ qua nếu không cài được extension."""
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_groups_name_trgm ON groups USING gin (name_lower gin_trgm_ops)")
+            self.conn.commit()
         except Exception as e:
-            print(f"Migration check warning: {e}")
+            self.conn.rollback()
+            logger.info("pg_trgm unavailable, substring group search will scan", extra={'fields': {'error': str(e)}})
+
+    def _table_exists(self, cursor, name):
+        if self.db_type == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+        else:
+            cursor.execute("SELECT 1 FROM information_schema.tables WHERE table_name = %s "
+                           "AND table_schema = ANY(current_schemas(false))", (name,))
+        return cursor.fetchone() is not None
+
+    def _migrate_conversations(self, cursor, backfill=False):
+        """Thêm cột tin cuối cho bảng conversations cũ (chỉ có unread_count), tạo index sidebar."""
+        if 'last_message_id' not in self._columns(cursor, 'conversations'):
+            logger.info("Migrating conversations table (add last message columns)...")
+            datetime_def = "DATETIME" if self.db_type == 'sqlite' else "TIMESTAMP"
+            for column, column_type in (('last_message_id', 'INTEGER'), ('last_sender', 'TEXT'),
+                                        ('last_preview', 'TEXT'), ('last_timestamp', datetime_def)):
+                self.execute_query(f"ALTER TABLE conversations ADD COLUMN {column} {column_type}", cursor=cursor)
+            backfill = True
+        self.execute_query('CREATE INDEX IF NOT EXISTS idx_conversations_recent ON conversations(username, last_message_id)', cursor=cursor)
+        self.conn.commit()
+        if backfill:
+            self.rebuild_conversations()
+
+    def rebuild_conversations(self):
+        """
+        Tính lại tin cuối của mọi cuộc trò chuyện từ bảng messages (database cũ, sau khi import);
+        số chưa đọc đang có được giữ nguyên.
+        """
+        preview = f"SUBSTR(m.content, 1, {int(self.PREVIEW_CHARS)})"
+        upsert = (" ON CONFLICT (username, kind, target) DO UPDATE SET last_message_id = excluded.last_message_id, "
+                  "last_sender = excluded.last_sender, last_preview = excluded.last_preview, "
+                  "last_timestamp = excluded.last_timestamp")
+        columns = "(username, kind, target, unread_count, last_message_id, last_sender, last_preview, last_timestamp)"
+        # WHERE true: với INSERT ... SELECT ... JOIN, SQLite cần WHERE để không đọc nhầm ON CONFLICT
+        self.execute_query(f'''
+            INSERT INTO conversations {columns}
+            SELECT x.username, 'private', x.target, 0, m.id, m.sender, {preview}, m.timestamp
+            FROM (
+                SELECT username, target, MAX(id) AS last_id FROM (
+                    SELECT receiver AS username, sender AS target, id FROM messages
+                    WHERE message_type = 'private' AND receiver IS NOT NULL
+                    UNION ALL
+                    SELECT sender, receiver, id FROM messages
+                    WHERE message_type = 'private' AND receiver IS NOT NULL
+                ) t GROUP BY username, target
+            ) x JOIN messages m ON m.id = x.last_id
+            WHERE true{upsert}
+        ''')
+        self.execute_query(f'''
+            INSERT INTO conversations {columns}
+            SELECT gm.username, 'group', x.receiver, 0, m.id, m.sender, {preview}, m.timestamp
+            FROM (
+                SELECT receiver, MAX(id) AS last_id FROM messages
+                WHERE message_type = 'group' AND receiver IS NOT NULL GROUP BY receiver
+            ) x JOIN messages m ON m.id = x.last_id
+            JOIN group_members gm ON CAST(gm.group_id AS TEXT) = x.receiver
+            WHERE true{upsert}
+        ''')
+        self.conn.commit()
+
+    def _migrate_friends(self, cursor):
+        """
+        Chuyển dữ liệu từ bảng cũ friends(user1 -> user2) sang friend_edges (2 dòng có hướng).
+        Chỉ chạy khi friend_edges còn trống; bảng cũ được giữ nguyên để có thể quay lại.
+        """
+        if not self._table_exists(cursor, 'friends'):
+            return
+        cursor.execute("SELECT 1 FROM friend_edges LIMIT 1")
+        if cursor.fetchone() is not None:
+            return
+        cursor.execute("SELECT 1 FROM friends LIMIT 1")
+        if cursor.fetchone() is None:
+            return
+        logger.info("Migrating friends -> friend_edges...")
+        ignore = "OR IGNORE " if self.db_type == 'sqlite' else ""
+        conflict = "" if self.db_type == 'sqlite' else " ON CONFLICT DO NOTHING"
+        self.execute_query(f'''
+            INSERT {ignore}INTO friend_edges (owner, peer, status, direction, created_at)
+            SELECT user1, user2, status, 'out', created_at FROM friends{conflict}
+        ''', cursor=cursor)
+        self.execute_query(f'''
+            INSERT {ignore}INTO friend_edges (owner, peer, status, direction, created_at)
+            SELECT user2, user1, status, 'in', created_at FROM friends{conflict}
+        ''', cursor=cursor)
+        self.conn.commit()
+
+    def _create_partitioned_messages(self, cursor):
+        """
+        messages (và messages_archive) dạng partition theo tháng trên timestamp. PK phải chứa
+        cột partition nên là (id, timestamp); partition DEFAULT giữ các tin ngoài mọi tháng
+        đã tạo. Partition cũ được chuyển nguyên khối sang messages_archive (archive_partitions).
+        """
+        for table, id_def in (('messages', 'SERIAL'), ('messages_archive', 'INTEGER NOT NULL')):
+            self.execute_query(f'''
+                CREATE TABLE {table} (
+                    id {id_def},
+                    sender TEXT NOT NULL,
+                    receiver TEXT,
+                    content TEXT NOT NULL,
+                    message_type TEXT DEFAULT 'public',
+                    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (id, timestamp)
+                ) PARTITION BY RANGE (timestamp)
+            ''', cursor=cursor)
+            self.execute_query(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT", cursor=cursor)
+        self.conn.commit()
+        logger.info("Created partitioned messages table")
+
+    def _check_partitions(self, cursor):
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('messages')")
+        self.messages_partitioned = cursor.fetchone() is not None
+        self.conn.commit()
+        if self.messages_partitioned:
+            now = datetime.utcnow()
+            self.ensure_partitions(_add_months(now, -1), _add_months(now, self.PARTITION_MONTHS_AHEAD))
+
+    def ensure_partitions(self, start, end):
+        """Tạo partition tháng của messages cho mọi tháng trong [start, end] (bỏ qua tháng đã có)."""
+        if not self.messages_partitioned:
+            return
+        cursor = self.get_cursor()
+        month = _month_start(start)
+        while month <= end:
+            upper = _add_months(month, 1)
+            name = f"messages_p{month:%Y%m}"
+            try:
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages "
+                               f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')")
+                self.conn.commit()
+            except Exception as e:
+                # vd. partition DEFAULT đã có tin của tháng này, hoặc tháng đã được archive
+                self.conn.rollback()
+                logger.warning("create partition failed", extra={'fields': {'partition': name, 'error': str(e)}})
+            month = upper
+
+    def message_partitions(self, table='messages'):
+        """[(tên, tháng bắt đầu, tháng kết thúc)] các partition tháng của bảng, theo thứ tự thời gian."""
+        cursor = self.get_cursor()
+        cursor.execute("SELECT c.relname AS name FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                       "WHERE i.inhparent = to_regclass(%s)", (table,))
+        parts = []
+        for row in cursor.fetchall():
+            match = _PARTITION_RE.match(row['name'])
+            if match:
+                month = datetime(int(match.group(1)), int(match.group(2)), 1)
+                parts.append((row['name'], month, _add_months(month, 1)))
+        self.conn.commit()
+        return sorted(parts, key=lambda p: p[1])
+
+    def archive_partitions(self, before):
+        """
+        Chuyển nguyên khối các partition tháng kết thúc trước `before` từ messages sang
+        messages_archive (DETACH + ATTACH, chỉ đổi metadata). Trả về tên các partition đã chuyển.
+        """
+        if not self.messages_partitioned:
+            return []
+        moved = []
+        cursor = self.get_cursor()
+        for name, lower, upper in self.message_partitions('messages'):
+            if upper > before:
+                break
+            archived = f"messages_archive_p{lower:%Y%m}"
+            try:
+                cursor.execute(f"ALTER TABLE messages DETACH PARTITION {name}")
+                cursor.execute(f"ALTER TABLE {name} RENAME TO {archived}")
+                cursor.execute(f"ALTER TABLE messages_archive ATTACH PARTITION {archived} "
+                               f"FOR VALUES FROM ('{lower:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')")
+                self.conn.commit()
+                moved.append(name)
+            except Exception as e:
+                self.conn.rollback()
+                logger.warning("archive partition failed", extra={'fields': {'partition': name, 'error': str(e)}})
+                break
+        return moved
+
+    def _create_search_index(self, cursor):
+        """
+        Index full-text cho messages.content.
+        SQLite: bảng FTS5 external-content (không lưu lại nội dung) đồng bộ bằng trigger,
+        tokenizer unicode61 bỏ dấu ('tiếng việt' khớp 'tieng viet').
+        Postgres: GIN index trên to_tsvector('simple', ...), bỏ dấu bằng extension unaccent nếu có.
+        """
+        try:
+            if self.db_type == 'sqlite':
+                self._create_fts5(cursor)
+            else:
+                self._create_tsvector(cursor)
+        except Exception as e:
+            self.conn.rollback()
+            self.search_backend = None
+            logger.warning("message search disabled", extra={'fields': {'error': str(e)}})
+
+    def _create_fts5(self, cursor):
+        existed = self._table_exists(cursor, 'messages_fts')
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content, content='messages', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        ''')
+        if not existed:
+            # Database cũ đã có tin nhắn: dựng index một lần (có thể lâu với bảng lớn)
+            cursor.execute("SELECT 1 FROM messages LIMIT 1")
+            if cursor.fetchone() is not None:
+                logger.info("Building messages_fts index...")
+                cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        self.conn.commit()
+        self.search_backend = 'fts5'
+
+    def _create_tsvector(self, cursor):
+        self.conn.commit()
+        try:
+            # unaccent() không IMMUTABLE nên phải bọc lại mới dùng được trong index
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION chat_unaccent(text) RETURNS text
+                LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+                AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$
+            ''')
+            self.conn.commit()
+            self._tsv_normalize = 'chat_unaccent'
+        except Exception as e:
+            self.conn.rollback()
+            self._tsv_normalize = ''
+            logger.info("unaccent unavailable, search keeps diacritics", extra={'fields': {'error': str(e)}})
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING gin ({self._tsv_expr('content')})")
+        self.conn.commit()
+        self.search_backend = 'tsvector'
+
+    def _tsv_expr(self, column):
+        return f"to_tsvector('simple', {self._tsv_normalize}({column}))"
 
     def _hash_password(self, password):
         return hashlib.sha256(password.encode()).hexdigest()
@@ -279,22 +1213,17 @@ class Database:
             return False
 
     def login_user(self, username, password):
+        # Kiểm tra mật khẩu và cập nhật last_login trong cùng một câu lệnh
         password_hash = self._hash_password(password)
         cursor = self.execute_query(
-            "SELECT password_hash, is_active FROM users WHERE username = ?",
-            (username,)
+            "UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE username = ? AND password_hash = ? AND is_active = 1",
+            (username, password_hash)
         )
-        # Fetch logic varies slightly by driver if not normalized, but RealDictCursor and Row behave similarly
-        row = cursor.fetchone()
-        
-        if row and row['password_hash'] == password_hash and row['is_active'] == 1:
-            self.execute_query(
-                "UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE username = ?",
-                (username,)
-            )
-            self.conn.commit()
-            return True
-        return False
+        ok = cursor.rowcount == 1
+        self.conn.commit()
+        if ok:
+            self.friend_cache.invalidate_profile(username)
+        return ok
 
     def update_user_display_name(self, username, new_name):
         try:
@@ -303,12 +1232,18 @@ class Database:
                 (new_name, username)
             )
             self.conn.commit()
+            self.friend_cache.invalidate_profile(username)
             return True
         except Exception as e:
-            print(f"Update name error: {e}")
+            logger.error(f"Update name error: {e}")
             self.conn.rollback()
             return False
 
+    def get_display_names(self, usernames):
+        """username -> display name cho nhiều user một lượt (cache profile, thiếu thì một query IN)."""
+        profiles = self._get_profiles(list(usernames))
+        return {name: (profiles[name][0] if name in profiles else None) or name for name in usernames}
+
     def get_user_display_name(self, username):
         cursor = self.execute_query("SELECT display_name FROM users WHERE username = ?", (username,))
         row = cursor.fetchone()
@@ -320,28 +1255,176 @@ class Database:
         cursor = self.execute_query("SELECT 1 FROM users WHERE username = ?", (username,))
         return cursor.fetchone() is not None
 
-    def save_message(self, sender, content, receiver=None, message_type='public'):
+    def save_message(self, sender, content, receiver=None, message_type='public', deliver_later=False):
+        """
+        Lưu tin và cập nhật số chưa đọc của người nhận trong cùng transaction; trả về id tin.
+        deliver_later: người nhận (tin riêng) đang offline, xếp tin vào hàng chờ giao khi đăng nhập.
+        """
+        receiver = str(receiver) if receiver is not None else None
+        query = "INSERT INTO messages (sender, receiver, content, message_type) VALUES (?, ?, ?, ?)"
+        params = (sender, receiver, content, message_type)
+        try:
+            if self.db_type == 'sqlite':
+                message_id = self.execute_query(query, params).lastrowid
+            else:
+                message_id = self.execute_query(query + " RETURNING id", params).fetchone()['id']
+            preview = content[:self.PREVIEW_CHARS]
+            if message_type == 'private' and receiver:
+                # Dòng của người nhận (+1 chưa đọc) và của người gửi (chỉ đổi tin cuối)
+                rows = [(receiver, sender, 1, message_id, sender, preview)]
+                if receiver != sender:
+                    rows.append((sender, receiver, 0, message_id, sender, preview))
+                values = ', '.join("(?, 'private', ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)" for _ in rows)
+                self.execute_query(
+                    f"INSERT INTO conversations {_CONVERSATION_COLUMNS} VALUES {values}{_CONVERSATION_UPSERT}",
+                    tuple(v for row in rows for v in row))
+                if deliver_later:
+                    self.execute_query(
+                        "INSERT INTO pending_deliveries (username, message_id) VALUES (?, ?)", (receiver, message_id))
+            elif message_type == 'group' and receiver:
+                # Mọi thành viên (+1 chưa đọc, trừ người gửi); dòng chưa có thì tạo (PK seek theo từng thành viên)
+                self.execute_query(
+                    f"INSERT INTO conversations {_CONVERSATION_COLUMNS} "
+                    "SELECT username, 'group', ?, CASE WHEN username = ? THEN 0 ELSE 1 END, ?, ?, ?, CURRENT_TIMESTAMP "
+                    f"FROM group_members WHERE group_id = ?{_CONVERSATION_UPSERT}",
+                    (receiver, sender, message_id, sender, preview, group_key(receiver)))
+            self.conn.commit()
+            return message_id
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def get_pending_messages(self, username, after_id=0, limit=None):
+        """
+        Một lô (tối đa limit) tin đang chờ giao cho user có id > after_id, theo thứ tự id.
+        Trả về (messages, last_id, more): last_id là mốc client ACK để xoá lô khỏi hàng chờ.
+        """
+        limit = limit or self.PENDING_BATCH
+        cursor = self.execute_query('''
+            SELECT p.message_id, m.id, m.sender, m.receiver, m.content, m.message_type, m.timestamp
+            FROM pending_deliveries p
+            LEFT JOIN messages m ON m.id = p.message_id
+            WHERE p.username = ? AND p.message_id > ?
+            ORDER BY p.message_id LIMIT ?
+        ''', (username, int(after_id or 0), limit + 1))
+        rows = cursor.fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        # Tin đã bị archive/xoá thì chỉ còn trong hàng chờ, bị xoá cùng lô khi ACK
+        messages = _message_dicts(row for row in rows if row['id'] is not None)
+        return messages, (rows[-1]['message_id'] if rows else after_id), more
+
+    def ack_pending(self, username, seq):
+        """Client đã nhận mọi tin tới seq: bỏ chúng khỏi hàng chờ."""
+        cursor = self.execute_query("DELETE FROM pending_deliveries WHERE username = ? AND message_id <= ?",
+                                    (username, int(seq)))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def get_messages_since(self, username, since_id, group_ids=None, limit=500):
+        """
+        Tin user được nhận (tin riêng gửi cho/bởi user, tin các nhóm đang tham gia, kể cả tin
+        của chính user) có id > since_id, theo thứ tự id; dùng khi replay ngoài vòng tin trong bộ nhớ.
+        """
+        if group_ids is None:
+            group_ids = self.get_user_group_ids(username)
+        group_ids = {str(g) for g in group_ids}
+        # receiver IN (...) liệt kê sẵn để mỗi giá trị là một range seek (receiver, id) trên
+        # idx_messages_receiver; OR với subquery group_members làm SQLite quét theo message_type.
+        # Tin riêng user gửi đi là nhánh thứ hai, seek (sender, id) trên idx_messages_sender
+        receivers = [username] + sorted(group_ids)
+        placeholders = ', '.join('?' * len(receivers))
+        cursor = self.execute_query(f'''
+            SELECT * FROM (
+                SELECT id, sender, receiver, content, message_type, timestamp FROM messages
+                WHERE receiver IN ({placeholders}) AND id > ? AND message_type IN ('private', 'group')
+                ORDER BY id LIMIT ?
+            ) received
+            UNION
+            SELECT * FROM (
+                SELECT id, sender, receiver, content, message_type, timestamp FROM messages
+                WHERE sender = ? AND id > ? AND message_type = 'private'
+                ORDER BY id LIMIT ?
+            ) sent
+            ORDER BY id LIMIT ?
+        ''', (*receivers, int(since_id), limit, username, int(since_id), limit, limit))
+        rows = [row for row in cursor.fetchall()
+                if (username in (row['receiver'], row['sender']) if row['message_type'] == 'private'
+                    else row['receiver'] in group_ids)]
+        return _message_dicts(rows)
+
+    def get_conversations(self, username, limit=50, before=None):
+        """
+        Danh sách cuộc trò chuyện của user, mới nhất trước (keyset theo id tin cuối):
+        trả về (conversations, next_cursor). Một truy vấn trên idx_conversations_recent,
+        tên nhóm / display name lấy bằng PK lookup.
+        """
+        page_cond = " AND c.last_message_id < ?" if before is not None else ""
+        params = [username] + ([int(before)] if before is not None else []) + [limit]
+        cursor = self.execute_query(f'''
+            SELECT c.kind, c.target, c.unread_count, c.last_message_id, c.last_sender, c.last_preview,
+                   c.last_timestamp, g.name AS group_name, u.display_name
+            FROM conversations c
+            LEFT JOIN groups g ON c.kind = 'group' AND g.id = CAST(c.target AS INTEGER)
+            LEFT JOIN users u ON c.kind = 'private' AND u.username = c.target
+            WHERE c.username = ? AND c.last_message_id IS NOT NULL{page_cond}
+            ORDER BY c.last_message_id DESC LIMIT ?
+        ''', tuple(params))
+        result = []
+        for row in cursor.fetchall():
+            ts = row['last_timestamp']
+            if isinstance(ts, datetime):
+                ts = ts.strftime('%Y-%m-%d %H:%M:%S')
+            is_group = row['kind'] == 'group'
+            result.append({
+                'type': row['kind'],
+                'target': int(row['target']) if is_group else row['target'],
+                'name': (row['group_name'] if is_group else row['display_name']) or row['target'],
+                'last_message_id': row['last_message_id'],
+                'last_sender': row['last_sender'],
+                'preview': row['last_preview'],
+                'timestamp': ts,
+                'unread': row['unread_count'],
+            })
+        next_cursor = result[-1]['last_message_id'] if len(result) >= limit else None
+        return result, next_cursor
+
+    def get_unread_counts(self, username):
+        """Các cuộc trò chuyện còn tin chưa đọc: [{'type', 'target', 'count'}]."""
+        cursor = self.execute_query(
+            "SELECT kind, target, unread_count FROM conversations WHERE username = ? AND unread_count > 0",
+            (username,))
+        return [{'type': r['kind'], 'target': int(r['target']) if r['kind'] == 'group' else r['target'],
+                 'count': r['unread_count']} for r in cursor.fetchall()]
+
+    def mark_read(self, username, kind, target):
         self.execute_query(
-            "INSERT INTO messages (sender, receiver, content, message_type) VALUES (?, ?, ?, ?)",
-            (sender, str(receiver) if receiver is not None else None, content, message_type)
-        )
+            "UPDATE conversations SET unread_count = 0 WHERE username = ? AND kind = ? AND target = ? AND unread_count > 0",
+            (username, kind, str(target)))
         self.conn.commit()
 
-    def get_history(self, limit=50, message_type='public', username=None, group_id=None):
+    def get_history(self, limit=50, message_type='public', username=None, group_id=None, before_id=None):
+        """
+        Lấy lịch sử tin nhắn theo thứ tự thời gian.
+        before_id: chỉ lấy các tin có id nhỏ hơn (dùng để phân trang ngược).
+        """
         query = ""
         params = []
         
-        base_select = "SELECT sender, receiver, content, timestamp, message_type FROM messages"
+        base_select = "SELECT id, sender, receiver, content, timestamp, message_type FROM messages"
+        # Điều kiện phân trang (keyset theo id)
+        page_cond = " AND id < ?" if before_id is not None else ""
+        page_params = [int(before_id)] if before_id is not None else []
         
         if message_type == 'public':
-            query = f"{base_select} WHERE message_type = 'public' ORDER BY id DESC LIMIT ?"
-            params = [limit]
+            query = f"{base_select} WHERE message_type = 'public'{page_cond} ORDER BY id DESC LIMIT ?"
+            params = page_params + [limit]
         elif message_type == 'private' and username:
-            query = f"{base_select} WHERE message_type = 'private' AND (sender = ? OR receiver = ?) ORDER BY id DESC LIMIT ?"
-            params = [username, username, limit]
+            query = f"{base_select} WHERE message_type = 'private' AND (sender = ? OR receiver = ?){page_cond} ORDER BY id DESC LIMIT ?"
+            params = [username, username] + page_params + [limit]
         elif message_type == 'group' and group_id:
-            query = f"{base_select} WHERE message_type = 'group' AND receiver = ? ORDER BY id DESC LIMIT ?"
-            params = [str(group_id), limit]
+            query = f"{base_select} WHERE message_type = 'group' AND receiver = ?{page_cond} ORDER BY id DESC LIMIT ?"
+            params = [str(group_id)] + page_params + [limit]
         else:
             # All messages for user
             if username:
@@ -381,6 +1464,7 @@ class Database:
                 ts = ts.strftime('%Y-%m-%d %H:%M:%S')
                 
             result.append({
+                'id': row['id'],
                 'sender': row['sender'],
                 'receiver': row['receiver'],
                 'content': row['content'],
@@ -395,23 +1479,21 @@ class Database:
         if name.strip().lower() in ["chat công khai", "public chat", "public", "công khai"]:
             return None
         try:
-            cursor = self.execute_query(
-                "INSERT INTO groups (name, creator) VALUES (?, ?)",
-                (name, creator)
-            )
+            query = "INSERT INTO groups (name, name_lower, creator, member_count) VALUES (?, ?, ?, 1)"
+            params = (name, group_name_key(name), creator)
             if self.db_type == 'sqlite':
-                group_id = cursor.lastrowid
+                group_id = self.execute_query(query, params).lastrowid
             else:
-                cursor = self.execute_query("INSERT INTO groups (name, creator) VALUES (?, ?) RETURNING id", (name, creator))
-                group_id = cursor.fetchone()['id']
+                group_id = self.execute_query(query + " RETURNING id", params).fetchone()['id']
             self.execute_query(
                 "INSERT INTO group_members (group_id, username) VALUES (?, ?)",
                 (group_id, creator)
             )
             self.conn.commit()
+            self.group_cache.add(group_id, creator)
             return group_id
         except Exception as e:
-            print(f"Create group error: {e}")
+            logger.error(f"Create group error: {e}")
             self.conn.rollback()
             return None
 
@@ -419,29 +1501,54 @@ class Database:
         try:
             # INSERT OR IGNORE syntax is SQLite specific. Postgres uses ON CONFLICT DO NOTHING
             if self.db_type == 'sqlite':
-                self.execute_query(
+                cursor = self.execute_query(
                     "INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)",
                     (group_id, username)
                 )
             else:
-                self.execute_query(
+                cursor = self.execute_query(
                     "INSERT INTO group_members (group_id, username) VALUES (?, ?) ON CONFLICT DO NOTHING",
                     (group_id, username)
                 )
+            if cursor.rowcount > 0:
+                self.execute_query("UPDATE groups SET member_count = member_count + 1 WHERE id = ?", (group_id,))
+                # Nhóm hiện ngay trong danh sách trò chuyện, với tin cuối chép từ dòng của thành viên khác
+                self.execute_query(
+                    f"INSERT INTO conversations {_CONVERSATION_COLUMNS} "
+                    "SELECT ?, 'group', target, 0, last_message_id, last_sender, last_preview, last_timestamp "
+                    "FROM conversations WHERE kind = 'group' AND target = ? AND last_message_id IS NOT NULL "
+                    "ORDER BY last_message_id DESC LIMIT 1 ON CONFLICT DO NOTHING",
+                    (username, str(group_id)))
             self.conn.commit()
+            gid = group_key(group_id)
+            if gid is not None:
+                self.group_cache.add(gid, username)
             return True
-        except Exception:
+        except Exception as e:
+            logger.error(f"Add group member error: {e}")
+            self.conn.rollback()
             return False
 
     def remove_member_from_group(self, group_id, username):
+        """True nếu user đã ở trong nhóm và bị xoá, False nếu không phải thành viên hoặc lỗi."""
         try:
-            self.execute_query(
+            cursor = self.execute_query(
                 "DELETE FROM group_members WHERE group_id = ? AND username = ?",
                 (group_id, username)
             )
+            removed = cursor.rowcount > 0
+            if removed:
+                self.execute_query("UPDATE groups SET member_count = member_count - 1 WHERE id = ?", (group_id,))
+                self.execute_query("DELETE FROM conversations WHERE username = ? AND kind = 'group' AND target = ?",
+                                   (username, str(group_id)))
             self.conn.commit()
-            return True
-        except Exception:
+            gid = group_key(group_id)
+            if gid is not None:
+                self.group_cache.remove(gid, username)
+            return removed
+        except Exception as e:
+            logger.error(f"Remove group member error: {e}")
+            self.conn.rollback()
             return False
 
     def get_user_groups(self, username):
@@ -467,23 +1574,340 @@ class Database:
         return result
 
 
-    def get_discoverable_groups(self, username):
+    def get_discoverable_groups(self, username, query=None, limit=None, after=None, match='prefix'):
         """
-        Trả về các nhóm mà user chưa tham gia (ngoại trừ nhóm công khai).
+        Trả về các nhóm mà user chưa tham gia (ngoại trừ nhóm công khai), theo tên rồi id.
+        query: lọc theo tên, không phân biệt hoa thường; match='prefix' (seek trên
+        idx_groups_name_lower) hoặc 'substring'. after: (name_lower, id) của dòng cuối trang
+        trước (keyset, xem group_cursor); limit: số dòng tối đa.
         """
-        cursor = self.execute_query('''
-            SELECT g.id, g.name, g.creator, g.created_at
+        sql = '''
+            SELECT g.id, g.name, g.creator, g.created_at, g.member_count
             FROM groups g
-            WHERE LOWER(g.name) NOT IN ('chat công khai', 'public chat', 'public', 'công khai')
-            AND g.id NOT IN (
-                SELECT group_id FROM group_members WHERE username = ?
+            WHERE g.name_lower NOT IN ('chat công khai', 'public chat', 'public', 'công khai')
+        '''
+        params = []
+        if query:
+            key = group_name_key(query)
+            if match == 'substring':
+                escaped = key.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                sql += " AND g.name_lower LIKE ? ESCAPE '\\'"
+                params.append(f"%{escaped}%")
+            else:
+                sql += " AND g.name_lower >= ? AND g.name_lower < ?"
+                params.extend([key, key + '\U0010ffff'])
+        if after is not None:
+            sql += " AND (g.name_lower, g.id) > (?, ?)"
+            params.extend(after)
+        # Anti-join theo PK (group_id, username), không dựng cả tập nhóm của user
+        sql += '''
+            AND NOT EXISTS (
+                SELECT 1 FROM group_members gm WHERE gm.group_id = g.id AND gm.username = ?
             )
-        ''', (username,))
+            ORDER BY g.name_lower, g.id
+        '''
+        params.append(username)
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        cursor = self.execute_query(sql, tuple(params))
         return [dict(row) for row in cursor.fetchall()]
 
+    def search_messages(self, username, query, scope='all', cursor=None, limit=20):
+        """
+        Tìm tin nhắn user được xem (công khai, tin riêng của mình, nhóm đã tham gia),
+        xếp theo độ liên quan. Từ cuối được khớp tiền tố (gõ tới đâu tìm tới đó).
+        scope: 'all' | 'public' | 'private' | 'private:<user>' | 'group' | 'group:<id>'.
+        cursor: next_cursor của trang trước ([before_id, offset], xem search_cursor), None = trang đầu.
+        Trả về (results, next_cursor).
+
+        SQLite xếp hạng theo từng cửa sổ SEARCH_CANDIDATES tin khớp (mới nhất trước): hết một
+        cửa sổ thì next_cursor chuyển sang cửa sổ các tin cũ hơn, nên vẫn đi hết lịch sử.
+        Postgres xếp hạng mọi tin khớp cùng lúc.
+        """
+        terms = search_terms(query)
+        if not terms or self.search_backend is None:
+            return [], None
+        kind, _, target = (scope or 'all').partition(':')
+        before, offset = search_cursor(cursor) if cursor is not None else (None, 0)
+
+        # Quyền xem: group ids lấy từ GroupCache, không join group_members cho mỗi dòng khớp
+        if kind == 'group' and target:
+            group_ids = [target] if self.is_group_member(target, username) else []
+        else:
+            group_ids = [str(g) for g in sorted(self.get_user_group_ids(username))]
+        conds, params = [], []
+        if kind in ('all', 'public'):
+            conds.append("m.message_type = 'public'")
+        if kind in ('all', 'private'):
+            if target:
+                conds.append("(m.message_type = 'private' AND ((m.sender = ? AND m.receiver = ?) OR (m.sender = ? AND m.receiver = ?)))")
+                params.extend([username, target, target, username])
+            else:
+                conds.append("(m.message_type = 'private' AND (m.sender = ? OR m.receiver = ?))")
+                params.extend([username, username])
+        if kind in ('all', 'group') and group_ids:
+            conds.append(f"(m.message_type = 'group' AND m.receiver IN ({', '.join('?' * len(group_ids))}))")
+            params.extend(group_ids)
+        if not conds:
+            return [], None
+        access = ' OR '.join(conds)
+
+        columns = "m.id, m.sender, m.receiver, m.content, m.timestamp, m.message_type"
+        if self.search_backend == 'fts5':
+            match = ' '.join(f'"{t}"' for t in terms) + '*'
+            # Mỗi lần chỉ xếp hạng một cửa sổ SEARCH_CANDIDATES tin khớp có id < before (FTS5
+            # duyệt rowid giảm dần không cần sort), để từ phổ biến không phải tính bm25 cho cả
+            # trăm nghìn dòng; window_size / window_min cho biết cửa sổ đã đầy và chỗ bắt đầu cửa sổ sau
+            window = " AND messages_fts.rowid < ?" if before is not None else ""
+            sql = f'''
+                SELECT *, COUNT(*) OVER () AS window_size, MIN(id) OVER () AS window_min FROM (
+                    SELECT {columns}, bm25(messages_fts) AS score,
+                           snippet(messages_fts, 0, '[', ']', '…', 16) AS snippet
+                    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE messages_fts MATCH ?{window} AND ({access})
+                    ORDER BY messages_fts.rowid DESC
+                    LIMIT {self.SEARCH_CANDIDATES}
+                )
+                ORDER BY score, id DESC
+                LIMIT ? OFFSET ?
+            '''
+            params = [match] + ([before] if before is not None else []) + params
+        else:
+            tsquery = ' & '.join(terms) + ':*'
+            q = f"to_tsquery('simple', {self._tsv_normalize}(?))"
+            sql = f'''
+                SELECT p.*, ts_headline('simple', p.content, {q},
+                                        'StartSel=[, StopSel=], MaxWords=24, MinWords=8') AS snippet
+                FROM (
+                    SELECT {columns}, ts_rank({self._tsv_expr('m.content')}, {q}) AS score
+                    FROM messages m
+                    WHERE {self._tsv_expr('m.content')} @@ {q} AND ({access})
+                    ORDER BY score DESC, m.id DESC
+                    LIMIT ? OFFSET ?
+                ) p
+                ORDER BY p.score DESC, p.id DESC
+            '''
+            params = [tsquery, tsquery, tsquery] + params
+        # Lấy dư 1 dòng để biết còn trang sau
+        params.extend([limit + 1, offset])
+        rows = self.execute_query(sql, tuple(params)).fetchall()
+
+        results = []
+        for row in rows[:limit]:
+            ts = row['timestamp']
+            if isinstance(ts, datetime):
+                ts = ts.strftime('%Y-%m-%d %H:%M:%S')
+            results.append({
+                'id': row['id'],
+                'sender': row['sender'],
+                'receiver': row['receiver'],
+                'content': row['content'],
+                'snippet': row['snippet'],
+                'timestamp': ts,
+                'message_type': row['message_type'],
+            })
+        if len(rows) > limit:
+            next_cursor = [before, offset + limit]
+        elif rows and self.search_backend == 'fts5' and rows[0]['window_size'] >= self.SEARCH_CANDIDATES:
+            # Hết cửa sổ đầy: còn có thể có tin khớp cũ hơn
+            next_cursor = [rows[0]['window_min'], 0]
+        else:
+            next_cursor = None
+        return results, next_cursor
+
+    def export_messages(self, filepath, batch_size=None, after_id=None, progress=None):
+        """
+        Xuất tin nhắn ra file NDJSON (mỗi dòng một tin, id tăng dần; nén theo đuôi .gz/.zst).
+        Đọc theo từng lô batch_size dòng (Postgres: named cursor phía server) nên bộ nhớ
+        không phụ thuộc kích thước lịch sử.
+        after_id: chỉ xuất các tin có id lớn hơn (xuất tiếp phần mới).
+        progress(count, last_id) được gọi sau mỗi lô. Trả về số tin đã xuất.
+        """
+        batch_size = batch_size or self.TRANSFER_BATCH
+        query = f"SELECT {', '.join(MESSAGE_EXPORT_FIELDS)} FROM messages"
+        params = ()
+        if after_id is not None:
+            query += " WHERE id > ?"
+            params = (int(after_id),)
+        query += " ORDER BY id"
+
+        if self.db_type == 'postgres':
+            cursor = self.conn.cursor(name=f"chat_export_{os.getpid()}")
+            cursor.itersize = batch_size
+        else:
+            # Cursor SQLite vốn chỉ đọc thêm dòng khi fetch
+            cursor = self.get_cursor()
+        count = 0
+        try:
+            with open_history(filepath, 'w') as out:
+                rows = self.execute_query(query, params, cursor=cursor)
+                while True:
+                    batch = rows.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    write_records(out, batch)
+                    count += len(batch)
+                    if progress:
+                        progress(count, batch[-1]['id'])
+        finally:
+            cursor.close()
+            if self.db_type == 'postgres':
+                # Kết thúc transaction giữ named cursor
+                self.conn.commit()
+        return count
+
+    def import_messages(self, filepath, batch_size=None, keep_ids=True, skip=0, progress=None):
+        """
+        Nhập tin nhắn từ file do export_messages tạo: đọc từng dòng, ghi theo lô batch_size
+        dòng bằng một câu INSERT nhiều dòng, mỗi lô một transaction.
+        keep_ids=True giữ id gốc (chuyển SQLite <-> Postgres): tin đã có bị bỏ qua, nên chạy
+        lại sau khi bị dừng giữa chừng sẽ nhập tiếp phần còn thiếu. keep_ids=False cấp id mới
+        (gộp lịch sử từ máy khác); khi đó chạy tiếp bằng skip = số dòng progress đã báo.
+        progress(lines, inserted) được gọi sau mỗi lô. Trả về số tin đã thêm.
+        """
+        batch_size = batch_size or self.TRANSFER_BATCH
+        columns = MESSAGE_EXPORT_FIELDS if keep_ids else MESSAGE_EXPORT_FIELDS[1:]
+        cursor = self.get_cursor()
+        lines = inserted = 0
+        batch = []
+
+        def flush():
+            nonlocal inserted
+            try:
+                inserted += self._insert_messages(cursor, columns, batch, keep_ids)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            batch.clear()
+            if progress:
+                progress(lines, inserted)
+
+        with open_history(filepath, 'r') as f:
+            for line in f:
+                lines += 1
+                if lines <= skip or not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    row = (record['sender'], record.get('receiver'), record['content'],
+                           record.get('message_type') or 'public',
+                           record.get('timestamp') or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+                    if keep_ids:
+                        row = (int(record['id']),) + row
+                except (ValueError, TypeError, KeyError) as e:
+                    raise ValueError(f"{filepath}:{lines}: dòng không hợp lệ ({e!r})") from None
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    flush()
+        if batch:
+            flush()
+
+        if keep_ids and self.db_type == 'postgres' and inserted:
+            # id được ghi trực tiếp nên sequence phải nhảy lên sau id lớn nhất
+            self.execute_query("SELECT setval(pg_get_serial_sequence('messages', 'id'), "
+                               "(SELECT MAX(id) FROM messages))", cursor=cursor)
+            self.conn.commit()
+        if inserted:
+            self.rebuild_conversations()
+        return inserted
+
+    def _insert_messages(self, cursor, columns, rows, keep_ids):
+        """INSERT một lô tin nhắn; trả về số dòng thực sự được thêm (trùng id thì bỏ qua)."""
+        # Không ghi rõ cột: trên bảng partition, PK là (id, timestamp)
+        conflict = " ON CONFLICT DO NOTHING" if keep_ids else ""
+        start = time.perf_counter()
+        if self.db_type == 'postgres':
+            query = f"INSERT INTO messages ({', '.join(columns)}) VALUES %s{conflict} RETURNING id"
+            count = len(execute_values(cursor, query, rows, page_size=len(rows), fetch=True))
+        else:
+            query = f"INSERT INTO messages ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}){conflict}"
+            cursor.executemany(query, rows)
+            count = cursor.rowcount
+        if self.query_stats is not None:
+            self.query_stats.record(self.query_stats.entry_for(query), time.perf_counter() - start, rows=count)
+        return count
+
+    def archive_messages(self, message_type, before, batch_size=None, sink=None):
+        """
+        Chuyển một lô (tối đa batch_size) tin nhắn loại message_type có timestamp < before
+        ra khỏi messages: vào sink(rows) nếu có (vd. ghi file, phải bền vững khi trả về),
+        ngược lại vào bảng messages_archive; xoá khỏi messages trong cùng transaction.
+        Trả về số tin đã chuyển, 0 khi không còn tin nào quá hạn.
+        """
+        batch_size = batch_size or self.ARCHIVE_BATCH
+        if isinstance(before, datetime):
+            before = before.strftime('%Y-%m-%d %H:%M:%S')
+        cursor = self.execute_query(
+            f"SELECT {', '.join(MESSAGE_EXPORT_FIELDS)} FROM messages "
+            "WHERE message_type = ? AND timestamp < ? ORDER BY timestamp LIMIT ?",
+            (message_type, before, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+        try:
+            if sink is not None:
+                sink(rows)
+            cursor = self.get_cursor()
+            ids = [row['id'] for row in rows]
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                if sink is None:
+                    cols = ', '.join(MESSAGE_EXPORT_FIELDS)
+                    self.execute_query(f"INSERT INTO messages_archive ({cols}) SELECT {cols} FROM messages "
+                                       f"WHERE id IN ({placeholders}) ON CONFLICT DO NOTHING", chunk, cursor=cursor)
+                self.execute_query(f"DELETE FROM messages WHERE id IN ({placeholders})", chunk, cursor=cursor)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return len(rows)
+
+    def get_group(self, group_id):
+        cursor = self.execute_query("SELECT id, name, creator, created_at FROM groups WHERE id = ?", (group_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
     def get_group_members(self, group_id):
         cursor = self.execute_query("SELECT username FROM group_members WHERE group_id = ?", (group_id,))
-        return [row['username'] for row in cursor.fetchall()]
+        names = [row['username'] for row in cursor.fetchall()]
+        gid = group_key(group_id)
+        if gid is not None:
+            self.group_cache.put_members(gid, names)
+        return names
+
+    def get_group_member_set(self, group_id):
+        """Set username thành viên của nhóm, đọc từ GroupCache khi có."""
+        gid = group_key(group_id)
+        if gid is None:
+            return set()
+        members = self.group_cache.members(gid)
+        if members is None:
+            members = set(self.get_group_members(gid))
+        return set(members)
+
+    def get_user_group_ids(self, username):
+        """Set id các nhóm user đã tham gia, đọc từ GroupCache khi có."""
+        group_ids = self.group_cache.groups(username)
+        if group_ids is None:
+            cursor = self.execute_query("SELECT group_id FROM group_members WHERE username = ?", (username,))
+            group_ids = {row['group_id'] for row in cursor.fetchall()}
+            self.group_cache.put_groups(username, group_ids)
+        return set(group_ids)
+
+    def is_group_member(self, group_id, username):
+        gid = group_key(group_id)
+        if gid is None:
+            return False
+        group_ids = self.group_cache.groups(username)
+        if group_ids is not None:
+            return gid in group_ids
+        members = self.group_cache.members(gid)
+        if members is not None:
+            return username in members
+        return gid in self.get_user_group_ids(username)
 
     def get_all_users(self):
         cursor = self.execute_query("SELECT username, display_name FROM users WHERE is_active = 1")
@@ -494,97 +1918,177 @@ class Database:
         # Let's simple directional: user1 is requester, user2 is target for pending status
         # Check if already friends or pending
         try:
-            # Check existing relationship in either direction
-            cursor = self.execute_query('''
-                SELECT status FROM friends 
-                WHERE (user1 = ? AND user2 = ?) OR (user1 = ? AND user2 = ?)
-            ''', (requester, target, target, requester))
+            # Cạnh lưu cả 2 chiều nên chỉ cần một lần seek theo PK
+            cursor = self.execute_query(
+                "SELECT status FROM friend_edges WHERE owner = ? AND peer = ?",
+                (requester, target)
+            )
             row = cursor.fetchone()
             if row:
                 return False, f"Relationship already exists: {row['status']}"
 
             self.execute_query(
-                "INSERT INTO friends (user1, user2, status) VALUES (?, ?, 'pending')",
+                "INSERT INTO friend_edges (owner, peer, status, direction) VALUES (?, ?, 'pending', 'out')",
                 (requester, target)
             )
+            self.execute_query(
+                "INSERT INTO friend_edges (owner, peer, status, direction) VALUES (?, ?, 'pending', 'in')",
+                (target, requester)
+            )
             self.conn.commit()
             return True, "Request sent"
         except Exception as e:
+            self.conn.rollback()
             return False, str(e)
 
     def accept_friend(self, accepter, requester):
         """Accept a friend request"""
         try:
-            # Update status where user1=requester AND user2=accepter
+            # Chỉ người nhận lời mời (cạnh 'in' đang pending) mới accept được
             cursor = self.execute_query(
-                "UPDATE friends SET status = 'accepted' WHERE user1 = ? AND user2 = ? AND status = 'pending'",
-                (requester, accepter)
+                "UPDATE friend_edges SET status = 'accepted' WHERE owner = ? AND peer = ? AND status = 'pending' AND direction = 'in'",
+                (accepter, requester)
             )
             if cursor.rowcount > 0:
+                self.execute_query(
+                    "UPDATE friend_edges SET status = 'accepted' WHERE owner = ? AND peer = ?",
+                    (requester, accepter)
+                )
                 self.conn.commit()
+                self.friend_cache.add_edge(accepter, requester)
                 return True
             return False
         except Exception:
             self.conn.rollback()
             return False
 
+    def get_friend_names(self, username):
+        """Set tên các bạn đã accepted (từ cache; nạp từ DB ở lần đầu). Không được sửa set trả về."""
+        names = self.friend_cache.friends(username)
+        if names is None:
+            cursor = self.execute_query(
+                "SELECT peer FROM friend_edges WHERE owner = ? AND status = 'accepted'",
+                (username,)
+            )
+            names = {row['peer'] for row in cursor.fetchall()}
+            self.friend_cache.put_friends(username, names)
+        return names
+
+    def _get_profiles(self, usernames):
+        """username -> (display_name, last_login) cho các user tồn tại, ưu tiên cache."""
+        profiles = {}
+        missing = []
+        for name in usernames:
+            p = self.friend_cache.profile(name)
+            if p is None:
+                missing.append(name)
+            else:
+                profiles[name] = p
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            cursor = self.execute_query(
+                f"SELECT username, display_name, last_login FROM users WHERE username IN ({placeholders})",
+                tuple(chunk))
+            for row in cursor.fetchall():
+                ts = row['last_login']
+                if isinstance(ts, datetime):
+                    ts = ts.isoformat()
+                elif ts is None:
+                    ts = ""
+                profiles[row['username']] = (row['display_name'], ts)
+                self.friend_cache.put_profile(row['username'], row['display_name'], ts)
+        return profiles
+
     def get_friends_with_status(self, username):
         """Get all accepted friends for a user, including their last_login"""
-        # Friends can be (user1=me, user2=them) OR (user1=them, user2=me)
-        query = '''
-            SELECT 
-                CASE WHEN f.user1 = ? THEN f.user2 ELSE f.user1 END as friend_name,
-                u.display_name,
-                u.last_login
-            FROM friends f
-            JOIN users u ON u.username = (CASE WHEN f.user1 = ? THEN f.user2 ELSE f.user1 END)
-            WHERE (f.user1 = ? OR f.user2 = ?) AND f.status = 'accepted'
-        '''
-        cursor = self.execute_query(query, (username, username, username, username))
+        names = sorted(self.get_friend_names(username))
+        profiles = self._get_profiles(names)
         result = []
-        for row in cursor.fetchall():
-            ts = row['last_login']
-            if isinstance(ts, datetime):
-                ts = ts.isoformat()
-            elif ts is None:
-                ts = ""
-                
+        for name in names:
+            if name not in profiles:
+                continue
+            display_name, ts = profiles[name]
             result.append({
-                'username': row['friend_name'],
-                'display_name': row['display_name'] or row['friend_name'],
+                'username': name,
+                'display_name': display_name or name,
                 'last_login': ts
             })
         return result
 
     def get_pending_requests(self, username):
-        """Get requests pending for this user (where user2 = username)"""
+        """Get requests pending for this user (lời mời người khác gửi tới)"""
         query = '''
-            SELECT f.user1 as requester, u.display_name
-            FROM friends f
-            JOIN users u ON u.username = f.user1
-            WHERE f.user2 = ? AND f.status = 'pending'
+            SELECT e.peer as requester, u.display_name
+            FROM friend_edges e
+            JOIN users u ON u.username = e.peer
+            WHERE e.owner = ? AND e.status = 'pending' AND e.direction = 'in'
         '''
         cursor = self.execute_query(query, (username,))
         return [{'username': row['requester'], 'display_name': row['display_name'] or row['requester']} for row in cursor.fetchall()]
 
     def get_sent_requests(self, username):
-        """Get requests sent by this user (where user1 = username)"""
+        """Get requests sent by this user (lời mời user đã gửi, chưa được chấp nhận)"""
         query = '''
-            SELECT f.user2 as target, u.display_name
-            FROM friends f
-            JOIN users u ON u.username = f.user2
-            WHERE f.user1 = ? AND f.status = 'pending'
+            SELECT e.peer as target, u.display_name
+            FROM friend_edges e
+            JOIN users u ON u.username = e.peer
+            WHERE e.owner = ? AND e.status = 'pending' AND e.direction = 'out'
         '''
         cursor = self.execute_query(query, (username,))
         return [{'username': row['target'], 'display_name': row['display_name'] or row['target']} for row in cursor.fetchall()]
     
-    def are_friends(self, user1, user2):
+    def get_bootstrap(self, username, conversations_limit=50):
+        """
+        Dữ liệu khởi tạo khi đăng nhập: bạn bè (kèm lời mời đến/đã gửi), nhóm đã tham gia,
+        trang đầu danh sách cuộc trò chuyện và số chưa đọc. Ba query (thêm một query số chưa
+        đọc khi có hơn một trang cuộc trò chuyện); nạp luôn cache bạn bè / nhóm của user.
+        """
         cursor = self.execute_query('''
-            SELECT 1 FROM friends 
-            WHERE ((user1 = ? AND user2 = ?) OR (user1 = ? AND user2 = ?)) 
-            AND status = 'accepted'
-        ''', (user1, user2, user2, user1))
-        return cursor.fetchone() is not None
+            SELECT e.peer, e.status, e.direction, u.display_name, u.last_login
+            FROM friend_edges e
+            JOIN users u ON u.username = e.peer
+            WHERE e.owner = ?
+        ''', (username,))
+        friends, pending, sent = [], [], []
+        for row in cursor.fetchall():
+            name = row['peer']
+            display_name = row['display_name'] or name
+            if row['status'] == 'accepted':
+                ts = row['last_login']
+                if isinstance(ts, datetime):
+                    ts = ts.isoformat()
+                elif ts is None:
+                    ts = ""
+                self.friend_cache.put_profile(name, row['display_name'], ts)
+                friends.append({'username': name, 'display_name': display_name, 'last_login': ts})
+            elif row['direction'] == 'in':
+                pending.append({'username': name, 'display_name': display_name})
+            else:
+                sent.append({'username': name, 'display_name': display_name})
+        friends.sort(key=lambda f: f['username'])
+        self.friend_cache.put_friends(username, {f['username'] for f in friends})
+
+        groups = self.get_user_groups(username)
+        self.group_cache.put_groups(username, {g['id'] for g in groups})
+
+        conversations, next_cursor = self.get_conversations(username, limit=conversations_limit)
+        if next_cursor is None:
+            unread = [{'type': c['type'], 'target': c['target'], 'count': c['unread']}
+                      for c in conversations if c['unread'] > 0]
+        else:
+            unread = self.get_unread_counts(username)
+        return {'friends': friends, 'pending': pending, 'sent': sent, 'groups': groups,
+                'conversations': conversations, 'next_cursor': next_cursor, 'unread': unread}
+
+    def are_friends(self, user1, user2):
+        names = self.friend_cache.friends(user1)
+        if names is not None:
+            return user2 in names
+        names = self.friend_cache.friends(user2)
+        if names is not None:
+            return user1 in names
+        return user2 in self.get_friend_names(user1)
 
     def update_last_seen(self, username):
         """Update last_login timestamp now"""
@@ -594,6 +2098,7 @@ class Database:
                 (username,)
             )
             self.conn.commit()
+            self.friend_cache.invalidate_profile(username)
         except:
             pass
 
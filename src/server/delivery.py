@@ -0,0 +1,98 @@
+# Replay tin nhắn cho client kết nối lại (LOGIN since_seq / SYNC).
+#
+# seq của một tin là id của nó trong bảng messages: tăng dần, nên dãy tin mỗi user nhận được
+# cũng tăng dần và client chỉ cần giữ seq lớn nhất đã xử lý. Khi kết nối lại, client gửi mốc
+# đó; server trả đúng các tin sau mốc mà user được nhận (tin riêng gửi cho user, tin nhóm
+# user đang tham gia, kể cả tin user gửi từ phiên khác) theo thứ tự seq; client bỏ các seq đã có.
+#
+# RecentMessages giữ RING_SIZE tin mới nhất trong bộ nhớ. Vòng chỉ trả lời khi chắc chắn có
+# đủ mọi tin sau mốc (không thiếu id nào ở giữa); còn lại server đọc từ database. Khi chạy
+# nhiều process, tin được publish sang các process khác giống cache bạn bè/nhóm.
+import bisect
+import logging
+import os
+import threading
+
+logger = logging.getLogger('chat.delivery')
+
+RING_SIZE = int(os.environ.get('CHAT_SYNC_RING_SIZE', 10000))
+
+
+def visible_to(message, username, group_ids):
+    """Tin có được giao cho user không (group_ids: tập id nhóm dạng str)."""
+    if message['message_type'] == 'private':
+        return username in (message['receiver'], message['sender'])
+    if message['message_type'] == 'group':
+        return message['receiver'] in group_ids
+    return False
+
+
+class RecentMessages:
+    """
+    Vòng các tin riêng/nhóm mới nhất, sắp theo seq. floor: mốc nhỏ nhất mà vòng biết đủ
+    mọi tin sau nó; tin bị đẩy ra khỏi vòng hoặc id nhảy cóc (tin từ nơi khác) nâng floor.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self._seqs = []
+        self._messages = []
+        self.floor = None
+        self._lock = threading.Lock()
+        self.publish = None
+
+    def record(self, message, propagate=True):
+        seq = message['id']
+        with self._lock:
+            if not self._seqs:
+                self.floor = seq - 1
+                self._seqs.append(seq)
+                self._messages.append(message)
+            elif seq > self._seqs[-1]:
+                if seq != self._seqs[-1] + 1:
+                    # Có id ở giữa vòng chưa thấy (tin công khai, tin ghi ở process khác chưa tới...)
+                    self.floor = seq - 1
+                self._seqs.append(seq)
+                self._messages.append(message)
+            else:
+                i = bisect.bisect_left(self._seqs, seq)
+                if i < len(self._seqs) and self._seqs[i] == seq:
+                    return
+                self._seqs.insert(i, seq)
+                self._messages.insert(i, message)
+            if len(self._seqs) > self.size:
+                self.floor = max(self.floor, self._seqs.pop(0))
+                self._messages.pop(0)
+        if propagate and self.publish is not None:
+            try:
+                self.publish({'message': message})
+            except Exception as e:
+                logger.warning("delivery publish failed", extra={'fields': {'error': str(e)}})
+
+    def apply(self, message):
+        self.record(message['message'], propagate=False)
+
+    def since(self, seq, username, group_ids, limit):
+        """Tối đa limit tin user được nhận có seq > mốc; None nếu vòng không đủ để trả lời."""
+        with self._lock:
+            if self.floor is None or seq < self.floor:
+                return None
+            start = bisect.bisect_right(self._seqs, seq)
+            result = []
+            for message in self._messages[start:]:
+                if visible_to(message, username, group_ids):
+                    result.append(message)
+                    if len(result) >= limit:
+                        break
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._seqs.clear()
+            self._messages.clear()
+            self.floor = None
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._seqs), 'floor': self.floor,
+                    'newest': self._seqs[-1] if self._seqs else None}
@@ -0,0 +1,127 @@
+# Dispatcher dạng bảng cho các message Socket.IO: type -> handler (tra cứu O(1)).
+# Mỗi route có chuỗi middleware (auth, validate, timing) được ghép sẵn lúc đăng ký
+# và một histogram độ trễ riêng để profile theo từng loại message.
+import time
+
+from src.server.metrics import DEFAULT_BUCKETS, LatencyHistogram  # noqa: F401 (re-export)
+
+
+class MessageContext:
+    """Thông tin của một message đang được xử lý."""
+    __slots__ = ('sid', 'msg_type', 'payload', 'username')
+
+    def __init__(self, sid, msg_type, payload, username=None):
+        self.sid = sid
+        self.msg_type = msg_type
+        self.payload = payload
+        self.username = username
+
+
+class Route:
+    __slots__ = ('msg_type', 'handler', 'histogram', 'call')
+
+    def __init__(self, msg_type, handler, histogram, call):
+        self.msg_type = msg_type
+        self.handler = handler
+        self.histogram = histogram
+        self.call = call
+
+
+def timing_middleware(histogram):
+    def middleware(ctx, call_next):
+        start = time.perf_counter()
+        error = True
+        try:
+            result = call_next(ctx)
+            error = False
+            return result
+        finally:
+            histogram.observe(time.perf_counter() - start, error)
+    return middleware
+
+
+class Dispatcher:
+    """
+    Registry handler theo type message.
+
+    get_username(sid) -> username hoặc None, dùng cho middleware xác thực.
+    histograms: (tuỳ chọn) metrics.Histogram theo label type, để /metrics thấy độ trễ handler.
+    on_unauthorized(ctx) / on_invalid(ctx) được gọi khi middleware từ chối message.
+    """
+
+    def __init__(self, get_username, on_unauthorized=None, on_invalid=None, histograms=None):
+        self._routes = {}
+        # histograms: metrics.Histogram có label 'type'; None = histogram riêng cho từng dispatcher
+        self.histograms = histograms
+        self.get_username = get_username
+        self.on_unauthorized = on_unauthorized
+        self.on_invalid = on_invalid
+
+    # --- Middleware dựng sẵn ---
+
+    def _auth_middleware(self, ctx, call_next):
+        ctx.username = self.get_username(ctx.sid)
+        if not ctx.username:
+            if self.on_unauthorized:
+                self.on_unauthorized(ctx)
+            return None
+        return call_next(ctx)
+
+    def _optional_auth_middleware(self, ctx, call_next):
+        ctx.username = self.get_username(ctx.sid)
+        return call_next(ctx)
+
+    def _validation_middleware(self, expected):
+        def middleware(ctx, call_next):
+            if not isinstance(ctx.payload, expected):
+                if self.on_invalid:
+                    self.on_invalid(ctx)
+                return None
+            return call_next(ctx)
+        return middleware
+
+    # --- Đăng ký ---
+
+    def route(self, msg_type, auth=True, payload=None, middleware=()):
+        """
+        Decorator đăng ký handler(ctx) cho msg_type.
+        auth: True (bắt buộc đăng nhập), False (không cần, vẫn điền ctx.username nếu có).
+        payload: kiểu (hoặc tuple kiểu) bắt buộc của payload, None = không kiểm tra.
+        middleware: middleware bổ sung, dạng mw(ctx, call_next).
+        """
+        def decorator(handler):
+            if msg_type in self._routes:
+                raise ValueError(f"Handler for {msg_type} already registered")
+            histogram = self.histograms.labels(msg_type) if self.histograms else LatencyHistogram()
+            chain = [timing_middleware(histogram)]
+            chain.append(self._auth_middleware if auth else self._optional_auth_middleware)
+            if payload is not None:
+                chain.append(self._validation_middleware(payload))
+            chain.extend(middleware)
+            self._routes[msg_type] = Route(msg_type, handler, histogram, self._compose(chain, handler))
+            return handler
+        return decorator
+
+    @staticmethod
+    def _compose(chain, handler):
+        call = handler
+        for mw in reversed(chain):
+            call = (lambda m, nxt: lambda ctx: m(ctx, nxt))(mw, call)
+        return call
+
+    # --- Dispatch ---
+
+    def dispatch(self, sid, data):
+        if not isinstance(data, dict):
+            return None
+        route = self._routes.get(data.get('type'))
+        if route is None:
+            return None
+        return route.call(MessageContext(sid, route.msg_type, data.get('payload')))
+
+    def routes(self):
+        return dict(self._routes)
+
+    def snapshot(self):
+        """Thống kê độ trễ theo từng loại message."""
+        return {t: r.histogram.snapshot() for t, r in self._routes.items()}
@@ -1,41 +1,73 @@
 #!/usr/bin/env python3
 """
-Script để export/import lịch sử chat giữa các máy
-Sử dụng: python export_import.py [export|import] [filepath]
+Script để export/import lịch sử chat giữa các máy (hoặc giữa SQLite và Postgres).
+File là NDJSON, mỗi dòng một tin nhắn; đuôi .gz / .zst để nén, '-' là stdin/stdout.
+
+Ví dụ:
+  python src/server/export_import.py export chat_history.ndjson.gz
+  python src/server/export_import.py import chat_history.ndjson.gz
+  # SQLite -> Postgres không cần file trung gian
+  python src/server/export_import.py export - | DATABASE_URL=postgresql://... python src/server/export_import.py import -
+
+Database lấy theo DATABASE_URL / CHAT_DB_PATH như server. Import giữ id gốc và bỏ qua tin
+đã có, nên chạy lại cùng lệnh sau khi bị dừng sẽ nhập tiếp; với --new-ids dùng --skip N
+(N là số dòng đã báo ở lần chạy trước).
 """
 
-import sys
+import argparse
 import os
-from db import Database
+import sys
+import time
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
-def main():
-    if len(sys.argv) < 3:
-        print("Sử dụng: python export_import.py [export|import] [filepath]")
-        print("Ví dụ:")
-        print("  python export_import.py export chat_history.json")
-        print("  python export_import.py import chat_history.json")
-        return
+from src.server.db import Database
 
-    action = sys.argv[1].lower()
-    filepath = sys.argv[2]
 
-    if action not in ['export', 'import']:
-        print("Action phải là 'export' hoặc 'import'")
-        return
+def reporter(template):
+    """Callback progress in một dòng tiến độ (ghi đè) ra stderr."""
+    start = time.monotonic()
+
+    def report(count, value):
+        rate = count / max(time.monotonic() - start, 1e-6)
+        print('\r' + template.format(count=count, value=value), f"- {rate:.0f}/s",
+              end='', file=sys.stderr, flush=True)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export/import lịch sử chat dạng NDJSON")
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('filepath', help="file .ndjson / .gz / .zst, hoặc '-' cho stdin/stdout")
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help=f"số dòng mỗi lô (mặc định {Database.TRANSFER_BATCH})")
+    parser.add_argument('--after-id', type=int, default=None, help="export: chỉ xuất tin có id lớn hơn")
+    parser.add_argument('--new-ids', action='store_true', help="import: cấp id mới thay vì giữ id gốc")
+    parser.add_argument('--skip', type=int, default=0, help="import: bỏ qua N dòng đầu (chạy tiếp)")
+    parser.add_argument('--quiet', action='store_true', help="không in tiến độ")
+    args = parser.parse_args(argv)
+
+    if args.action == 'import' and args.filepath != '-' and not os.path.exists(args.filepath):
+        print(f"❌ File {args.filepath} không tồn tại", file=sys.stderr)
+        return 1
 
     try:
         with Database() as db:
-            if action == 'export':
-                count = db.export_messages(filepath)
-                print(f"✅ Đã xuất thành công {count} tin nhắn vào {filepath}")
-            elif action == 'import':
-                if not os.path.exists(filepath):
-                    print(f"❌ File {filepath} không tồn tại")
-                    return
-                count = db.import_messages(filepath)
-                print(f"✅ Đã nhập thành công {count} tin nhắn từ {filepath}")
+            if args.action == 'export':
+                progress = None if args.quiet else reporter("đã xuất {count} tin (tới id {value})")
+                count = db.export_messages(args.filepath, args.batch_size, args.after_id, progress=progress)
+                print(f"\n✅ Đã xuất thành công {count} tin nhắn vào {args.filepath}", file=sys.stderr)
+            else:
+                progress = None if args.quiet else reporter("đã đọc {count} dòng ({value} tin mới)")
+                count = db.import_messages(args.filepath, args.batch_size, keep_ids=not args.new_ids,
+                                           skip=args.skip, progress=progress)
+                print(f"\n✅ Đã nhập thành công {count} tin nhắn từ {args.filepath}", file=sys.stderr)
     except Exception as e:
-        print(f"❌ Lỗi: {e}")
+        print(f"\n❌ Lỗi: {e}", file=sys.stderr)
+        return 1
+    return 0
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,198 @@
+# Logging có cấu trúc cho server: QueueHandler trên hot path, ghi ra stream bằng thread nền.
+#
+# Cấu hình qua biến môi trường:
+#   CHAT_LOG_LEVEL   mức mặc định (INFO)
+#   CHAT_LOG_LEVELS  mức riêng cho từng subsystem, ví dụ "db=WARNING,server=DEBUG"
+#   CHAT_LOG_FORMAT  "text" (mặc định) hoặc "json"
+#   CHAT_LOG_MAX_FIELD  độ dài tối đa của một field trước khi bị cắt (256)
+#
+# Dùng:
+#   logger = get_logger('server')
+#   logger.info("user connected", extra=fields(sid=sid))
+#   logger.debug("file chunk", extra=fields(size=n, sample_rate=0.01))
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+ROOT_LOGGER = 'chat'
+# Các key luôn bị ẩn khi log payload
+REDACT_KEYS = frozenset({'password', 'password_hash', 'data', 'token'})
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def get_logger(subsystem):
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+
+def fields(sample_rate=None, **kwargs):
+    """Tạo `extra` cho lệnh log: các field có cấu trúc và (tuỳ chọn) tỉ lệ lấy mẫu."""
+    extra = {'fields': kwargs}
+    if sample_rate is not None:
+        extra['sample_rate'] = sample_rate
+    return extra
+
+
+def truncate(value, max_len, depth=0):
+    """Cắt chuỗi dài và ẩn các key nhạy cảm trong dict/list (đệ quy có giới hạn)."""
+    if isinstance(value, str):
+        if len(value) > max_len:
+            return f"{value[:max_len]}...<{len(value)} chars>"
+        return value
+    if depth >= 3:
+        return f"<{type(value).__name__}>"
+    if isinstance(value, dict):
+        return {k: ('<redacted>' if k in REDACT_KEYS else truncate(v, max_len, depth + 1))
+                for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [truncate(v, max_len, depth + 1) for v in value[:20]]
+        if len(value) > 20:
+            items.append(f"...<{len(value)} items>")
+        return items
+    return value
+
+
+class RedactingFilter(logging.Filter):
+    """Cắt/ẩn field trước khi record vào hàng đợi để không giữ payload lớn trong bộ nhớ."""
+
+    def __init__(self, max_len=256):
+        super().__init__()
+        self.max_len = max_len
+
+    def filter(self, record):
+        f = getattr(record, 'fields', None)
+        if f:
+            record.fields = truncate(f, self.max_len)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lấy mẫu cho sự kiện tần suất cao: record có sample_rate=r chỉ được giữ 1 trên
+    round(1/r) lần cho mỗi (logger, message). Không dùng random để kết quả ổn định.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        if rate is None or rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        every = max(1, round(1 / rate))
+        key = (record.name, record.msg)
+        with self._lock:
+            n = self._counters.get(key, 0)
+            self._counters[key] = n + 1
+        if n % every:
+            return False
+        record.sampled = every
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler không format trên thread gọi; việc format do listener làm."""
+
+    def prepare(self, record):
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(name)s] %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        f = getattr(record, 'fields', None)
+        if f:
+            line += ' ' + ' '.join(f"{k}={v!r}" if isinstance(v, str) else f"{k}={v}" for k, v in f.items())
+        if getattr(record, 'sampled', None):
+            line += f" (sampled 1/{record.sampled})"
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        f = getattr(record, 'fields', None)
+        if f:
+            entry.update(f)
+        if getattr(record, 'sampled', None):
+            entry['sampled'] = record.sampled
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def parse_levels(spec):
+    """'db=WARNING,server=DEBUG' -> {'db': 'WARNING', 'server': 'DEBUG'}"""
+    levels = {}
+    for part in (spec or '').split(','):
+        name, sep, level = part.partition('=')
+        if sep and name.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level=None, levels=None, fmt=None, stream=None, max_field=None):
+    """Cấu hình logger 'chat' (idempotent). Trả về QueueListener đang chạy."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return _listener
+
+        level = (level or os.environ.get('CHAT_LOG_LEVEL') or 'INFO').upper()
+        if levels is None:
+            levels = parse_levels(os.environ.get('CHAT_LOG_LEVELS'))
+        fmt = fmt or os.environ.get('CHAT_LOG_FORMAT', 'text')
+        max_field = max_field or int(os.environ.get('CHAT_LOG_MAX_FIELD', 256))
+
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(level)
+        root.propagate = False
+        for name, lvl in levels.items():
+            get_logger(name).setLevel(lvl)
+
+        q = queue.SimpleQueue()
+        handler = _DeferredQueueHandler(q)
+        # Filter chạy trên thread gọi: loại record bị lấy mẫu và cắt payload trước khi vào hàng đợi
+        handler.addFilter(SamplingFilter())
+        handler.addFilter(RedactingFilter(max_field))
+        root.addHandler(handler)
+
+        out = logging.StreamHandler(stream or sys.stderr)
+        out.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+        _listener = logging.handlers.QueueListener(q, out, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+        return _listener
+
+
+def shutdown_logging():
+    """Dừng thread ghi log và flush các record còn trong hàng đợi."""
+    global _listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        root = logging.getLogger(ROOT_LOGGER)
+        for h in list(root.handlers):
+            if isinstance(h, _DeferredQueueHandler):
+                root.removeHandler(h)
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,253 @@
+# Metrics dạng Prometheus (counter, gauge, histogram) với chi phí thấp trên hot path
+# và hàm render() xuất text exposition format cho endpoint /metrics.
+import bisect
+import threading
+
+# Biên của các bucket độ trễ (giây), giống bucket mặc định của Prometheus
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Bucket cho kích thước fan-out (số người nhận)
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """Histogram với bucket cố định; observe() chỉ tốn một bisect và vài phép cộng."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # bucket cuối là +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value, error=False):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+            if error:
+                self.errors += 1
+
+    def quantile(self, q):
+        """Ước lượng phân vị từ bucket (cận trên của bucket chứa phân vị)."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = []
+            total = 0
+            for c in self.counts:
+                total += c
+                cumulative.append(total)
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'errors': self.errors,
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], cumulative)),
+            }
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, fn):
+        """Giá trị được tính lúc scrape thay vì cập nhật trên hot path."""
+        self.function = fn
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Trả về child cho bộ label; nên giữ lại child để tránh tra dict trên hot path."""
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _label_str(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in sorted(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{self._label_str(key)} {_fmt(child.value)}"]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+    def set_function(self, fn):
+        self._children[()].set_function(fn)
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{self._label_str(key)} {_fmt(child.get())}"]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return LatencyHistogram(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def _render_child(self, key, child):
+        snap = child.snapshot()
+        lines = []
+        for le, count in snap['buckets'].items():
+            lines.append(f"{self.name}_bucket{self._label_str(key, ('le', le))} {count}")
+        lines.append(f"{self.name}_sum{self._label_str(key)} {_fmt(snap['sum'])}")
+        lines.append(f"{self.name}_count{self._label_str(key)} {snap['count']}")
+        return lines
+
+
+def _fmt(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# --- Metrics của server ---
+CONNECTED_SOCKETS = REGISTRY.gauge('chat_connected_sockets', 'Socket.IO connections currently open')
+LOGGED_IN_SESSIONS = REGISTRY.gauge('chat_logged_in_sessions', 'Connections with a logged-in user')
+MESSAGES_RECEIVED = REGISTRY.counter('chat_messages_received_total', 'Inbound messages by type', ('type',))
+HANDLER_LATENCY = REGISTRY.histogram('chat_handler_duration_seconds', 'Message handler latency by type', ('type',))
+DB_QUERY_LATENCY = REGISTRY.histogram('chat_db_query_duration_seconds', 'Database query latency by statement kind', ('op',))
+DB_QUERY_ERRORS = REGISTRY.counter('chat_db_query_errors_total', 'Failed database queries by statement kind', ('op',))
+FILE_BYTES = REGISTRY.counter('chat_file_transfer_bytes_total', 'Decoded file bytes received from clients')
+FILE_TRANSFERS = REGISTRY.counter('chat_file_transfers_total', 'File transfers by result', ('result',))
+ACTIVE_FILE_TRANSFERS = REGISTRY.gauge('chat_file_transfers_active', 'File transfers in progress')
+BROADCAST_FANOUT = REGISTRY.histogram('chat_broadcast_fanout', 'Recipients per broadcast/room emit', ('kind',),
+                                      buckets=FANOUT_BUCKETS)
+SYNC_REPLAYS = REGISTRY.counter('chat_sync_replays_total', 'Reconnect replays (LOGIN since_seq / SYNC) by source', ('source',))
+TYPING_EVENTS = REGISTRY.counter('chat_typing_events_total', 'Typing indicators by outcome (received vs forwarded/expired sent, rest dropped)', ('result',))
+TYPING_ACTIVE = REGISTRY.gauge('chat_typing_active', 'Typing states currently tracked by the coalescer')
+OUTBOUND_QUEUED_BYTES = REGISTRY.gauge('chat_outbound_queued_bytes', 'Encoded bytes held in per-connection outbound queues')
+OUTBOUND_QUEUED_MESSAGES = REGISTRY.gauge('chat_outbound_queued_messages', 'Packets held in per-connection outbound queues')
+OUTBOUND_BACKLOGGED = REGISTRY.gauge('chat_outbound_backlogged_connections', 'Connections whose transport is full and have a queue')
+OUTBOUND_MAX_SESSION_BYTES = REGISTRY.gauge('chat_outbound_max_connection_bytes', 'Largest single outbound queue in bytes')
+OUTBOUND_DROPPED = REGISTRY.counter('chat_outbound_dropped_total', 'Queued packets dropped or replaced by a newer one, by priority', ('priority',))
+OUTBOUND_EVICTIONS = REGISTRY.counter('chat_outbound_evictions_total', 'Slow consumers disconnected for staying over the queue cap')
@@ -0,0 +1,383 @@
+# Chuyển toàn bộ dữ liệu từ SQLite sang Postgres bằng COPY FROM STDIN.
+#
+#   python -m src.server.migrate_pg data/chat.db postgresql://user@host/chat --jobs 4
+#
+# Các bước: tạo schema trên Postgres (Database.create_tables), bỏ các index phụ, COPY song
+# song mỗi bảng (bảng có cột id được chia theo khoảng id) từ các process riêng, tạo lại
+# index, chỉnh sequence của cột SERIAL, rồi so số dòng và checksum từng bảng ở hai phía.
+# SQLite được mở read-only. Postgres phải trống, hoặc dùng --truncate để xoá dữ liệu cũ
+# (kể cả khi chạy lại sau một lần bị dừng giữa chừng).
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+# Add project root to path
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+logger = logging.getLogger('chat.migrate')
+
+# Bảng cần chuyển (theo thứ tự tạo) và các bảng có id SERIAL cần chỉnh sequence
+TABLES = ('users', 'messages', 'messages_archive', 'groups', 'group_members', 'friend_edges',
+          'pending_deliveries', 'conversations')
+SERIAL_TABLES = ('messages', 'groups')
+BATCH = 5000
+# Số id mỗi phần khi chia bảng lớn cho nhiều process
+CHUNK_ROWS = 1_000_000
+# Kích thước mỗi lần copy_expert đọc/ghi
+COPY_BUFFER = 1 << 20
+_MASK = (1 << 64) - 1
+# Escape của định dạng text trong COPY (Postgres cũng xuất đúng các escape này khi COPY TO)
+_ESCAPE = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r',
+                         '\b': '\\b', '\f': '\\f', '\v': '\\v'})
+_SPECIAL = re.compile(r'[\\\t\n\r\b\f\v]')
+
+
+class MigrationError(Exception):
+    pass
+
+
+def copy_line(row):
+    """Một dòng định dạng text của COPY: tab giữa các cột, \\N là NULL."""
+    texts = [None if v is None else str(v) for v in row]
+    # Phần lớn dòng không có ký tự cần escape: kiểm tra cả dòng một lần thay vì translate từng cột
+    if _SPECIAL.search(''.join(t for t in texts if t is not None)):
+        texts = [None if t is None else t.translate(_ESCAPE) for t in texts]
+    return '\t'.join('\\N' if t is None else t for t in texts) + '\n'
+
+
+def line_hash(line):
+    return int.from_bytes(hashlib.blake2b(line.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class CopySource:
+    """
+    File-like cho copy_expert(... FROM STDIN): lấy dần từng lô dòng từ cursor SQLite,
+    mã hoá sang định dạng COPY, đồng thời đếm dòng và cộng checksum (không phụ thuộc thứ tự).
+    """
+
+    def __init__(self, cursor, batch_size=BATCH):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.rows = 0
+        self.checksum = 0
+        self._buf = b''
+        self._pos = 0
+
+    def _fill(self):
+        batch = self.cursor.fetchmany(self.batch_size)
+        if not batch:
+            return False
+        lines = [copy_line(row) for row in batch]
+        for line in lines:
+            self.checksum = (self.checksum + line_hash(line)) & _MASK
+        self.rows += len(batch)
+        self._buf = self._buf[self._pos:] + ''.join(lines).encode('utf-8')
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(self._buf) - self._pos
+        while len(self._buf) - self._pos < size and self._fill():
+            pass
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+class HashSink:
+    """File-like cho copy_expert(... TO STDOUT): đếm dòng và checksum giống CopySource."""
+
+    def __init__(self):
+        self.rows = 0
+        self.checksum = 0
+        self._tail = b''
+
+    def write(self, data):
+        data = self._tail + (data.encode('utf-8') if isinstance(data, str) else bytes(data))
+        *lines, self._tail = data.split(b'\n')
+        for line in lines:
+            self.checksum = (self.checksum + line_hash(line.decode('utf-8') + '\n')) & _MASK
+        self.rows += len(lines)
+        return len(data)
+
+
+def open_source(path):
+    if not os.path.exists(path):
+        raise MigrationError(f"SQLite database {path} không tồn tại")
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def copy_chunk(source, target, table, columns, id_range=None, batch_size=BATCH):
+    """
+    COPY một bảng (hoặc các dòng có id trong [lo, hi)) từ connection SQLite source sang
+    connection Postgres target, commit; trả về (số dòng, checksum).
+    """
+    cols = ', '.join(columns)
+    sql, params = f"SELECT {cols} FROM {table}", ()
+    if id_range is not None:
+        sql += " WHERE id >= ? AND id < ?"
+        params = tuple(id_range)
+    stream = CopySource(source.execute(sql, params), batch_size)
+    cursor = target.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table} ({cols}) FROM STDIN", stream, size=COPY_BUFFER)
+    finally:
+        cursor.close()
+    target.commit()
+    return stream.rows, stream.checksum
+
+
+def target_checksum(target, table, columns):
+    """(số dòng, checksum) của bảng Postgres, đọc bằng COPY ... TO STDOUT."""
+    sink = HashSink()
+    cursor = target.cursor()
+    try:
+        cursor.copy_expert(f"COPY (SELECT {', '.join(columns)} FROM {table}) TO STDOUT", sink, size=COPY_BUFFER)
+    finally:
+        cursor.close()
+    target.rollback()
+    return sink.rows, sink.checksum
+
+
+# --- Task chạy trong process con (tham số picklable, mỗi task tự mở kết nối) ---
+
+def _copy_task(sqlite_path, pg_url, table, columns, id_range, batch_size):
+    start = time.monotonic()
+    source = open_source(sqlite_path)
+    target = psycopg2.connect(pg_url)
+    try:
+        rows, checksum = copy_chunk(source, target, table, columns, id_range, batch_size)
+    finally:
+        source.close()
+        target.close()
+    return table, rows, checksum, time.monotonic() - start
+
+
+def _verify_task(pg_url, table, columns):
+    target = psycopg2.connect(pg_url)
+    try:
+        return (table,) + target_checksum(target, table, columns)
+    finally:
+        target.close()
+
+
+class _InlineExecutor:
+    """Chạy task ngay trong process hiện tại (jobs <= 1)."""
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _starmap(executor, fn, tasks):
+    return executor.map(fn, *zip(*tasks)) if tasks else []
+
+
+class Migration:
+    def __init__(self, sqlite_path, pg_url, jobs=4, chunk_rows=CHUNK_ROWS, batch_size=BATCH, truncate=False):
+        self.sqlite_path = sqlite_path
+        self.pg_url = pg_url
+        self.jobs = jobs
+        self.chunk_rows = chunk_rows
+        self.batch_size = batch_size
+        self.truncate = truncate
+
+    def run(self):
+        """
+        Chạy toàn bộ migration; trả về report {table: {'rows', 'checksum', 'seconds',
+        'target_rows', 'ok'}} với ok = số dòng và checksum hai phía khớp nhau.
+        """
+        if psycopg2 is None:
+            raise MigrationError("psycopg2 is required for PostgreSQL connection")
+        source = open_source(self.sqlite_path)
+        target_db = self._open_target_db()
+        try:
+            cursor = target_db.get_cursor()
+            columns = self._plan_columns(source, target_db, cursor)
+            self._prepare_target(cursor, columns)
+            tasks = self._copy_tasks(source, columns)
+            self._ensure_partitions(source, target_db, columns)
+            indexes = self._drop_indexes(cursor, columns)
+            report = {t: {'rows': 0, 'checksum': 0, 'seconds': 0.0} for t in columns}
+            try:
+                with self._executor() as executor:
+                    for table, rows, checksum, seconds in _starmap(executor, _copy_task, tasks):
+                        entry = report[table]
+                        entry['rows'] += rows
+                        entry['checksum'] = (entry['checksum'] + checksum) & _MASK
+                        entry['seconds'] += seconds
+                        logger.info("copied chunk", extra={'fields': {'table': table, 'rows': rows}})
+            finally:
+                self._create_indexes(cursor, indexes)
+            self._finish_target(target_db, cursor, source, columns)
+            self._verify(columns, report)
+        finally:
+            source.close()
+            target_db.close()
+        return report
+
+    def _executor(self):
+        return ProcessPoolExecutor(self.jobs) if self.jobs > 1 else _InlineExecutor()
+
+    def _open_target_db(self):
+        """Database trỏ vào Postgres đích (tạo bảng/index như server)."""
+        from src.server.db import Database
+        old = os.environ.get('DATABASE_URL')
+        os.environ['DATABASE_URL'] = self.pg_url
+        try:
+            return Database()
+        finally:
+            if old is None:
+                os.environ.pop('DATABASE_URL', None)
+            else:
+                os.environ['DATABASE_URL'] = old
+
+    def _plan_columns(self, source, target_db, cursor):
+        """Các cột chung của từng bảng ở hai phía (bảng không có trong SQLite bị bỏ qua)."""
+        plan = {}
+        for table in TABLES:
+            src_cols = [r[1] for r in source.execute(f"PRAGMA table_info({table})")]
+            if not src_cols:
+                logger.warning("table missing in SQLite, skipped", extra={'fields': {'table': table}})
+                continue
+            dst_cols = target_db._columns(cursor, table)
+            plan[table] = [c for c in src_cols if c in dst_cols]
+        return plan
+
+    def _prepare_target(self, cursor, columns):
+        tables = list(columns)
+        if self.truncate:
+            cursor.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY")
+            cursor.connection.commit()
+            return
+        for table in tables:
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table}) AS used")
+            if cursor.fetchone()['used']:
+                cursor.connection.rollback()
+                raise MigrationError(f"bảng {table} trên Postgres đã có dữ liệu (dùng --truncate để xoá)")
+        cursor.connection.rollback()
+
+    def _copy_tasks(self, source, columns):
+        """Chia việc: bảng có cột id thành các khoảng chunk_rows id, bảng khác là một task."""
+        tasks = []
+        for table, cols in columns.items():
+            ranges = [None]
+            if 'id' in cols:
+                lo, hi = source.execute(f"SELECT MIN(id), MAX(id) FROM {table}").fetchone()
+                if lo is None:
+                    continue
+                ranges = [(start, start + self.chunk_rows) for start in range(lo, hi + 1, self.chunk_rows)]
+            for id_range in ranges:
+                tasks.append((self.sqlite_path, self.pg_url, table, cols, id_range, self.batch_size))
+        return tasks
+
+    def _ensure_partitions(self, source, target_db, columns):
+        """messages trên Postgres là bảng partition: tạo trước partition cho mọi tháng có dữ liệu."""
+        if not target_db.messages_partitioned or 'messages' not in columns:
+            return
+        lo, hi = source.execute("SELECT MIN(timestamp), MAX(timestamp) FROM messages").fetchone()
+        if lo is not None:
+            target_db.ensure_partitions(datetime.fromisoformat(lo), datetime.fromisoformat(hi))
+
+    def _drop_indexes(self, cursor, columns):
+        """Bỏ các index phụ (không phải PK/unique constraint) trước khi COPY; trả về định nghĩa để tạo lại."""
+        cursor.execute('''
+            SELECT i.indexname, i.indexdef FROM pg_indexes i
+            WHERE i.schemaname = current_schema() AND i.tablename = ANY(%s)
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname)
+        ''', (list(columns),))
+        indexes = [(r['indexname'], r['indexdef']) for r in cursor.fetchall()]
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX "{name}"')
+        cursor.connection.commit()
+        return indexes
+
+    def _create_indexes(self, cursor, indexes):
+        cursor.connection.rollback()
+        for name, definition in indexes:
+            start = time.monotonic()
+            # Index của bảng partition được in là "ON ONLY": tạo lại cho cả các partition con
+            cursor.execute(definition.replace(' ON ONLY ', ' ON ', 1))
+            cursor.connection.commit()
+            logger.info("index rebuilt", extra={'fields': {'index': name, 'seconds': round(time.monotonic() - start, 2)}})
+
+    def _finish_target(self, target_db, cursor, source, columns):
+        """Chỉnh sequence theo id lớn nhất, tính các cột SQLite cũ không có, rồi ANALYZE."""
+        for table in SERIAL_TABLES:
+            if table in columns:
+                cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                               f"COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {table}")
+        cursor.connection.commit()
+        if 'groups' in columns and 'name_lower' not in columns['groups']:
+            target_db._backfill_groups(cursor)
+        if 'last_message_id' not in columns.get('conversations', ()):
+            target_db.rebuild_conversations()
+        for table in columns:
+            cursor.execute(f"ANALYZE {table}")
+        cursor.connection.commit()
+
+    def _verify(self, columns, report):
+        tasks = [(self.pg_url, table, cols) for table, cols in columns.items()]
+        with self._executor() as executor:
+            for table, rows, checksum in _starmap(executor, _verify_task, tasks):
+                entry = report[table]
+                entry['target_rows'] = rows
+                entry['ok'] = rows == entry['rows'] and checksum == entry['checksum']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copy the chat database from SQLite to Postgres")
+    parser.add_argument('sqlite_path')
+    parser.add_argument('pg_url', nargs='?', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--jobs', type=int, default=min(4, os.cpu_count() or 1),
+                        help="number of parallel COPY processes")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help="ids per COPY task for large tables")
+    parser.add_argument('--batch-size', type=int, default=BATCH, help="rows fetched from SQLite at a time")
+    parser.add_argument('--truncate', action='store_true', help="empty the Postgres tables first")
+    args = parser.parse_args(argv)
+    if not args.pg_url:
+        parser.error("pg_url (or DATABASE_URL) is required")
+
+    from src.server.log import setup_logging
+    setup_logging()
+    start = time.monotonic()
+    migration = Migration(args.sqlite_path, args.pg_url, args.jobs, args.chunk_rows, args.batch_size, args.truncate)
+    try:
+        report = migration.run()
+    except MigrationError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    for table, entry in report.items():
+        status = 'ok' if entry['ok'] else f"MISMATCH (postgres has {entry['target_rows']} rows)"
+        print(f"{table:<15} {entry['rows']:>12} rows  {entry['seconds']:>8.1f}s  {entry['checksum']:016x}  {status}")
+    if not all(entry['ok'] for entry in report.values()):
+        print("❌ row count / checksum mismatch", file=sys.stderr)
+        return 1
+    print(f"✅ done in {time.monotonic() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
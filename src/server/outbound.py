@@ -0,0 +1,311 @@
+# Hàng đợi gửi đi theo từng kết nối, có backpressure.
+#
+# Mặc định Socket.IO đẩy mọi packet thẳng vào hàng đợi của socket Engine.IO, không giới hạn:
+# client mạng chậm (điện thoại mất sóng, long-polling bị treo...) làm server giữ mãi các packet
+# chưa gửi được. OutboundQueues chen vào Server._send_packet (điểm mọi emit tới từng client,
+# kể cả emit tới room/broadcast và từ node khác, đều đi qua):
+# - transport còn ít hơn TRANSPORT_HIGH_WATER packet chờ thì gửi thẳng như cũ;
+# - ngược lại packet vào hàng đợi riêng của kết nối, xếp theo độ ưu tiên chat > presence > typing
+#   và được một task nền đẩy dần khi transport rảnh;
+# - presence/typing mới thay thế bản cũ cùng loại đang chờ (USERS_LIST mới thay cái cũ, STOP_TYPING
+#   thay TYPING...); vượt giới hạn byte/số tin thì bỏ typing rồi presence cũ nhất, chat không bị bỏ;
+# - kết nối vẫn vượt giới hạn quá OUTBOUND_EVICT_AFTER giây (hoặc gấp đôi giới hạn byte) bị
+#   ngắt: client kết nối lại và lấy tin bị lỡ qua SYNC.
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import socketio
+from socketio import packet
+
+from src.common import protocol
+
+logger = logging.getLogger('chat.outbound')
+
+OUTBOUND_MAX_BYTES = int(os.environ.get('CHAT_OUTBOUND_MAX_BYTES', 1024 * 1024))
+OUTBOUND_MAX_MESSAGES = int(os.environ.get('CHAT_OUTBOUND_MAX_MESSAGES', 1000))
+OUTBOUND_EVICT_AFTER = float(os.environ.get('CHAT_OUTBOUND_EVICT_AFTER', 10.0))
+# Số packet tối đa để sẵn trong hàng đợi Engine.IO trước khi giữ lại ở hàng đợi của mình
+TRANSPORT_HIGH_WATER = 16
+DRAIN_INTERVAL = 0.05
+
+CHAT, PRESENCE, TYPING = 0, 1, 2
+PRIORITY_NAMES = ('chat', 'presence', 'typing')
+
+_TYPING_TYPES = (protocol.MSG_TYPING, protocol.MSG_STOP_TYPING)
+
+
+def classify(pkt):
+    """(priority, coalesce key) của packet; key khác None: packet mới thay packet cũ cùng key."""
+    if pkt.packet_type != packet.EVENT or not pkt.data or pkt.data[0] != 'message':
+        return CHAT, None
+    message = pkt.data[1] if len(pkt.data) > 1 else None
+    if not isinstance(message, dict):
+        return CHAT, None
+    msg_type = message.get('type')
+    payload = message.get('payload')
+    if msg_type in _TYPING_TYPES and isinstance(payload, dict):
+        return TYPING, ('typing', payload.get('sender'), payload.get('mode'), payload.get('group_id'))
+    if msg_type == protocol.MSG_USERS_LIST:
+        return PRESENCE, (msg_type,)
+    if msg_type == protocol.MSG_USER_STATUS and isinstance(payload, dict):
+        return PRESENCE, (msg_type, payload.get('username'))
+    return CHAT, None
+
+
+def _size(encoded):
+    if isinstance(encoded, list):
+        return sum(len(ep) for ep in encoded)
+    return len(encoded)
+
+
+class OutboundQueue:
+    """Các packet đã encode đang chờ gửi tới một kết nối, tách theo độ ưu tiên."""
+
+    __slots__ = ('lanes', 'bytes', 'count', 'over_since', 'draining')
+
+    def __init__(self):
+        self.lanes = (deque(), deque(), deque())   # mỗi phần tử: [key, encoded, size]
+        self.bytes = 0
+        self.count = 0
+        self.over_since = None
+        self.draining = False
+
+    def push(self, priority, key, encoded, size):
+        """Thêm packet; trả về số packet cũ bị thay thế (0/1)."""
+        lane = self.lanes[priority]
+        if key is not None:
+            for entry in lane:
+                if entry[0] == key:
+                    self.bytes += size - entry[2]
+                    entry[1], entry[2] = encoded, size
+                    return 1
+        lane.append([key, encoded, size])
+        self.bytes += size
+        self.count += 1
+        return 0
+
+    def pop(self):
+        for lane in self.lanes:
+            if lane:
+                _, encoded, size = lane.popleft()
+                self.bytes -= size
+                self.count -= 1
+                return encoded
+        return None
+
+    def shed(self, max_bytes, max_messages):
+        """Bỏ typing rồi presence cũ nhất tới khi dưới giới hạn; trả về {priority: số bị bỏ}."""
+        dropped = {}
+        for priority in (TYPING, PRESENCE):
+            lane = self.lanes[priority]
+            while lane and (self.bytes > max_bytes or self.count > max_messages):
+                self.bytes -= lane.popleft()[2]
+                self.count -= 1
+                dropped[priority] = dropped.get(priority, 0) + 1
+        return dropped
+
+    def __len__(self):
+        return self.count
+
+
+class OutboundQueues:
+    """
+    Hàng đợi gửi đi của mọi kết nối trên process; install() gắn vào python-socketio Server.
+    Kết nối không bị nghẽn không có hàng đợi (đường gửi thẳng chỉ thêm một lần tra dict).
+    """
+
+    def __init__(self, server, max_bytes=OUTBOUND_MAX_BYTES, max_messages=OUTBOUND_MAX_MESSAGES,
+                 evict_after=OUTBOUND_EVICT_AFTER, high_water=TRANSPORT_HIGH_WATER, clock=time.monotonic,
+                 metrics=None):
+        self.server = server
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.evict_after = evict_after
+        self.high_water = high_water
+        self.clock = clock
+        self.queues = {}         # eio_sid -> OutboundQueue, chỉ các kết nối đang nghẽn
+        self._lock = threading.Lock()
+        self._dropped = None
+        self._evictions = None
+        if metrics is not None:
+            self._dropped = {p: metrics.OUTBOUND_DROPPED.labels(name) for p, name in enumerate(PRIORITY_NAMES)}
+            self._evictions = metrics.OUTBOUND_EVICTIONS
+            metrics.OUTBOUND_QUEUED_BYTES.set_function(lambda: self.stats()['bytes'])
+            metrics.OUTBOUND_QUEUED_MESSAGES.set_function(lambda: self.stats()['messages'])
+            metrics.OUTBOUND_BACKLOGGED.set_function(lambda: len(self.queues))
+            metrics.OUTBOUND_MAX_SESSION_BYTES.set_function(lambda: self.stats()['max_bytes'])
+
+    def install(self):
+        self._write = self.server._send_packet
+        self.server._send_packet = self.send_packet
+        return self
+
+    def _write_encoded(self, eio_sid, encoded):
+        if isinstance(encoded, list):
+            for ep in encoded:
+                self.server.eio.send(eio_sid, ep)
+        else:
+            self.server.eio.send(eio_sid, encoded)
+
+    def _transport_depth(self, eio_sid):
+        """Số packet đang chờ trong hàng đợi Engine.IO; None nếu socket đã đóng."""
+        socket = self.server.eio.sockets.get(eio_sid)
+        if socket is None or socket.closed:
+            return None
+        return socket.queue.qsize()
+
+    def send_packet(self, eio_sid, pkt):
+        if pkt.packet_type != packet.EVENT:
+            # CONNECT/DISCONNECT/ACK đi thẳng
+            return self._write(eio_sid, pkt)
+        self._send(eio_sid, pkt)
+
+    def _send(self, eio_sid, pkt, encoded=None, classified=None):
+        """Gửi packet (encoded: bản đã encode sẵn, dùng chung cho cả fan-out)."""
+        queue = self.queues.get(eio_sid)
+        if queue is None:
+            depth = self._transport_depth(eio_sid)
+            if depth is None or depth < self.high_water:
+                if encoded is None:
+                    return self._write(eio_sid, pkt)
+                return self._write_encoded(eio_sid, encoded)
+        priority, key = classified or classify(pkt)
+        if encoded is None:
+            encoded = pkt.encode()
+        evict = False
+        with self._lock:
+            queue = self.queues.get(eio_sid)
+            if queue is None:
+                queue = self.queues[eio_sid] = OutboundQueue()
+            coalesced = queue.push(priority, key, encoded, _size(encoded))
+            if coalesced:
+                self._count_dropped({priority: coalesced})
+            if queue.bytes > self.max_bytes or queue.count > self.max_messages:
+                self._count_dropped(queue.shed(self.max_bytes, self.max_messages))
+            evict = self._check_over(eio_sid, queue)
+            start = not queue.draining and not evict
+            if start:
+                queue.draining = True
+        if evict:
+            self.evict(eio_sid)
+        elif start:
+            self.server.start_background_task(self._drain_loop, eio_sid)
+
+    def fanout(self, data, sids=(), rooms=(), skip_sids=(), event='message', namespace='/'):
+        """
+        Gửi cùng một data tới nhiều sid/room: tạo và encode packet một lần rồi đưa bản đã
+        encode vào từng kết nối (vẫn qua hàng đợi ở trên). Trả về số kết nối trên process này
+        nhận được; sid ở node khác và room khi chạy nhiều process đi qua emit của Socket.IO.
+        """
+        server = self.server
+        manager = server.manager
+        skip = set(skip_sids)
+        targets = {}
+        clustered = isinstance(manager, socketio.PubSubManager)
+        if clustered:
+            for room in rooms:
+                server.emit(event, data, room=room, skip_sid=list(skip) or None, namespace=namespace)
+        else:
+            for room in rooms:
+                for sid, eio_sid in manager.get_participants(namespace, room):
+                    if sid not in skip:
+                        targets[eio_sid] = None
+        for sid in sids:
+            if sid in skip:
+                continue
+            eio_sid = manager.eio_sid_from_sid(sid, namespace) if manager.is_connected(sid, namespace) else None
+            if eio_sid is not None:
+                targets[eio_sid] = None
+            elif clustered:
+                server.emit(event, data, to=sid, namespace=namespace)
+        if not targets:
+            return 0
+        pkt = server.packet_class(packet.EVENT, namespace=namespace, data=[event, data])
+        if server._send_packet != self.send_packet:
+            # Có hook khác thay _send_packet (vd. test client của Flask-SocketIO): gửi qua hook đó
+            for eio_sid in targets:
+                server._send_packet(eio_sid, pkt)
+            return len(targets)
+        encoded = pkt.encode()
+        classified = classify(pkt)
+        for eio_sid in targets:
+            self._send(eio_sid, pkt, encoded, classified)
+        return len(targets)
+
+    def _check_over(self, eio_sid, queue):
+        """Cập nhật mốc vượt giới hạn; True nếu kết nối cần bị ngắt."""
+        if queue.bytes <= self.max_bytes and queue.count <= self.max_messages:
+            queue.over_since = None
+            return False
+        now = self.clock()
+        if queue.over_since is None:
+            queue.over_since = now
+        return queue.bytes > 2 * self.max_bytes or now - queue.over_since >= self.evict_after
+
+    def drain(self, eio_sid):
+        """
+        Đẩy packet sang transport tới khi đầy lại; trả về False khi không còn gì để làm
+        (hàng đợi rỗng, socket đã đóng hoặc kết nối bị ngắt).
+        """
+        while True:
+            depth = self._transport_depth(eio_sid)
+            with self._lock:
+                queue = self.queues.get(eio_sid)
+                if queue is None:
+                    return False
+                if depth is None:
+                    del self.queues[eio_sid]
+                    return False
+                if depth >= self.high_water:
+                    evict = self._check_over(eio_sid, queue)
+                    if not evict:
+                        return True
+                else:
+                    evict = False
+                    encoded = queue.pop()
+                    if encoded is None:
+                        del self.queues[eio_sid]
+                        return False
+            if evict:
+                self.evict(eio_sid)
+                return False
+            self._write_encoded(eio_sid, encoded)
+
+    def _drain_loop(self, eio_sid):
+        try:
+            while self.drain(eio_sid):
+                self.server.sleep(DRAIN_INTERVAL)
+        except Exception as e:
+            logger.warning("outbound drain failed", extra={'fields': {'sid': eio_sid, 'error': str(e)}})
+            self.discard(eio_sid)
+
+    def evict(self, eio_sid):
+        """Ngắt kết nối tiêu thụ quá chậm và bỏ hàng đợi của nó."""
+        queue = self.discard(eio_sid)
+        logger.warning("slow consumer evicted", extra={'fields': {
+            'sid': eio_sid, 'queued_bytes': queue.bytes if queue else 0,
+            'queued_messages': len(queue) if queue else 0}})
+        if self._evictions is not None:
+            self._evictions.inc()
+        # Ngắt ở task riêng: đang ở giữa một emit, handler disconnect sẽ emit tiếp
+        self.server.start_background_task(self.server.eio.disconnect, eio_sid)
+
+    def discard(self, eio_sid):
+        with self._lock:
+            return self.queues.pop(eio_sid, None)
+
+    def _count_dropped(self, dropped):
+        if self._dropped is None:
+            return
+        for priority, n in dropped.items():
+            self._dropped[priority].inc(n)
+
+    def stats(self):
+        with self._lock:
+            sizes = [q.bytes for q in self.queues.values()]
+            return {'sessions': len(sizes), 'bytes': sum(sizes),
+                    'messages': sum(len(q) for q in self.queues.values()),
+                    'max_bytes': max(sizes, default=0)}
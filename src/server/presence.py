@@ -0,0 +1,242 @@
+# Registry người dùng online: sid -> username và username -> các sid.
+#
+# LocalPresence: một process (mặc định).
+# ReplicatedPresence: mỗi node giữ bản sao presence của cả cluster, đồng bộ qua chính
+# message queue của Socket.IO (Redis/Kombu/chatbus...). Node gửi delta khi có user
+# đăng nhập/thoát và snapshot định kỳ làm heartbeat; node im lặng quá PRESENCE_EXPIRE
+# giây bị coi là đã chết và các session của nó bị bỏ.
+import json
+import logging
+import pickle
+import time
+
+logger = logging.getLogger('chat.presence')
+
+HEARTBEAT_INTERVAL = 5.0
+PRESENCE_EXPIRE = 3 * HEARTBEAT_INTERVAL
+
+
+class LocalPresence:
+    def __init__(self):
+        self.local = {}          # sid -> username, chỉ các socket trên process này
+        self._user_sids = {}     # username -> set(sid), trên toàn cluster
+
+    def add(self, sid, username):
+        self.local[sid] = username
+        self._index(sid, username)
+
+    def remove(self, sid):
+        username = self.local.pop(sid, None)
+        if username is not None:
+            self._unindex(sid, username)
+        return username
+
+    def username_of(self, sid):
+        return self.local.get(sid)
+
+    def sid_for(self, username):
+        """Một sid của user (ưu tiên socket trên process này), None nếu offline."""
+        sids = self._user_sids.get(username)
+        if not sids:
+            return None
+        for sid in sids:
+            if sid in self.local:
+                return sid
+        return next(iter(sids))
+
+    def sids_for(self, username):
+        return set(self._user_sids.get(username, ()))
+
+    def is_online(self, username):
+        return bool(self._user_sids.get(username))
+
+    def online_usernames(self):
+        return [u for u, sids in self._user_sids.items() if sids]
+
+    def _index(self, sid, username):
+        self._user_sids.setdefault(username, set()).add(sid)
+
+    def _unindex(self, sid, username):
+        sids = self._user_sids.get(username)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._user_sids[username]
+
+
+class ReplicatedPresence(LocalPresence):
+    """Presence dùng chung giữa các process, đồng bộ qua pub/sub."""
+
+    def __init__(self, node_id=None):
+        super().__init__()
+        self.node_id = node_id
+        self.publish = None      # callable(dict), gắn bởi PresenceMixin
+        self._remote = {}        # node_id -> {sid: username}
+        self._seen = {}          # node_id -> thời điểm nhận tin cuối
+
+    # --- Thay đổi cục bộ ---
+
+    def add(self, sid, username):
+        super().add(sid, username)
+        self._send({'op': 'add', 'sid': sid, 'user': username})
+
+    def remove(self, sid):
+        username = super().remove(sid)
+        if username is not None:
+            self._send({'op': 'remove', 'sid': sid})
+        return username
+
+    def _send(self, message):
+        if self.publish is None:
+            return
+        message.update(method='presence', node=self.node_id)
+        try:
+            self.publish(message)
+        except Exception as e:
+            logger.warning("presence publish failed", extra={'fields': {'error': str(e)}})
+
+    def heartbeat(self):
+        self._send({'op': 'snapshot', 'sessions': dict(self.local)})
+        self.expire()
+
+    def hello(self):
+        """Node mới khởi động: xin snapshot của các node khác."""
+        self._send({'op': 'hello'})
+
+    # --- Tin từ node khác ---
+
+    def apply(self, message):
+        node = message.get('node')
+        if not node or node == self.node_id:
+            return
+        op = message.get('op')
+        if op == 'hello':
+            self.heartbeat()
+            return
+        self._seen[node] = time.monotonic()
+        sessions = self._remote.setdefault(node, {})
+        if op == 'add':
+            sid, user = message['sid'], message['user']
+            sessions[sid] = user
+            self._index(sid, user)
+        elif op == 'remove':
+            user = sessions.pop(message['sid'], None)
+            if user is not None:
+                self._unindex(message['sid'], user)
+        elif op == 'snapshot':
+            self._replace_node(node, message.get('sessions') or {})
+        elif op == 'bye':
+            self._replace_node(node, {})
+            self._remote.pop(node, None)
+            self._seen.pop(node, None)
+
+    def _replace_node(self, node, sessions):
+        old = self._remote.get(node, {})
+        for sid, user in old.items():
+            if sessions.get(sid) != user:
+                self._unindex(sid, user)
+        for sid, user in sessions.items():
+            self._index(sid, user)
+        self._remote[node] = dict(sessions)
+
+    def expire(self, now=None):
+        """Bỏ session của các node không gửi heartbeat trong PRESENCE_EXPIRE giây."""
+        now = time.monotonic() if now is None else now
+        for node, seen in list(self._seen.items()):
+            if now - seen > PRESENCE_EXPIRE:
+                logger.warning("presence node expired", extra={'fields': {'node': node}})
+                self._replace_node(node, {})
+                self._remote.pop(node, None)
+                self._seen.pop(node, None)
+
+    def nodes(self):
+        return [self.node_id] + list(self._remote)
+
+    def shutdown(self):
+        self._send({'op': 'bye'})
+
+
+def _decode(message):
+    if isinstance(message, dict):
+        return message
+    if isinstance(message, bytes):
+        try:
+            return pickle.loads(message)
+        except Exception:
+            pass
+    try:
+        return json.loads(message)
+    except Exception:
+        return None
+
+
+class PresenceMixin:
+    """
+    Mixin cho các PubSubManager của python-socketio: tách tin 'presence' ra khỏi luồng
+    nhận để cập nhật ReplicatedPresence, các tin khác đi tiếp như bình thường.
+
+    handlers: method -> callable(message) cho các tin đồng bộ khác (vd. invalidate cache),
+    gửi bằng publish_custom(); tin do chính process này gửi không được xử lý lại.
+    """
+    presence = None
+
+    def publish_custom(self, method, message):
+        message = dict(message, method=method, node=self.host_id)
+        self._publish(message)
+
+    def initialize(self):
+        super().initialize()
+        if self.presence is None:
+            return
+        self.presence.node_id = self.host_id
+        self.presence.publish = self._publish
+        if not self.write_only:
+            self.server.start_background_task(self._presence_heartbeat)
+
+    def _presence_heartbeat(self):
+        self.presence.hello()
+        while True:
+            self.presence.heartbeat()
+            self.server.sleep(HEARTBEAT_INTERVAL)
+
+    def _listen(self):
+        for message in super()._listen():
+            data = _decode(message)
+            if isinstance(data, dict):
+                method = data.get('method')
+                if method == 'presence':
+                    if self.presence is not None:
+                        self.presence.apply(data)
+                    continue
+                handler = self.handlers.get(method)
+                if handler is not None:
+                    if data.get('node') != self.host_id:
+                        try:
+                            handler(data)
+                        except Exception as e:
+                            logger.warning("sync handler failed", extra={'fields': {'method': method, 'error': str(e)}})
+                    continue
+            yield data if data is not None else message
+
+
+def make_client_manager(url, presence=None, channel='socketio'):
+    """
+    Tạo client manager Socket.IO theo URL của message queue, kèm đồng bộ presence:
+    redis(s):// -> RedisManager, kafka:// -> KafkaManager, zmq+tcp:// -> ZmqManager,
+    chatbus[+unix]:// -> BusManager, còn lại -> KombuManager (amqp://, ...).
+    """
+    import socketio
+    from src.server.bus import BusManager, is_bus_url
+
+    if is_bus_url(url):
+        base = BusManager
+    elif url.startswith(('redis://', 'rediss://')):
+        base = socketio.RedisManager
+    elif url.startswith('kafka://'):
+        base = socketio.KafkaManager
+    elif url.startswith('zmq'):
+        base = socketio.ZmqManager
+    else:
+        base = socketio.KombuManager
+    cls = type(f"Presence{base.__name__}", (PresenceMixin, base), {'presence': presence, 'handlers': {}})
+    return cls(url, channel=channel)
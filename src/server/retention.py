@@ -0,0 +1,150 @@
+# Retention: chuyển tin nhắn quá hạn ra khỏi bảng messages để bảng "nóng" không lớn mãi.
+#
+#   python -m src.server.retention                       # một lượt theo CHAT_RETENTION_*_DAYS
+#   python -m src.server.retention --public-days 30 --group-days 365 --loop 3600
+#   python -m src.server.retention --archive-dir /backups/chat   # ra file .ndjson.gz thay vì bảng
+#
+# Mỗi loại tin (public / private / group) có hạn riêng, tính theo ngày; không đặt = giữ mãi.
+# Tin quá hạn được chuyển theo lô (mỗi lô một transaction ngắn) sang bảng messages_archive,
+# hoặc ra file NDJSON (định dạng của export_messages, nhập lại bằng export_import.py).
+# Postgres với messages dạng partition: các tháng đã quá hạn với mọi loại được chuyển nguyên
+# partition sang messages_archive (chỉ đổi metadata) trước khi chuyển từng lô phần còn lại.
+#
+# Chỉ chạy ở một process (cron hoặc --loop), không chạy trong từng worker của server.
+import argparse
+import logging
+import os
+import sys
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+
+# Add project root to path
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from src.server.db import Database, open_history, write_records
+
+logger = logging.getLogger('chat.retention')
+
+MESSAGE_TYPES = ('public', 'private', 'group')
+
+
+class RetentionPolicy:
+    """Số ngày giữ tin của từng loại; None = giữ mãi."""
+
+    def __init__(self, days=None):
+        days = days or {}
+        self.days = {t: days.get(t) or None for t in MESSAGE_TYPES}
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        days = {}
+        for t in MESSAGE_TYPES:
+            value = environ.get(f'CHAT_RETENTION_{t.upper()}_DAYS')
+            days[t] = float(value) if value else None
+        return cls(days)
+
+    def cutoffs(self, now=None):
+        """{message_type: mốc thời gian (UTC)} — tin cũ hơn mốc là quá hạn."""
+        now = now or datetime.utcnow()
+        return {t: now - timedelta(days=d) for t, d in self.days.items() if d}
+
+    def __bool__(self):
+        return any(self.days.values())
+
+
+class FileSink:
+    """Ghi các lô tin vào file NDJSON (mỗi loại một file mỗi lượt), fsync trước khi trả về."""
+
+    def __init__(self, directory, stack, stamp):
+        self.directory = directory
+        self.stack = stack
+        self.stamp = stamp
+        self.files = {}
+
+    def for_type(self, message_type):
+        def write(rows):
+            out = self.files.get(message_type)
+            if out is None:
+                path = os.path.join(self.directory, f"messages-{message_type}-{self.stamp}.ndjson.gz")
+                out = self.files[message_type] = self.stack.enter_context(open_history(path, 'w'))
+            write_records(out, rows)
+            # Tin chỉ bị xoá khỏi database sau khi đã nằm chắc trên đĩa
+            out.flush()
+            os.fsync(out.fileno())
+        return write
+
+
+class Archiver:
+    def __init__(self, db, policy, archive_dir=None, batch_size=None, pause=0.0):
+        self.db = db
+        self.policy = policy
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        # Nghỉ giữa các lô để không chiếm database của server
+        self.pause = pause
+
+    def run_once(self, now=None):
+        """Một lượt archive; trả về {message_type: số tin đã chuyển, 'partitions': [...]}."""
+        now = now or datetime.utcnow()
+        cutoffs = self.policy.cutoffs(now)
+        result = {t: 0 for t in cutoffs}
+        if self.db.messages_partitioned:
+            self.db.ensure_partitions(now, now + timedelta(days=31 * self.db.PARTITION_MONTHS_AHEAD))
+            if self.archive_dir is None and len(cutoffs) == len(MESSAGE_TYPES):
+                result['partitions'] = self.db.archive_partitions(min(cutoffs.values()))
+
+        with ExitStack() as stack:
+            files = FileSink(self.archive_dir, stack, now.strftime('%Y%m%d-%H%M%S')) if self.archive_dir else None
+            for message_type, cutoff in cutoffs.items():
+                sink = files.for_type(message_type) if files else None
+                while True:
+                    n = self.db.archive_messages(message_type, cutoff, self.batch_size, sink)
+                    result[message_type] += n
+                    if n < (self.batch_size or self.db.ARCHIVE_BATCH):
+                        break
+                    if self.pause:
+                        time.sleep(self.pause)
+                if result[message_type]:
+                    logger.info("messages archived", extra={'fields': {
+                        'type': message_type, 'count': result[message_type], 'before': str(cutoff)}})
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move expired chat messages out of the messages table")
+    env = RetentionPolicy.from_env()
+    for t in MESSAGE_TYPES:
+        parser.add_argument(f'--{t}-days', type=float, default=env.days[t],
+                            help=f"keep {t} messages this many days (env CHAT_RETENTION_{t.upper()}_DAYS)")
+    parser.add_argument('--archive-dir', help="write expired messages to .ndjson.gz files here instead of messages_archive")
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--pause', type=float, default=0.0, help="seconds to sleep between batches")
+    parser.add_argument('--loop', type=float, default=None, help="run again every N seconds")
+    args = parser.parse_args(argv)
+
+    policy = RetentionPolicy({t: getattr(args, f'{t}_days') for t in MESSAGE_TYPES})
+    if not policy:
+        print("Không có chính sách retention nào (đặt --public-days/--private-days/--group-days)", file=sys.stderr)
+        return 1
+    if args.archive_dir:
+        os.makedirs(args.archive_dir, exist_ok=True)
+
+    from src.server.log import setup_logging
+    setup_logging()
+    with Database() as db:
+        archiver = Archiver(db, policy, args.archive_dir, args.batch_size, args.pause)
+        while True:
+            result = archiver.run_once()
+            print(f"{datetime.utcnow():%Y-%m-%d %H:%M:%S} archived {result}")
+            if args.loop is None:
+                break
+            time.sleep(args.loop)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,30 +1,108 @@
 
 # Flask-SocketIO server with Database integration
-from flask import Flask, request
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask import Flask, Response, request, jsonify
+from flask_socketio import SocketIO, emit
 import os
 import sys
 import json
 import base64
+import logging
+import re
+from datetime import datetime
 
 # Add project root to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
-from src.server.db import Database
+from src.server.db import Database, group_cursor, group_key, search_cursor
+from src.server.delivery import RecentMessages
+from src.server.dispatcher import Dispatcher
+from src.server import metrics
+from src.server.outbound import OutboundQueues
+from src.server.presence import LocalPresence, ReplicatedPresence, make_client_manager
+from src.server.typing_state import TypingCoalescer, FORWARDED, EXPIRED
+from src.server.log import setup_logging, get_logger, fields
 from src.common import protocol
 
+setup_logging()
+logger = get_logger('server')
+file_logger = get_logger('server.file')
+
+# Message queue cho chạy nhiều process/node (redis://, amqp://, chatbus+unix://...).
+# Không đặt = một process, presence chỉ trong bộ nhớ.
+MESSAGE_QUEUE = os.environ.get('CHAT_MESSAGE_QUEUE')
+
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+if MESSAGE_QUEUE:
+    presence = ReplicatedPresence()
+    socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet',
+                        client_manager=make_client_manager(MESSAGE_QUEUE, presence))
+else:
+    presence = LocalPresence()
+    socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+# Hàng đợi gửi đi theo kết nối: giới hạn byte/số tin, ưu tiên chat > presence > typing
+outbound = OutboundQueues(socketio.server, metrics=metrics).install()
 db = Database()
+# Các tin riêng/nhóm gần nhất để replay cho client kết nối lại (SYNC)
+message_log = RecentMessages()
+# Trạng thái "đang nhập" theo (người gửi, target): debounce, tự hết hạn, giới hạn mode public
+typing_state = TypingCoalescer()
+if MESSAGE_QUEUE:
+    # Đồng bộ cache bạn bè / membership nhóm giữa các process
+    _manager = socketio.server.manager
+    _manager.handlers['friend_cache'] = db.friend_cache.apply
+    db.friend_cache.publish = lambda message: _manager.publish_custom('friend_cache', message)
+    _manager.handlers['group_cache'] = db.group_cache.apply
+    db.group_cache.publish = lambda message: _manager.publish_custom('group_cache', message)
+    _manager.handlers['delivery'] = message_log.apply
+    message_log.publish = lambda message: _manager.publish_custom('delivery', message)
 
-# Dictionary to map sid -> username
-clients = {}
+# Dictionary to map sid -> username (chỉ các socket trên process này; toàn cluster xem `presence`)
+clients = presence.local
 # Track file transfers: sid -> {filename, filesize, receiver, file_obj}
 file_transfers = {}
-# Files directory
-FILES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../data/received_files'))
+# Số tin nhắn tối đa cho mỗi trang lịch sử
+HISTORY_PAGE_SIZE = 50
+# Số nhóm mỗi trang GROUPS_DISCOVER (mặc định / tối đa client được xin)
+DISCOVER_PAGE_SIZE = 20
+DISCOVER_MAX_PAGE_SIZE = 100
+# Số kết quả tối đa mỗi trang SEARCH
+SEARCH_PAGE_SIZE = 20
+# Số tin tối đa mỗi frame SYNC_RESULT
+SYNC_PAGE_SIZE = 500
+# Số cuộc trò chuyện mỗi trang CONVERSATIONS
+CONVERSATIONS_PAGE_SIZE = 50
+# Files directory (khi chạy nhiều node, CHAT_FILES_DIR phải là thư mục dùng chung)
+FILES_DIR = os.path.abspath(os.environ.get('CHAT_FILES_DIR') or
+                            os.path.join(os.path.dirname(__file__), '../../../data/received_files'))
 os.makedirs(FILES_DIR, exist_ok=True)
 
+# Metrics: các gauge tính lúc scrape, độ trễ DB đo qua hook của Database
+metrics.LOGGED_IN_SESSIONS.set_function(lambda: len(clients))
+metrics.ACTIVE_FILE_TRANSFERS.set_function(lambda: len(file_transfers))
+metrics.TYPING_ACTIVE.set_function(lambda: len(typing_state))
+
+def _observe_query(op, seconds, error):
+    metrics.DB_QUERY_LATENCY.labels(op).observe(seconds)
+    if error:
+        metrics.DB_QUERY_ERRORS.labels(op).inc()
+
+Database.query_observer = staticmethod(_observe_query)
+_fanout = {}
+
+def observe_fanout(kind, room=None, count=None):
+    """
+    Ghi số người nhận của một lần emit tới room (None = broadcast toàn namespace);
+    count: số socket khi gửi riêng tới từng sid.
+    """
+    child = _fanout.get(kind)
+    if child is None:
+        child = _fanout[kind] = metrics.BROADCAST_FANOUT.labels(kind)
+    child.observe(room_size(room) if count is None else count)
+
+def room_size(room=None):
+    rooms = socketio.server.manager.rooms.get('/', {})
+    return len(rooms.get(room, ()))
+
 @app.route("/")
 def index():
     return "Nhom11 Chat Server is running!"
@@ -41,553 +119,797 @@ def download_file():
     from flask import send_from_directory
     return send_from_directory(FILES_DIR, safe_name, as_attachment=True)
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Metrics dạng text của Prometheus."""
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+@app.route("/stats/handlers")
+def handler_stats():
+    """Độ trễ xử lý theo từng loại message (histogram của dispatcher)."""
+    return jsonify(dispatcher.snapshot())
+
+@app.route("/stats/queries")
+def query_stats():
+    """Thống kê query theo câu SQL đã chuẩn hoá. ?sort=total_ms|mean_ms|max_ms|calls|rows&limit=N&format=text"""
+    if db.query_stats is None:
+        return jsonify({'enabled': False, 'queries': []})
+    sort = request.args.get('sort', 'total_ms')
+    limit = request.args.get('limit', type=int)
+    if request.args.get('format') == 'text':
+        return Response(db.dump_query_stats(sort, limit or 20) + '\n', mimetype='text/plain')
+    return jsonify({
+        'enabled': True,
+        'since': db.query_stats.started_at,
+        'slow_ms': db.SLOW_QUERY_MS,
+        'queries': db.query_stats.snapshot(sort, limit),
+    })
+
+@app.route("/stats/queries/reset", methods=['POST'])
+def reset_query_stats():
+    if db.query_stats is not None:
+        db.query_stats.reset()
+    return jsonify({'ok': True})
+
 @socketio.on('connect')
 def handle_connect():
-    print(f"[SERVER] Client connected: {request.sid}", flush=True)
+    metrics.CONNECTED_SOCKETS.inc()
+    logger.debug("client connected", extra=fields(sid=request.sid))
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    metrics.CONNECTED_SOCKETS.dec()
     sid = request.sid
     if sid in clients:
         username = clients[sid]
-        print(f"User {username} disconnected")
-        del clients[sid]
+        logger.info("user disconnected", extra=fields(user=username, sid=sid))
+        presence.remove(sid)
         if sid in file_transfers:
-            try:
-                file_transfers[sid]['file'].close()
-            except:
-                pass
-            del file_transfers[sid]
+            abort_file_transfer(sid)
+        if not presence.is_online(username):
+            stop_user_typing(username)
         
         # Update last seen
         db.update_last_seen(username)
         
         # Notify friends that user is offline
-        friends = db.get_friends_with_status(username)
-        for friend in friends:
-            f_name = friend['username']
-            f_sid = get_sid_by_username(f_name)
-            if f_sid:
-                 emit('message', {
-                    'type': protocol.MSG_USER_STATUS,
-                    'payload': {'username': username, 'status': 'offline', 'last_seen': 'Just now'}
-                }, room=f_sid)
+        fanout({
+            'type': protocol.MSG_USER_STATUS,
+            'payload': {'username': username, 'status': 'offline', 'last_seen': 'Just now'}
+        }, sids=sids_of(db.get_friend_names(username)), kind='friend_status')
 
         emit('message', {
             'type': protocol.MSG_TEXT,
             'payload': f"Server: {username} has left the chat."
         }, broadcast=True)
+        observe_fanout('presence')
         broadcast_users_list()
 
 @socketio.on('message')
 def handle_message(data):
-    sid = request.sid
-    print(f"[SERVER] Nhận message từ client: {data}", flush=True)
-    msg_type = data.get('type')
-    payload = data.get('payload')
-
-    if msg_type == 'GROUPS_REQUEST':
-        # Lấy username từ clients mapping
-        username = clients.get(sid)
-        if username:
-            # Trả về các nhóm user đã tham gia (tab Trò chuyện)
-            groups = db.get_user_groups(username)
-        else:
-            groups = db.get_all_groups()  # fallback nếu chưa đăng nhập
-        # Convert datetime fields to string
-        for g in groups:
-            for k, v in g.items():
-                if hasattr(v, 'isoformat'):
-                    g[k] = v.isoformat()
-        emit('message', {'type': protocol.MSG_GROUPS_LIST, 'payload': groups}, room=sid)
+    if logger.isEnabledFor(logging.DEBUG) and isinstance(data, dict):
+        logger.debug("message received", extra=fields(sid=request.sid, type=data.get('type'), payload=data.get('payload')))
+    msg_type = data.get('type') if isinstance(data, dict) else None
+    (_message_counters.get(msg_type) or _message_counters[None]).inc()
+    dispatcher.dispatch(request.sid, data)
+
+def _reply_unauthorized(ctx):
+    emit('message', {'type': 'ERROR', 'payload': 'Chưa đăng nhập hoặc phiên đăng nhập hết hạn'})
+
+def _reply_invalid(ctx):
+    emit('message', {'type': 'ERROR', 'payload': 'Invalid message format'})
+
+# Bảng handler: type -> handler(ctx), kèm middleware auth/validate/timing
+dispatcher = Dispatcher(get_username=clients.get, on_unauthorized=_reply_unauthorized, on_invalid=_reply_invalid,
+                        histograms=metrics.HANDLER_LATENCY)
+
+@dispatcher.route('GROUPS_REQUEST', auth=False)
+def on_groups_request(ctx):
+    username = ctx.username
+    # Chỉ các nhóm user đã tham gia (tab Trò chuyện); nhóm khác xem qua GROUPS_DISCOVER
+    groups = db.get_user_groups(username) if username else []
+    emit('message', {'type': protocol.MSG_GROUPS_LIST, 'payload': serialize_groups(groups)}, room=ctx.sid)
+
+@dispatcher.route(protocol.MSG_GROUPS_DISCOVER, payload=(dict, type(None)))
+def on_groups_discover(ctx):
+    """
+    Tìm nhóm chưa tham gia theo tên, từng trang (keyset). payload: query, match
+    ('prefix' | 'substring'), limit, cursor = next_cursor của trang trước.
+    """
+    payload = ctx.payload or {}
+    query = str(payload.get('query') or '').strip()
+    match = 'substring' if payload.get('match') == 'substring' else 'prefix'
+    cursor = payload.get('cursor')
+    try:
+        limit = min(max(int(payload.get('limit') or DISCOVER_PAGE_SIZE), 1), DISCOVER_MAX_PAGE_SIZE)
+        after = None if cursor is None else (str(cursor[0]), int(cursor[1]))
+    except (TypeError, ValueError, IndexError, KeyError):
+        emit('message', {'type': 'ERROR', 'payload': 'Invalid message format'})
         return
+    groups = db.get_discoverable_groups(ctx.username, query=query or None, limit=limit + 1,
+                                        after=after, match=match)
+    has_more = len(groups) > limit
+    groups = groups[:limit]
+    emit('message', {'type': protocol.MSG_GROUPS_DISCOVER_RESULT, 'payload': {
+        'query': query,
+        'cursor': cursor,
+        'groups': serialize_groups(groups),
+        'next_cursor': group_cursor(groups[-1]) if has_more else None,
+    }}, room=ctx.sid)
+
+@dispatcher.route(protocol.MSG_GROUP_MEMBERS, auth=False, payload=dict)
+def on_group_members(ctx):
+    group_id = ctx.payload.get('group_id')
+    if group_id:
+        try:
+            # Ensure group_id is int for DB
+            group_id_int = int(group_id)
+            members = db.get_group_members(group_id_int)
+            # Fetch display names and status for each member
+            detailed_members = []
+            for m_username in members:
+                d_name = db.get_user_display_name(m_username)
+                status = 'online' if get_sid_by_username(m_username) else 'offline'
+                # Maybe get last login too if offline
+                detailed_members.append({
+                    'username': m_username,
+                    'display_name': d_name,
+                    'status': status
+                })
+            emit('message', {'type': protocol.MSG_GROUP_MEMBERS_RESPONSE, 'payload': {'group_id': str(group_id), 'members': detailed_members}}, room=ctx.sid)
+        except ValueError:
+            pass # Invalid ID format
+
+@dispatcher.route(protocol.MSG_REGISTER, auth=False, payload=dict)
+def on_register(ctx):
+    username = ctx.payload.get('username')
+    password = ctx.payload.get('password', 'default')
+    if db.user_exists(username):
+        emit('message', {'type': 'ERROR', 'payload': 'Tên đăng nhập đã tồn tại'})
+    elif db.register_user(username, password):
+        emit('message', {'type': 'LOGIN_SUCCESS', 'payload': f'Đăng ký thành công! Chào mừng {username}!'})
+    else:
+        emit('message', {'type': 'ERROR', 'payload': 'Đăng ký thất bại. Vui lòng thử lại.'})
 
-    if msg_type == protocol.MSG_GROUP_MEMBERS:
-        group_id = payload.get('group_id')
-        if group_id:
-            try:
-                # Ensure group_id is int for DB
-                group_id_int = int(group_id)
-                members = db.get_group_members(group_id_int)
-                # Fetch display names and status for each member
-                detailed_members = []
-                for m_username in members:
-                    d_name = db.get_user_display_name(m_username)
-                    status = 'online' if get_sid_by_username(m_username) else 'offline'
-                    # Maybe get last login too if offline
-                    detailed_members.append({
-                        'username': m_username,
-                        'display_name': d_name,
-                        'status': status
-                    })
-                emit('message', {'type': protocol.MSG_GROUP_MEMBERS_RESPONSE, 'payload': {'group_id': str(group_id), 'members': detailed_members}}, room=sid)
-            except ValueError:
-                pass # Invalid ID format
+@dispatcher.route(protocol.MSG_LOGIN, auth=False, payload=dict)
+def on_login(ctx):
+    sid = ctx.sid
+    username = ctx.payload.get('username')
+    password = ctx.payload.get('password', 'default')
+    if not db.login_user(username, password):
+        emit('message', {'type': 'ERROR', 'payload': 'Invalid username or password'})
         return
 
-    if msg_type == protocol.MSG_REGISTER:
-        username = payload.get('username')
-        password = payload.get('password', 'default')
-        if db.user_exists(username):
-            emit('message', {'type': 'ERROR', 'payload': 'Tên đăng nhập đã tồn tại'})
-        elif db.register_user(username, password):
-            emit('message', {'type': 'LOGIN_SUCCESS', 'payload': f'Đăng ký thành công! Chào mừng {username}!'})
-        else:
-            emit('message', {'type': 'ERROR', 'payload': 'Đăng ký thất bại. Vui lòng thử lại.'})
+    presence.add(sid, username)
+    emit('message', {'type': 'LOGIN_SUCCESS', 'payload': f'Welcome {username}!'})
+
+    since_seq = parse_seq(ctx.payload.get('since_seq'))
+    if ctx.payload.get('bootstrap') is True:
+        # Client mới: bạn bè, nhóm, cuộc trò chuyện, số chưa đọc gộp trong một frame BOOTSTRAP
+        send_bootstrap(sid, username)
+        send_offline_messages(sid, username, since_seq, with_unread=False)
+    else:
+        # Tin nhận lúc offline (hoặc sau since_seq khi kết nối lại) + số chưa đọc theo từng cuộc trò chuyện
+        send_offline_messages(sid, username, since_seq)
+
+        # Send Friend List
+        send_friend_list([sid], username)
+
+        # Restore group memberships
+        group_ids = sorted(db.get_user_group_ids(username))
+        join_rooms(sid, [f"group_{gid}" for gid in group_ids])
+        emit('message', {'type': 'USER_GROUPS', 'payload': group_ids})
+
+    # Notify friends I am online
+    fanout({
+        'type': protocol.MSG_USER_STATUS,
+        'payload': {'username': username, 'status': 'online'}
+    }, sids=sids_of(db.get_friend_names(username)), kind='friend_status')
+
+    # Broadcast join message
+    emit('message', {
+        'type': protocol.MSG_TEXT,
+        'payload': f"Server: {username} has joined the chat."
+    }, broadcast=True, include_self=False)
+    observe_fanout('presence')
+
+    broadcast_users_list()
+
+# Đã loại bỏ hoàn toàn luồng chat công khai MSG_TEXT
+
+@dispatcher.route(protocol.MSG_PRIVATE, payload=dict)
+def on_private(ctx):
+    username = ctx.username
+    receiver = ctx.payload.get('receiver')
+    content = ctx.payload.get('content')
+
+    # Check friendship
+    if not db.are_friends(username, receiver):
+        emit('message', {'type': 'ERROR', 'payload': f"You are not friends with {receiver}. Add them to chat."})
         return
 
-    # Lấy username cho các nhánh cần xác thực (sau LOGIN/REGISTER)
-    if msg_type not in [protocol.MSG_LOGIN, protocol.MSG_REGISTER]:
-        username = clients.get(sid)
-        if not username:
-            emit('message', {'type': 'ERROR', 'payload': 'Chưa đăng nhập hoặc phiên đăng nhập hết hạn'})
-            return
+    # Mọi phiên của người nhận, và các phiên khác của người gửi (để thấy tin mình vừa gửi)
+    receiver_sids = sids_of([receiver])
+    seq = store_message(username, content, receiver=receiver, message_type='private',
+                        deliver_later=not receiver_sids)
+    fanout({
+        'type': protocol.MSG_PRIVATE,
+        'payload': {'sender': username, 'receiver': receiver, 'content': content, 'seq': seq}
+    }, sids=receiver_sids | sids_of([username]), skip_sids=[ctx.sid], kind='private')
+    send_sent(seq)
+    if not receiver_sids:
+        # Giao khi người nhận đăng nhập lại (OFFLINE_MESSAGES)
+        logger.info("private message queued for offline user", extra=fields(sender=username, receiver=receiver))
+
+@dispatcher.route(protocol.MSG_GROUP, payload=dict)
+def on_group(ctx):
+    username = ctx.username
+    group_id = ctx.payload.get('group_id')
+    content = ctx.payload.get('content')
+    if not db.is_group_member(group_id, username):
+        emit('message', {'type': 'ERROR', 'payload': f"You are not a member of group {group_id}."})
+        return
+    seq = store_message(username, content, receiver=group_id, message_type='group')
+
+    fanout({
+        'type': protocol.MSG_GROUP,
+        'payload': {'sender': username, 'group_id': group_id, 'content': content, 'seq': seq}
+    }, rooms=[f"group_{group_id}"], skip_sids=[ctx.sid], kind='group')
+    send_sent(seq)
 
-    if msg_type == protocol.MSG_LOGIN:
-        username = payload.get('username')
-        password = payload.get('password', 'default')
-        if db.login_user(username, password):
-            clients[sid] = username
-            emit('message', {'type': 'LOGIN_SUCCESS', 'payload': f'Welcome {username}!'})
-            
-            # Send history
-            send_history(sid, username)
-            
-            # Send Friend List
-            send_friend_list(sid, username)
-            
-            # Notify friends I am online
-            friends = db.get_friends_with_status(username)
-            for friend in friends:
-                f_name = friend['username']
-                f_sid = get_sid_by_username(f_name)
-                if f_sid:
-                     emit('message', {
-                        'type': protocol.MSG_USER_STATUS,
-                        'payload': {'username': username, 'status': 'online'}
-                    }, room=f_sid)
-
-            # Restore group memberships
-            user_groups = db.get_user_groups(username)
-            group_ids = []
-            for g in user_groups:
-                gid = g['id']
-                join_room(f"group_{gid}")
-                group_ids.append(gid)
-            emit('message', {'type': 'USER_GROUPS', 'payload': group_ids})
-            
-            # Broadcast join message
+def send_sent(seq):
+    """
+    Báo seq của tin vừa gửi cho đúng phiên gửi (phiên này tự hiện tin, không nhận lại bản fan-out):
+    client ghi nhận seq để bỏ tin đó khi replay sau kết nối lại.
+    """
+    emit('message', {'type': protocol.MSG_SENT, 'payload': {'seq': seq}})
+
+FILE_MESSAGE_RE = re.compile(r"📎 File: (.+) \((.+)\)")
+FILE_SIZE_RE = re.compile(r"([\d\.]+)\s*(KB|MB|B)")
+FILE_SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 * 1024}
+
+def parse_file_message(content):
+    """Tách (filename, filesize) từ nội dung '📎 File: name (size)'; None nếu không phải tin file."""
+    if not isinstance(content, str) or "📎 File:" not in content:
+        return None
+    filename, filesize = '', 0
+    m = FILE_MESSAGE_RE.match(content)
+    if m:
+        filename = m.group(1)
+        size_match = FILE_SIZE_RE.match(m.group(2))
+        if size_match:
+            filesize = int(float(size_match.group(1)) * FILE_SIZE_UNITS[size_match.group(2)])
+    return filename, filesize
+
+def emit_history_row(row, history_type, target, my_name=None):
+    content = row['content']
+    file_info = parse_file_message(content)
+    if history_type == 'private':
+        if file_info:
+            filename, filesize = file_info
+            # Xác định lại receiver cho đúng chiều
+            receiver = row['receiver']
+            if not receiver and my_name:
+                if row['sender'] == my_name:
+                    receiver = target
+                else:
+                    receiver = my_name
+            elif not receiver:
+                receiver = target
             emit('message', {
-                'type': protocol.MSG_TEXT,
-                'payload': f"Server: {username} has joined the chat."
-            }, broadcast=True, include_self=False)
-            
-            broadcast_users_list()
-            broadcast_groups_list()
+                'type': protocol.MSG_FILE,
+                'payload': {
+                    'id': row['id'],
+                    'sender': row['sender'],
+                    'receiver': receiver,
+                    'filename': filename,
+                    'filesize': filesize,
+                    'message': content,
+                    'timestamp': row['timestamp']
+                }
+            })
         else:
-            emit('message', {'type': 'ERROR', 'payload': 'Invalid username or password'})
+            emit('message', {
+                'type': protocol.MSG_PRIVATE,
+                'payload': {
+                    'id': row['id'],
+                    'sender': row['sender'],
+                    'receiver': row['receiver'],
+                    'content': row['content'],
+                    'timestamp': row['timestamp']
+                }
+            })
+    else:
+        if file_info:
+            filename, filesize = file_info
+            emit('message', {
+                'type': protocol.MSG_FILE,
+                'payload': {
+                    'id': row['id'],
+                    'sender': row['sender'],
+                    'group_id': target,
+                    'filename': filename,
+                    'filesize': filesize,
+                    'message': content,
+                    'timestamp': row['timestamp']
+                }
+            })
+        else:
+            emit('message', {
+                'type': protocol.MSG_GROUP,
+                'payload': {
+                    'id': row['id'],
+                    'sender': row['sender'],
+                    'group_id': target,
+                    'content': row['content'],
+                    'timestamp': row['timestamp']
+                }
+            })
 
+@dispatcher.route(protocol.MSG_HISTORY_REQUEST, payload=dict)
+def on_history_request(ctx):
+    payload = ctx.payload
+    history_type = payload.get('history_type')
+    target = payload.get('target')
+    # Phân trang: client gửi before_id (id tin cũ nhất đang có) để lấy trang trước
+    before_id = payload.get('before_id')
+    try:
+        before_id = None if before_id is None else int(before_id)
+    except (TypeError, ValueError):
+        emit('message', {'type': 'ERROR', 'payload': 'Invalid message format'})
+        return
+    try:
+        limit = max(1, min(int(payload.get('limit') or HISTORY_PAGE_SIZE), HISTORY_PAGE_SIZE))
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    history = []
+    if history_type == 'private' and target:
+        history = db.get_history(limit, message_type='private', username=target, before_id=before_id)
+    elif history_type == 'group' and target:
+        history = db.get_history(limit, message_type='group', group_id=target, before_id=before_id)
+    for row in history: # Send in chronological order
+        emit_history_row(row, history_type, target, payload.get('myName'))
+    if history and before_id is None:
+        # Mở cuộc trò chuyện = đã đọc
+        db.mark_read(ctx.username, history_type, target)
+    # Đánh dấu kết thúc trang để client biết đã nhận đủ và id để lấy trang tiếp theo
+    emit('message', {
+        'type': protocol.MSG_HISTORY_END,
+        'payload': {
+            'history_type': history_type,
+            'target': target,
+            'count': len(history),
+            'next_before_id': history[0]['id'] if len(history) >= limit else None
+        }
+    })
+
+@dispatcher.route(protocol.MSG_MARK_READ, payload=dict)
+def on_mark_read(ctx):
+    """Client đang xem cuộc trò chuyện (type 'private' | 'group', target) nên đặt lại số chưa đọc."""
+    kind = ctx.payload.get('type')
+    target = ctx.payload.get('target')
+    if kind not in ('private', 'group') or target in (None, ''):
+        emit('message', {'type': 'ERROR', 'payload': 'Invalid message format'})
+        return
+    db.mark_read(ctx.username, kind, target)
+
+@dispatcher.route(protocol.MSG_CONVERSATIONS, payload=(dict, type(None)))
+def on_conversations(ctx):
+    """Danh sách cuộc trò chuyện (tin cuối + số chưa đọc) cho sidebar, mới nhất trước."""
+    payload = ctx.payload or {}
+    try:
+        limit = max(1, min(int(payload.get('limit') or CONVERSATIONS_PAGE_SIZE), CONVERSATIONS_PAGE_SIZE))
+        cursor = payload.get('cursor')
+        cursor = None if cursor is None else int(cursor)
+    except (TypeError, ValueError):
+        emit('message', {'type': 'ERROR', 'payload': 'Invalid message format'})
+        return
+    conversations, next_cursor = db.get_conversations(ctx.username, limit, cursor)
+    emit('message', {'type': protocol.MSG_CONVERSATIONS_RESULT, 'payload': {
+        'conversations': conversations,
+        'next_cursor': next_cursor,
+    }})
 
+@dispatcher.route(protocol.MSG_SYNC, payload=dict)
+def on_sync(ctx):
+    """Replay các tin user được nhận có seq > since_seq (sau khi mất kết nối)."""
+    since = parse_seq(ctx.payload.get('since_seq'))
+    if since is None:
+        emit('message', {'type': 'ERROR', 'payload': 'Invalid message format'})
+        return
+    try:
+        limit = max(1, min(int(ctx.payload.get('limit') or SYNC_PAGE_SIZE), SYNC_PAGE_SIZE))
+    except (TypeError, ValueError):
+        limit = SYNC_PAGE_SIZE
+    messages, more, source = replay_messages(ctx.username, since, limit)
+    emit('message', {'type': protocol.MSG_SYNC_RESULT, 'payload': {
+        'messages': messages,
+        'seq': messages[-1]['id'] if messages else since,
+        'more': more,
+        'source': source,
+    }})
 
-    # Đã loại bỏ hoàn toàn luồng chat công khai MSG_TEXT
+@dispatcher.route(protocol.MSG_ACK, payload=dict)
+def on_ack(ctx):
+    """Client đã xử lý mọi tin tới seq: xoá chúng khỏi hàng chờ giao offline."""
+    seq = parse_seq(ctx.payload.get('seq'))
+    if seq is None:
+        emit('message', {'type': 'ERROR', 'payload': 'Invalid message format'})
+        return
+    db.ack_pending(ctx.username, seq)
+
+@dispatcher.route(protocol.MSG_SEARCH, payload=dict)
+def on_search(ctx):
+    """Tìm trong lịch sử tin nhắn user được xem; scope như Database.search_messages."""
+    payload = ctx.payload
+    query = str(payload.get('query') or '')
+    scope = str(payload.get('scope') or 'all')
+    try:
+        limit = max(1, min(int(payload.get('limit') or SEARCH_PAGE_SIZE), SEARCH_PAGE_SIZE))
+        cursor = payload.get('cursor')
+        cursor = None if cursor is None else search_cursor(cursor)
+    except (TypeError, ValueError):
+        emit('message', {'type': 'ERROR', 'payload': 'Invalid message format'})
+        return
+    results, next_cursor = db.search_messages(ctx.username, query, scope=scope, cursor=cursor, limit=limit)
+    emit('message', {'type': protocol.MSG_SEARCH_RESULT, 'payload': {
+        'query': query,
+        'scope': scope,
+        'cursor': cursor,
+        'results': results,
+        'next_cursor': next_cursor,
+    }}, room=ctx.sid)
 
-    elif msg_type == protocol.MSG_PRIVATE:
-        receiver = payload.get('receiver')
-        content = payload.get('content')
+@dispatcher.route(protocol.MSG_GROUP_CREATE, payload=(dict, str))
+def on_group_create(ctx):
+    sid = ctx.sid
+    username = ctx.username
+    payload = ctx.payload
+    group_name = ""
+    members_to_add = []
 
-        # Check friendship
-        if not db.are_friends(username, receiver):
-            emit('message', {'type': 'ERROR', 'payload': f"You are not friends with {receiver}. Add them to chat."})
+    if isinstance(payload, dict):
+        group_name = payload.get('name')
+        members_to_add = payload.get('members', [])
+    else:
+        group_name = payload
+    
+    # Validation for multi-member creation
+    if isinstance(payload, dict): 
+        all_members = set(members_to_add)
+        all_members.add(username) # Ensure creator is counted
+        if len(all_members) < 3:
+            emit('message', {'type': 'ERROR', 'payload': "Nhóm phải có ít nhất 3 thành viên."})
             return
 
-        db.save_message(username, content, receiver=receiver, message_type='private')
+    group_id = db.create_group(group_name, username)
+    if not group_id:
+        emit('message', {'type': 'ERROR', 'payload': "Failed to create group"})
+        return
 
-        target_sid = get_sid_by_username(receiver)
-        if target_sid:
-            emit('message', {
-                'type': protocol.MSG_PRIVATE,
-                'payload': {'sender': username, 'content': content}
-            }, room=target_sid)
-        else:
-            print(f"[SERVER][LOG] User '{receiver}' is offline. Sender: '{username}', content: '{content}'", flush=True)
-            emit('message', {'type': 'ERROR', 'payload': f"User {receiver} is offline."})
+    db.add_member_to_group(group_id, username)
 
-    elif msg_type == protocol.MSG_GROUP:
-        group_id = payload.get('group_id')
-        content = payload.get('content')
-        db.save_message(username, content, receiver=group_id, message_type='group')
-        
-        emit('message', {
-            'type': protocol.MSG_GROUP,
-            'payload': {'sender': username, 'group_id': group_id, 'content': content}
-        }, room=f"group_{group_id}", include_self=False)
-
-    elif msg_type == 'HISTORY_REQUEST':
-        history_type = payload.get('history_type')
-        target = payload.get('target')
-        if history_type == 'private' and target:
-            myName = payload.get('myName')
-            history = db.get_history(50, message_type='private', username=target)
-            print(f"DEBUG: Sending private history ({len(history)} items). First: {history[0]['timestamp'] if history else 'None'}, Last: {history[-1]['timestamp'] if history else 'None'}")
-            for row in history: # Send in chronological order
-                content = row['content']
-                import re
-                if isinstance(content, str) and re.search(r"📎 File:", content, re.DOTALL):
-                    import re
-                    m = re.match(r"📎 File: (.+) \((.+)\)", content)
-                    filename, filesize_str = '', ''
-                    filesize = 0
-                    if m:
-                        filename = m.group(1)
-                        filesize_str = m.group(2)
-                        import re as _re
-                        size_match = _re.match(r"([\d\.]+)\s*(KB|MB|B)", filesize_str)
-                        if size_match:
-                            size_val = float(size_match.group(1))
-                            size_unit = size_match.group(2)
-                            if size_unit == 'KB':
-                                filesize = int(size_val * 1024)
-                            elif size_unit == 'MB':
-                                filesize = int(size_val * 1024 * 1024)
-                            elif size_unit == 'B':
-                                filesize = int(size_val)
-                    # Xác định lại receiver cho đúng chiều
-                    receiver = row['receiver']
-                    if not receiver and myName:
-                        if row['sender'] == myName:
-                            receiver = target
-                        else:
-                            receiver = myName
-                    elif not receiver:
-                        receiver = target
-                    emit('message', {
-                        'type': protocol.MSG_FILE,
-                        'payload': {
-                            'sender': row['sender'],
-                            'receiver': receiver,
-                            'filename': filename,
-                            'filesize': filesize,
-                            'message': content,
-                            'timestamp': row['timestamp']
-                        }
-                    })
-                else:
-                    emit('message', {
-                        'type': protocol.MSG_PRIVATE,
-                        'payload': {
-                            'sender': row['sender'],
-                            'receiver': row['receiver'],
-                            'content': row['content'],
-                            'timestamp': row['timestamp']
-                        }
-                    })
-        elif history_type == 'group' and target:
-            history = db.get_history(50, message_type='group', group_id=target)
-            for row in history:
-                content = row['content']
-                import re
-                if isinstance(content, str) and re.search(r"📎 File:", content, re.DOTALL):
-                    import re
-                    m = re.match(r"📎 File: (.+) \((.+)\)", content)
-                    filename, filesize_str = '', ''
-                    filesize = 0
-                    if m:
-                        filename = m.group(1)
-                        filesize_str = m.group(2)
-                        import re as _re
-                        size_match = _re.match(r"([\d\.]+)\s*(KB|MB|B)", filesize_str)
-                        if size_match:
-                            size_val = float(size_match.group(1))
-                            size_unit = size_match.group(2)
-                            if size_unit == 'KB':
-                                filesize = int(size_val * 1024)
-                            elif size_unit == 'MB':
-                                filesize = int(size_val * 1024 * 1024)
-                            elif size_unit == 'B':
-                                filesize = int(size_val)
-                    emit('message', {
-                        'type': protocol.MSG_FILE,
-                        'payload': {
-                            'sender': row['sender'],
-                            'group_id': target,
-                            'filename': filename,
-                            'filesize': filesize,
-                            'message': content,
-                            'timestamp': row['timestamp']
-                        }
-                    })
-                else:
-                    emit('message', {
-                        'type': protocol.MSG_GROUP,
-                        'payload': {
-                            'sender': row['sender'],
-                            'group_id': target,
-                            'content': row['content'],
-                            'timestamp': row['timestamp']
-                        }
-                    })
-
-    elif msg_type == protocol.MSG_GROUP_CREATE:
-        group_name = ""
-        members_to_add = []
-
-        if isinstance(payload, dict):
-            group_name = payload.get('name')
-            members_to_add = payload.get('members', [])
-        else:
-            group_name = payload
-        
-        # Validation for multi-member creation
-        if isinstance(payload, dict): 
-            all_members = set(members_to_add)
-            all_members.add(username) # Ensure creator is counted
-            if len(all_members) < 3:
-                emit('message', {'type': 'ERROR', 'payload': "Nhóm phải có ít nhất 3 thành viên."})
-                return
-
-        group_id = db.create_group(group_name, username)
-        if group_id:
-            db.add_member_to_group(group_id, username)
-            join_room(f"group_{group_id}")
-
-            # Add other members
-            for m in members_to_add:
-                if m != username:
-                    if db.add_member_to_group(group_id, m):
-                        m_sid = get_sid_by_username(m)
-                        if m_sid:
-                            join_room(f"group_{group_id}", sid=m_sid)
-                            emit('message', {'type': 'SUCCESS', 'payload': f"Bạn đã được thêm vào nhóm '{group_name}'"}, room=m_sid)
-                            # Update their group list mapping
-                            user_groups = db.get_user_groups(m)
-                            u_gids = [ug['id'] for ug in user_groups]
-                            emit('message', {'type': 'USER_GROUPS', 'payload': u_gids}, room=m_sid)
-
-            # Update creator's group mapping
-            user_groups = db.get_user_groups(username)
-            u_gids = [ug['id'] for ug in user_groups]
-            emit('message', {'type': 'USER_GROUPS', 'payload': u_gids})
-
-            # Gửi lại danh sách nhóm đầy đủ cho người tạo nhóm (để cập nhật tab Trò chuyện)
-            all_groups = db.get_all_groups()
-            # Convert datetime fields to string
-            for g in all_groups:
-                for k, v in g.items():
-                    if hasattr(v, 'isoformat'):
-                        g[k] = v.isoformat()
-            emit('message', {'type': protocol.MSG_GROUPS_LIST, 'payload': all_groups}, room=sid)
-
-            emit('message', {'type': 'SUCCESS', 'payload': f"Group '{group_name}' created"})
-            broadcast_groups_list()
-        else:
-            emit('message', {'type': 'ERROR', 'payload': "Failed to create group"})
+    # Add other members; thông báo và GROUP_ADDED giống nhau cho mọi người nên chỉ encode một lần
+    # (GROUP_ADDED cũng cập nhật myGroups ở client, thay cho USER_GROUPS riêng từng người)
+    added = [m for m in members_to_add if m != username and db.add_member_to_group(group_id, m)]
+    added_sids = sids_of(added)
+    # Mọi phiên của người tạo và thành viên mới vào room, kể cả phiên trên node khác
+    group_room(added_sids | sids_of([username]), group_id)
+    fanout({'type': 'SUCCESS', 'payload': f"Bạn đã được thêm vào nhóm '{group_name}'"}, sids=added_sids)
+    notify_group_added(added, group_id)
 
-    elif msg_type == protocol.MSG_GROUP_JOIN:
-        group_id = payload
-        if db.add_member_to_group(group_id, username):
-            join_room(f"group_{group_id}")
-            emit('message', {'type': 'SUCCESS', 'payload': f"Joined group {group_id}"})
-        else:
-            emit('message', {'type': 'ERROR', 'payload': "Failed to join group"})
-
-    elif msg_type == protocol.MSG_GROUP_LEAVE:
-        group_id = payload
-        if db.remove_member_from_group(group_id, username):
-            leave_room(f"group_{group_id}")
-            emit('message', {'type': 'SUCCESS', 'payload': f"Left group {group_id}"})
-            # Gửi lại danh sách nhóm đã tham gia
-            user_groups = db.get_user_groups(username)
-            u_gids = [ug['id'] for ug in user_groups]
-            emit('message', {'type': 'USER_GROUPS', 'payload': u_gids})
-            # Gửi lại danh sách nhóm khám phá (chưa tham gia)
-            discoverable = db.get_discoverable_groups(username)
-            for g in discoverable:
-                for k, v in g.items():
-                    if hasattr(v, 'isoformat'):
-                        g[k] = v.isoformat()
-            emit('message', {'type': protocol.MSG_GROUPS_LIST, 'payload': discoverable}, room=sid)
-        else:
-            emit('message', {'type': 'ERROR', 'payload': "Failed to leave group"})
-
-    elif msg_type == 'GROUP_DELETE':
-        group_id = payload.get('group_id')
-        print(f"[SERVER] Nhận yêu cầu xóa nhóm: group_id={group_id}, username={username}", flush=True)
-        # Only allow creator to delete
-        if db.delete_group(group_id, username):
-            print(f"[SERVER] Đã xóa nhóm thành công: group_id={group_id}", flush=True)
-            emit('message', {'type': 'SUCCESS', 'payload': f'Group {group_id} deleted'})
-            broadcast_groups_list()
-        else:
-            print(f"[SERVER] Không xóa được nhóm: group_id={group_id}, username={username}", flush=True)
-            emit('message', {'type': 'ERROR', 'payload': 'You are not allowed to delete this group or deletion failed.'})
-
-    elif msg_type == protocol.MSG_FILE_REQUEST:
-        filename = payload.get('filename')
-        filesize = payload.get('filesize')
-        receiver = payload.get('receiver')
-        print(f"[FILE] {username} sending file: {filename} ({filesize} bytes)")
-        filepath = os.path.join(FILES_DIR, filename)
+    # Update creator's group mapping
+    u_gids = sorted(db.get_user_group_ids(username))
+    emit('message', {'type': 'USER_GROUPS', 'payload': u_gids})
+
+    # Danh sách nhóm của người tạo (để cập nhật tab Trò chuyện); người khác không bị ảnh hưởng
+    groups = serialize_groups(db.get_user_groups(username))
+    emit('message', {'type': protocol.MSG_GROUPS_LIST, 'payload': groups}, room=sid)
+
+    emit('message', {'type': 'SUCCESS', 'payload': f"Group '{group_name}' created"})
+
+@dispatcher.route(protocol.MSG_GROUP_JOIN, payload=(int, str))
+def on_group_join(ctx):
+    group_id = group_key(ctx.payload)
+    if group_id is None or db.get_group(group_id) is None:
+        emit('message', {'type': 'ERROR', 'payload': f"Group {ctx.payload} not found"})
+        return
+    if db.add_member_to_group(group_id, ctx.username):
+        group_room(sids_of([ctx.username]), group_id)
+        emit('message', {'type': 'SUCCESS', 'payload': f"Joined group {group_id}"})
+        notify_group_added([ctx.username], group_id)
+    else:
+        emit('message', {'type': 'ERROR', 'payload': "Failed to join group"})
+
+@dispatcher.route(protocol.MSG_GROUP_LEAVE, payload=(int, str))
+def on_group_leave(ctx):
+    username = ctx.username
+    group_id = group_key(ctx.payload)
+    if group_id is None:
+        emit('message', {'type': 'ERROR', 'payload': f"Group {ctx.payload} not found"})
+        return
+    # Chỉ báo SUCCESS / GROUP_REMOVED khi thật sự có dòng membership bị xoá
+    if db.remove_member_from_group(group_id, username):
+        group_room(sids_of([username]), group_id, join=False)
+        emit('message', {'type': 'SUCCESS', 'payload': f"Left group {group_id}"})
+        # Gửi lại danh sách nhóm đã tham gia
+        u_gids = sorted(db.get_user_group_ids(username))
+        emit('message', {'type': 'USER_GROUPS', 'payload': u_gids})
+        notify_group_removed([username], group_id)
+    else:
+        emit('message', {'type': 'ERROR', 'payload': f"You are not a member of group {group_id}."})
+
+@dispatcher.route('GROUP_DELETE', payload=dict)
+def on_group_delete(ctx):
+    username = ctx.username
+    group_id = ctx.payload.get('group_id')
+    # Only allow creator to delete
+    members = db.get_group_member_set(group_id)
+    if db.delete_group(group_id, username):
+        logger.info("group deleted", extra=fields(group_id=group_id, user=username))
+        emit('message', {'type': 'SUCCESS', 'payload': f'Group {group_id} deleted'})
+        notify_group_removed(members, group_id)
+        socketio.close_room(f"group_{group_id}")
+    else:
+        logger.warning("group delete rejected", extra=fields(group_id=group_id, user=username))
+        emit('message', {'type': 'ERROR', 'payload': 'You are not allowed to delete this group or deletion failed.'})
+
+@dispatcher.route(protocol.MSG_FILE_REQUEST, payload=dict)
+def on_file_request(ctx):
+    username = ctx.username
+    filename = ctx.payload.get('filename')
+    filesize = ctx.payload.get('filesize')
+    receiver = ctx.payload.get('receiver')
+    if receiver is not None and str(receiver).isdigit() and not db.is_group_member(receiver, username):
+        emit('message', {'type': 'ERROR', 'payload': f"You are not a member of group {receiver}."})
+        metrics.FILE_TRANSFERS.labels('failed').inc()
+        return
+    file_logger.info("file transfer started", extra=fields(user=username, filename=filename, filesize=filesize))
+    filepath = os.path.join(FILES_DIR, filename)
+    # Ghi vào file tạm rồi đổi tên khi xong, để /download ở node khác (thư mục dùng chung)
+    # không bao giờ trả về file đang ghi dở. Transfer gắn với socket nên cần sticky session.
+    part_path = f"{filepath}.{ctx.sid}.part"
+    try:
+        f = open(part_path, 'wb')
+        file_transfers[ctx.sid] = {
+            'sender': username,
+            'filename': filename,
+            'filesize': filesize,
+            'receiver': receiver,
+            'file': f,
+            'path': filepath,
+            'part_path': part_path
+        }
+    except Exception as e:
+        file_logger.error("cannot open file for writing", extra=fields(filename=filename, error=str(e)))
+        metrics.FILE_TRANSFERS.labels('failed').inc()
+
+@dispatcher.route(protocol.MSG_FILE_CHUNK, payload=dict)
+def on_file_chunk(ctx):
+    chunk_b64 = ctx.payload.get('data', '')
+    transfer = file_transfers.get(ctx.sid)
+    if transfer:
         try:
-            f = open(filepath, 'wb')
-            file_transfers[sid] = {
+            data_chunk = base64.b64decode(chunk_b64)
+            transfer['file'].write(data_chunk)
+            metrics.FILE_BYTES.inc(len(data_chunk))
+        except Exception as e:
+            file_logger.error("write chunk failed", extra=fields(sid=ctx.sid, error=str(e), sample_rate=0.1))
+
+@dispatcher.route(protocol.MSG_FILE_END)
+def on_file_end(ctx):
+    sid = ctx.sid
+    username = ctx.username
+    if sid not in file_transfers:
+        return
+    info = file_transfers[sid]
+    info['file'].close()
+    os.replace(info['part_path'], info['path'])
+    filename = info['filename']
+    filesize = info['filesize']
+    receiver = info.get('receiver')
+    # Xác định context gửi file: public, private, group
+    # Nếu receiver là số (int/str digit) => group, nếu là tên user => private, nếu None => public
+    file_msg = f"📎 File: {filename} ({format_file_size(filesize)})"
+    if receiver is None:
+        store_message(username, file_msg, message_type='public')
+        broadcast_msg = {
+            'type': protocol.MSG_FILE,
+            'payload': {
+                'sender': username,
+                'filename': filename,
+                'filesize': filesize,
+                'message': f"{username} đã gửi file: {filename}"
+            }
+        }
+        emit('message', broadcast_msg, broadcast=True)
+        observe_fanout('file')
+    elif str(receiver).isdigit():
+        seq = store_message(username, file_msg, receiver=receiver, message_type='group')
+        broadcast_msg = {
+            'type': protocol.MSG_FILE,
+            'payload': {
+                'seq': seq,
+                'sender': username,
+                'filename': filename,
+                'filesize': filesize,
+                'group_id': int(receiver),
+                'message': f"{username} đã gửi file: {filename}"
+            }
+        }
+        emit('message', broadcast_msg, room=f"group_{receiver}")
+        observe_fanout('file', f"group_{receiver}")
+    else:
+        # Online hay không tính trên đúng tập phiên nhận fan-out bên dưới
+        receiver_sids = sids_of([receiver])
+        seq = store_message(username, file_msg, receiver=receiver, message_type='private',
+                            deliver_later=not receiver_sids)
+        # Gửi cho cả 2 phía (sender và receiver)
+        fanout({
+            'type': protocol.MSG_FILE,
+            'payload': {
+                'seq': seq,
                 'sender': username,
                 'filename': filename,
                 'filesize': filesize,
                 'receiver': receiver,
-                'file': f
+                'message': f"{username} đã gửi file: {filename}"
             }
+        }, sids=receiver_sids | sids_of([username]), kind='file')
+    del file_transfers[sid]
+    metrics.FILE_TRANSFERS.labels('completed').inc()
+
+def abort_file_transfer(sid):
+    """Huỷ transfer dở dang của socket: đóng và xoá file tạm."""
+    info = file_transfers.pop(sid, None)
+    if not info:
+        return
+    try:
+        info['file'].close()
+        os.remove(info['part_path'])
+    except OSError:
+        pass
+    metrics.FILE_TRANSFERS.labels('aborted').inc()
+
+# Quét trạng thái typing hết hạn mỗi TYPING_SWEEP_INTERVAL giây (chạy khi có typing đầu tiên)
+TYPING_SWEEP_INTERVAL = 1.0
+_typing_sweeper = None
+_typing_counters = {}
+
+def count_typing(result):
+    child = _typing_counters.get(result)
+    if child is None:
+        child = _typing_counters[result] = metrics.TYPING_EVENTS.labels(result)
+    child.inc()
+
+def typing_key(payload):
+    """(mode, target) chuẩn hoá từ payload TYPING/STOP_TYPING; None nếu không hợp lệ."""
+    mode = payload.get('mode')  # 'private', 'group' hoặc 'public'
+    target = payload.get('target')  # username hoặc group_id
+    if mode == 'public':
+        return mode, None
+    if mode in ('private', 'group') and isinstance(target, (str, int)) and not isinstance(target, bool) and target != '':
+        return mode, str(target)
+    return None
+
+def forward_typing(msg_type, username, mode, target):
+    """Gửi TYPING/STOP_TYPING tới người nhận (không gửi lại cho các phiên của chính user)."""
+    skip = list(presence.sids_for(username)) or None
+    if mode == 'private':
+        fanout({
+            'type': msg_type,
+            'payload': {'sender': username, 'mode': 'private'}
+        }, sids=sids_of([target]))
+    elif mode == 'group':
+        group_id = int(target) if target.isdigit() else target
+        socketio.emit('message', {
+            'type': msg_type,
+            'payload': {'sender': username, 'mode': 'group', 'group_id': group_id}
+        }, room=f"group_{target}", skip_sid=skip)
+        observe_fanout('typing', f"group_{target}")
+    elif mode == 'public':
+        socketio.emit('message', {
+            'type': msg_type,
+            'payload': {'sender': username, 'mode': 'public'}
+        }, skip_sid=skip)
+        observe_fanout('typing')
+
+def expire_typing(now=None):
+    """Phát STOP_TYPING thay cho các client im lặng quá hạn; trả về số trạng thái đã hết hạn."""
+    keys = typing_state.expired(now)
+    for username, mode, target in keys:
+        forward_typing(protocol.MSG_STOP_TYPING, username, mode, target)
+        count_typing(EXPIRED)
+    return len(keys)
+
+def stop_user_typing(username):
+    """User thoát: tắt ngay mọi chỉ báo đang nhập của user."""
+    for _, mode, target in typing_state.drop_user(username):
+        forward_typing(protocol.MSG_STOP_TYPING, username, mode, target)
+        count_typing(EXPIRED)
+
+def _sweep_typing():
+    while True:
+        socketio.sleep(TYPING_SWEEP_INTERVAL)
+        try:
+            expire_typing()
         except Exception as e:
-            print(f"[ERROR] Cannot open file for writing: {e}")
+            logger.warning("typing sweep failed", extra=fields(error=str(e)))
 
-    elif msg_type == protocol.MSG_FILE_CHUNK:
-        chunk_b64 = payload.get('data', '')
-        if sid in file_transfers:
-            try:
-                data_chunk = base64.b64decode(chunk_b64)
-                file_transfers[sid]['file'].write(data_chunk)
-            except Exception as e:
-                print(f"[ERROR] Write chunk failed: {e}")
+def _ensure_typing_sweeper():
+    global _typing_sweeper
+    if _typing_sweeper is None:
+        _typing_sweeper = socketio.start_background_task(_sweep_typing)
 
-    elif msg_type == protocol.MSG_FILE_END:
-        if sid in file_transfers:
-            info = file_transfers[sid]
-            info['file'].close()
-            filename = info['filename']
-            filesize = info['filesize']
-            receiver = info.get('receiver')
-            # Xác định context gửi file: public, private, group
-            # Nếu receiver là số (int/str digit) => group, nếu là tên user => private, nếu None => public
-            file_msg = f"📎 File: {filename} ({format_file_size(filesize)})"
-            if receiver is None:
-                db.save_message(username, file_msg, message_type='public')
-                broadcast_msg = {
-                    'type': protocol.MSG_FILE,
-                    'payload': {
-                        'sender': username,
-                        'filename': filename,
-                        'filesize': filesize,
-                        'message': f"{username} đã gửi file: {filename}"
-                    }
-                }
-                emit('message', broadcast_msg, broadcast=True)
-            elif str(receiver).isdigit():
-                db.save_message(username, file_msg, receiver=receiver, message_type='group')
-                broadcast_msg = {
-                    'type': protocol.MSG_FILE,
-                    'payload': {
-                        'sender': username,
-                        'filename': filename,
-                        'filesize': filesize,
-                        'group_id': int(receiver),
-                        'message': f"{username} đã gửi file: {filename}"
-                    }
-                }
-                emit('message', broadcast_msg, room=f"group_{receiver}")
-            else:
-                db.save_message(username, file_msg, receiver=receiver, message_type='private')
-                # Gửi cho cả 2 phía (sender và receiver)
-                for u in [username, receiver]:
-                    target_sid = get_sid_by_username(u)
-                    if target_sid:
-                        emit('message', {
-                            'type': protocol.MSG_FILE,
-                            'payload': {
-                                'sender': username,
-                                'filename': filename,
-                                'filesize': filesize,
-                                'receiver': receiver,
-                                'message': f"{username} đã gửi file: {filename}"
-                            }
-                        }, room=target_sid)
-            del file_transfers[sid]
-
-    elif msg_type == protocol.MSG_TYPING:
-        target_mode = payload.get('mode') # 'private' or 'group'
-        target_id = payload.get('target') # username or group_id
-        
-        if target_mode == 'private':
-            target_sid = get_sid_by_username(target_id)
-            if target_sid:
-                emit('message', {
-                    'type': protocol.MSG_TYPING,
-                    'payload': {'sender': username, 'mode': 'private'}
-                }, room=target_sid)
-        elif target_mode == 'group':
-             emit('message', {
-                    'type': protocol.MSG_TYPING,
-                    'payload': {'sender': username, 'mode': 'group', 'group_id': target_id}
-                }, room=f"group_{target_id}", include_self=False)
-        elif target_mode == 'public':
-            emit('message', {
-                'type': protocol.MSG_TYPING,
-                'payload': {'sender': username, 'mode': 'public'}
-            }, broadcast=True, include_self=False)
+def handle_typing(msg_type, ctx):
+    count_typing('received')
+    key = typing_key(ctx.payload)
+    if key is None:
+        _reply_invalid(ctx)
+        return
+    mode, target = key
+    if msg_type == protocol.MSG_TYPING:
+        result = typing_state.typing(ctx.username, mode, target)
+    else:
+        result = typing_state.stop(ctx.username, mode, target)
+    count_typing(result)
+    if result == FORWARDED:
+        forward_typing(msg_type, ctx.username, mode, target)
+        _ensure_typing_sweeper()
 
-    elif msg_type == protocol.MSG_STOP_TYPING:
-        target_mode = payload.get('mode')
-        target_id = payload.get('target')
-        
-        if target_mode == 'private':
-            target_sid = get_sid_by_username(target_id)
-            if target_sid:
-                emit('message', {
-                    'type': protocol.MSG_STOP_TYPING,
-                    'payload': {'sender': username, 'mode': 'private'}
-                }, room=target_sid)
-        elif target_mode == 'group':
-             emit('message', {
-                    'type': protocol.MSG_STOP_TYPING,
-                    'payload': {'sender': username, 'mode': 'group', 'group_id': target_id}
-                }, room=f"group_{target_id}", include_self=False)
-        elif target_mode == 'public':
-            emit('message', {
-                'type': protocol.MSG_STOP_TYPING,
-                'payload': {'sender': username, 'mode': 'public'}
-            }, broadcast=True, include_self=False)
-
-    elif msg_type == protocol.MSG_UPDATE_NAME:
-        new_name = payload.get('new_name')
-        if db.update_user_display_name(username, new_name):
-            emit('message', {'type': protocol.MSG_UPDATE_NAME_SUCCESS, 'payload': new_name})
-            broadcast_users_list()
-        else:
-            emit('message', {'type': 'ERROR', 'payload': "Failed to update name"})
-
-    elif msg_type == protocol.MSG_FRIEND_REQUEST:
-        target = payload.get('target')
-        if target == username:
-             emit('message', {'type': 'ERROR', 'payload': "Cannot add yourself."})
-             return
-             
-        success, msg = db.request_friend(username, target)
-        if success:
-            emit('message', {'type': 'SUCCESS', 'payload': f"Friend request sent to {target}"})
-            # Notify target
-            target_sid = get_sid_by_username(target)
-            if target_sid:
-                 emit('message', {'type': protocol.MSG_FRIEND_REQUEST, 'payload': {'requester': username}}, room=target_sid)
-        else:
-            emit('message', {'type': 'ERROR', 'payload': msg})
-
-    elif msg_type == protocol.MSG_FRIEND_ACCEPT:
-        requester = payload.get('requester')
-        if db.accept_friend(username, requester):
-            emit('message', {'type': 'SUCCESS', 'payload': f"You and {requester} are now friends!"})
-            # Notify requester
-            req_sid = get_sid_by_username(requester)
-            if req_sid:
-                emit('message', {'type': protocol.MSG_FRIEND_ACCEPT, 'payload': {'accepter': username}}, room=req_sid)
-                # Refresh friend lists for both
-                send_friend_list(req_sid, requester)
-            
-            # Refresh my list
-            send_friend_list(sid, username)
-        else:
-             emit('message', {'type': 'ERROR', 'payload': "Failed to accept request."})
+@dispatcher.route(protocol.MSG_TYPING, payload=dict)
+def on_typing(ctx):
+    handle_typing(protocol.MSG_TYPING, ctx)
 
-    elif msg_type == protocol.MSG_FRIEND_LIST:
-        send_friend_list(sid, username)
+@dispatcher.route(protocol.MSG_STOP_TYPING, payload=dict)
+def on_stop_typing(ctx):
+    handle_typing(protocol.MSG_STOP_TYPING, ctx)
 
+@dispatcher.route(protocol.MSG_UPDATE_NAME, payload=dict)
+def on_update_name(ctx):
+    new_name = ctx.payload.get('new_name')
+    if db.update_user_display_name(ctx.username, new_name):
+        emit('message', {'type': protocol.MSG_UPDATE_NAME_SUCCESS, 'payload': new_name})
+        broadcast_users_list()
+    else:
+        emit('message', {'type': 'ERROR', 'payload': "Failed to update name"})
+
+@dispatcher.route(protocol.MSG_FRIEND_REQUEST, payload=dict)
+def on_friend_request(ctx):
+    username = ctx.username
+    target = ctx.payload.get('target')
+    if target == username:
+         emit('message', {'type': 'ERROR', 'payload': "Cannot add yourself."})
+         return
+         
+    success, msg = db.request_friend(username, target)
+    if success:
+        emit('message', {'type': 'SUCCESS', 'payload': f"Friend request sent to {target}"})
+        # Notify target (mọi phiên)
+        fanout({'type': protocol.MSG_FRIEND_REQUEST, 'payload': {'requester': username}},
+               sids=sids_of([target]), kind='friend_request')
+    else:
+        emit('message', {'type': 'ERROR', 'payload': msg})
+
+@dispatcher.route(protocol.MSG_FRIEND_ACCEPT, payload=dict)
+def on_friend_accept(ctx):
+    username = ctx.username
+    requester = ctx.payload.get('requester')
+    if db.accept_friend(username, requester):
+        emit('message', {'type': 'SUCCESS', 'payload': f"You and {requester} are now friends!"})
+        # Notify requester; refresh friend lists cho mọi phiên của cả hai
+        req_sids = sids_of([requester])
+        if req_sids:
+            fanout({'type': protocol.MSG_FRIEND_ACCEPT, 'payload': {'accepter': username}},
+                   sids=req_sids, kind='friend_request')
+            send_friend_list(req_sids, requester)
+        send_friend_list(sids_of([username]), username)
+    else:
+         emit('message', {'type': 'ERROR', 'payload': "Failed to accept request."})
+
+@dispatcher.route(protocol.MSG_FRIEND_LIST)
+def on_friend_list(ctx):
+    send_friend_list([ctx.sid], ctx.username)
 
 def format_file_size(size_bytes):
     if size_bytes < 1024:
@@ -597,76 +919,194 @@ def format_file_size(size_bytes):
     else:
         return f"{size_bytes / (1024 * 1024):.2f} MB"
 
-def send_history(sid, username):
-    # Public history
-    public_history = db.get_history(20, message_type='public')
-    for row in reversed(list(public_history)):
-        emit('message', {
-            'type': protocol.MSG_TEXT,
-            'payload': f"[{row['timestamp']}] {row['sender']}: {row['content']}"
-        }, room=sid)
+def parse_seq(value):
+    """seq client gửi lên (int >= 0); None nếu thiếu hoặc không hợp lệ."""
+    if isinstance(value, bool):
+        return None
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        return None
+    return seq if seq >= 0 else None
+
+def store_message(sender, content, receiver=None, message_type='public', deliver_later=False):
+    """Lưu tin và ghi vào vòng replay; trả về seq (id) của tin."""
+    seq = db.save_message(sender, content, receiver=receiver, message_type=message_type,
+                          deliver_later=deliver_later)
+    message_log.record({
+        'id': seq,
+        'sender': sender,
+        'receiver': str(receiver) if receiver is not None else None,
+        'content': content,
+        'message_type': message_type,
+        'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+    })
+    return seq
+
+def replay_messages(username, since, limit):
+    """(messages, more, source): tin user được nhận sau since, từ vòng trong bộ nhớ hoặc database."""
+    group_ids = {str(g) for g in db.get_user_group_ids(username)}
+    messages = message_log.since(since, username, group_ids, limit + 1)
+    source = 'buffer'
+    if messages is None:
+        messages = db.get_messages_since(username, since, group_ids, limit + 1)
+        source = 'db'
+    metrics.SYNC_REPLAYS.labels(source).inc()
+    return messages[:limit], len(messages) > limit, source
 
-    # Private history
-    private_history = db.get_history(20, message_type='private', username=username)
-    for row in reversed(list(private_history)):
+def send_offline_messages(sid, username, since_seq=None, with_unread=True):
+    """
+    Giao các tin riêng đến lúc user offline (theo lô PENDING_BATCH, thường chỉ một frame)
+    kèm số chưa đọc của từng cuộc trò chuyện; client ACK seq của frame để xoá lô khỏi hàng chờ.
+    Kết nối lại với since_seq: giao mọi tin sau mốc đó (như SYNC) thay cho hàng chờ.
+    Client tự tải lịch sử khi mở cuộc trò chuyện. with_unread=False: số chưa đọc đã có trong
+    BOOTSTRAP.
+    """
+    unread = db.get_unread_counts(username) if with_unread else None
+    seq = since_seq or 0
+    while True:
+        if since_seq is None:
+            messages, seq, more = db.get_pending_messages(username, seq)
+        else:
+            messages, more, _ = replay_messages(username, seq, db.PENDING_BATCH)
+            seq = messages[-1]['id'] if messages else seq
         emit('message', {
-            'type': protocol.MSG_PRIVATE,
-            'payload': {
-                'sender': row['sender'],
-                'receiver': row['receiver'],
-                'content': row['content'],
-                'timestamp': row['timestamp']
-            }
+            'type': protocol.MSG_OFFLINE_MESSAGES,
+            'payload': {'messages': messages, 'unread': unread, 'seq': seq, 'more': more}
         }, room=sid)
+        if not more:
+            break
+        unread = None
 
-def send_friend_list(sid, username):
+def send_bootstrap(sid, username):
+    """
+    Frame BOOTSTRAP sau đăng nhập: bạn bè (kèm trạng thái online), lời mời, nhóm đã tham gia,
+    trang đầu danh sách cuộc trò chuyện và số chưa đọc, thay cho FRIEND_LIST + USER_GROUPS +
+    GROUPS_REQUEST + CONVERSATIONS riêng lẻ; cho sid vào room của các nhóm.
+    """
+    data = db.get_bootstrap(username, CONVERSATIONS_PAGE_SIZE)
+    for f in data['friends']:
+        f['status'] = 'online' if presence.is_online(f['username']) else 'offline'
+    group_ids = sorted(g['id'] for g in data['groups'])
+    join_rooms(sid, [f"group_{gid}" for gid in group_ids])
+    data['groups'] = serialize_groups(data['groups'])
+    data['group_ids'] = group_ids
+    emit('message', {'type': protocol.MSG_BOOTSTRAP, 'payload': data}, room=sid)
+
+def send_friend_list(sids, username):
+    """FRIEND_LIST của username tới các sid (các phiên của user, kể cả trên node khác)."""
     friends = db.get_friends_with_status(username)
     pending = db.get_pending_requests(username)
     sent = db.get_sent_requests(username)
     
     # Check online status for friends
     for f in friends:
-        f_sid = get_sid_by_username(f['username'])
-        f['status'] = 'online' if f_sid else 'offline'
+        f['status'] = 'online' if presence.is_online(f['username']) else 'offline'
         
-    emit('message', {
+    fanout({
         'type': protocol.MSG_FRIEND_LIST,
         'payload': {
             'friends': friends,
             'pending': pending,
             'sent': sent
         }
-    }, room=sid)
+    }, sids=sids)
 
 def broadcast_users_list():
-    online_usernames = list(set(clients.values()))
-    payload = []
-    for u in online_usernames:
-        d_name = db.get_user_display_name(u)
-        payload.append({'username': u, 'display_name': d_name})
+    online_usernames = presence.online_usernames()
+    names = db.get_display_names(online_usernames)
+    payload = [{'username': u, 'display_name': names[u]} for u in online_usernames]
         
-    emit('message', {
+    fanout({
         'type': protocol.MSG_USERS_LIST,
         'payload': payload
-    }, broadcast=True)
+    }, rooms=[None], kind='users_list')
 
-def broadcast_groups_list():
-    groups = db.get_all_groups()
+def serialize_groups(groups):
     # Convert datetime fields to string
     for g in groups:
         for k, v in g.items():
             if hasattr(v, 'isoformat'):
                 g[k] = v.isoformat()
-    emit('message', {
-        'type': protocol.MSG_GROUPS_LIST,
-        'payload': groups
-    }, broadcast=True)
+    return groups
+
+def sids_of(usernames):
+    """Mọi phiên (sid) của các user, kể cả trên node khác."""
+    sids = set()
+    for username in usernames:
+        sids |= presence.sids_for(username)
+    return sids
+
+def fanout(message, sids=(), rooms=(), skip_sids=(), kind=None):
+    """
+    Gửi cùng một message tới nhiều sid/room (room None = mọi kết nối): dict được dựng và
+    encode một lần cho mọi người nhận, thay cho emit từng người; trả về số socket nhận trên
+    process này.
+    """
+    n = outbound.fanout(message, sids=sids, rooms=rooms, skip_sids=skip_sids)
+    if kind is not None:
+        observe_fanout(kind, count=n)
+    return n
+
+def notify_group_added(usernames, group_id):
+    """Delta GROUP_ADDED cho các user vừa vào nhóm, thay cho việc gửi lại cả danh sách nhóm."""
+    if not usernames:
+        return
+    group = db.get_group(group_id)
+    if group is None:
+        return
+    fanout({'type': protocol.MSG_GROUP_ADDED, 'payload': serialize_groups([group])[0]},
+           sids=sids_of(usernames), kind='group_delta')
+
+def notify_group_removed(usernames, group_id):
+    """Delta GROUP_REMOVED cho các user rời nhóm / thành viên của nhóm vừa bị xoá."""
+    fanout({'type': protocol.MSG_GROUP_REMOVED, 'payload': {'group_id': int(group_id)}},
+           sids=sids_of(usernames), kind='group_delta')
+
+def join_rooms(sid, rooms, namespace='/'):
+    """
+    Cho sid vào nhiều room một lượt: tra eio_sid một lần rồi ghi thẳng vào manager,
+    thay vì join_room() từng room (user ở hàng trăm nhóm khi đăng nhập).
+    """
+    manager = socketio.server.manager
+    eio_sid = manager.rooms[namespace][None][sid]
+    for room in rooms:
+        manager.enter_room(sid, namespace, room, eio_sid=eio_sid)
+
+def group_room(sids, group_id, join=True):
+    """
+    Cho các sid vào (join=False: ra khỏi) room của nhóm. Room chỉ tồn tại trên node giữ
+    socket: sid của process này được xử lý ngay, sid ở node khác được gửi qua message queue
+    để node đó tự join/leave (apply_room_command).
+    """
+    room = f"group_{group_id}"
+    remote = []
+    for sid in sids:
+        if sid in clients:
+            if join:
+                join_rooms(sid, [room])
+            else:
+                socketio.server.manager.leave_room(sid, '/', room)
+        else:
+            remote.append(sid)
+    if remote and MESSAGE_QUEUE:
+        _manager.publish_custom('rooms', {'op': 'join' if join else 'leave', 'group_id': group_id, 'sids': remote})
+
+def apply_room_command(message):
+    """Lệnh join/leave room từ node khác; chỉ các sid đang kết nối tới process này."""
+    local = [sid for sid in message.get('sids') or () if sid in clients]
+    if local:
+        group_room(local, message['group_id'], join=message.get('op') == 'join')
+
+if MESSAGE_QUEUE:
+    _manager.handlers['rooms'] = apply_room_command
 
 def get_sid_by_username(username):
-    for sid, name in clients.items():
-        if name == username:
-            return sid
-    return None
+    return presence.sid_for(username)
+
+# Counter theo type message, tạo sẵn cho các type đã đăng ký; type lạ gộp vào 'unknown'
+_message_counters = {t: metrics.MESSAGES_RECEIVED.labels(t) for t in dispatcher.routes()}
+_message_counters[None] = metrics.MESSAGES_RECEIVED.labels('unknown')
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 8000))
@@ -0,0 +1,101 @@
+# Gộp chỉ báo "đang nhập" (TYPING / STOP_TYPING) trước khi fan-out.
+#
+# Trình duyệt gửi TYPING theo từng phím; chuyển nguyên từng cái thì room nhóm / broadcast
+# công khai ngập tin typing. Server giữ trạng thái theo (người gửi, mode, target):
+# - TYPING đầu tiên được chuyển đi, các TYPING tiếp theo trong DEBOUNCE giây bị bỏ (chỉ gia
+#   hạn thời điểm hết hạn);
+# - STOP_TYPING chỉ chuyển khi đang có trạng thái typing, STOP lặp lại bị bỏ;
+# - client im lặng quá EXPIRE giây (đóng tab, mất mạng...) thì server tự phát STOP_TYPING;
+# - mode public chỉ cho tối đa PUBLIC_MAX người cùng lúc hiện "đang nhập".
+#
+# Trạng thái nằm trong bộ nhớ của từng process, không đồng bộ qua message queue: chạy nhiều
+# worker/node thì giới hạn public là PUBLIC_MAX cho mỗi process (tối đa PUBLIC_MAX x số worker
+# người hiện "đang nhập"), và user gõ từ hai thiết bị ở hai node được debounce riêng ở mỗi node.
+import os
+import threading
+import time
+
+TYPING_DEBOUNCE = float(os.environ.get('CHAT_TYPING_DEBOUNCE', 3.0))
+TYPING_EXPIRE = float(os.environ.get('CHAT_TYPING_EXPIRE', 6.0))
+# Số người typing public tối đa trên mỗi process (không phải toàn cluster)
+TYPING_PUBLIC_MAX = int(os.environ.get('CHAT_TYPING_PUBLIC_MAX', 3))
+
+# Kết quả của typing()/stop(); chỉ FORWARDED mới được gửi tới người nhận
+FORWARDED = 'forwarded'
+DEBOUNCED = 'debounced'
+DUPLICATE = 'duplicate'
+CAPPED = 'capped'
+EXPIRED = 'expired'
+
+
+class TypingCoalescer:
+    """
+    Trạng thái typing theo key (username, mode, target); target đã chuẩn hoá thành str
+    (None với mode public). clock: hàm thời gian, thay được khi test.
+    """
+
+    def __init__(self, debounce=TYPING_DEBOUNCE, expire=TYPING_EXPIRE, public_max=TYPING_PUBLIC_MAX,
+                 clock=time.monotonic):
+        self.debounce = debounce
+        self.expire = expire
+        self.public_max = public_max
+        self.clock = clock
+        self._state = {}     # key -> [lần chuyển gần nhất, hạn hết]
+        self._public = 0     # số người đang typing ở mode public
+        self._lock = threading.Lock()
+
+    def typing(self, username, mode, target):
+        key = (username, mode, target)
+        now = self.clock()
+        with self._lock:
+            state = self._state.get(key)
+            if state is not None:
+                state[1] = now + self.expire
+                if now - state[0] < self.debounce:
+                    return DEBOUNCED
+                state[0] = now
+                return FORWARDED
+            if mode == 'public':
+                if self._public >= self.public_max:
+                    return CAPPED
+                self._public += 1
+            self._state[key] = [now, now + self.expire]
+            return FORWARDED
+
+    def stop(self, username, mode, target):
+        with self._lock:
+            if not self._remove((username, mode, target)):
+                return DUPLICATE
+            return FORWARDED
+
+    def expired(self, now=None):
+        """Bỏ và trả về các key quá hạn (cần phát STOP_TYPING thay cho client)."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            keys = [key for key, state in self._state.items() if state[1] <= now]
+            for key in keys:
+                self._remove(key)
+        return keys
+
+    def drop_user(self, username):
+        """User thoát: bỏ và trả về mọi key typing của user."""
+        with self._lock:
+            keys = [key for key in self._state if key[0] == username]
+            for key in keys:
+                self._remove(key)
+        return keys
+
+    def _remove(self, key):
+        if self._state.pop(key, None) is None:
+            return False
+        if key[1] == 'public':
+            self._public -= 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._state.clear()
+            self._public = 0
+
+    def __len__(self):
+        return len(self._state)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark cho các hot path của Database trên dữ liệu tổng hợp.
+
+Ví dụ:
+  python tests/bench_db.py                                   # SQLite, dataset mặc định
+  python tests/bench_db.py --users 5000 --messages 200000 --json bench.json
+  python tests/bench_db.py --postgres postgresql://localhost/chat_bench --json bench.json
+  python tests/bench_db.py --json new.json --compare old.json
+
+Kết quả JSON (so sánh được giữa các commit) gồm cấu hình dataset, commit hiện tại
+và thống kê thời gian (µs) cho từng thao tác trên từng backend.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+# Add project root to path
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.append(ROOT)
+
+import src.server.db as db_module
+
+BATCH = 5000
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+# --- Mở database cho từng backend ---
+
+def open_sqlite():
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.environ.pop('DATABASE_URL', None)
+    db_module.DB_PATH = path
+    db = db_module.Database()
+
+    def cleanup():
+        db.close()
+        os.remove(path)
+    return db, cleanup
+
+
+def open_postgres(url):
+    """Tạo schema tạm trong Postgres và trỏ search_path vào đó."""
+    import psycopg2
+    schema = f"bench_{uuid.uuid4().hex[:8]}"
+    admin = psycopg2.connect(url)
+    admin.autocommit = True
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    sep = '&' if '?' in url else '?'
+    os.environ['DATABASE_URL'] = f"{url}{sep}options=-csearch_path%3D{schema}"
+    try:
+        db = db_module.Database()
+    finally:
+        os.environ.pop('DATABASE_URL', None)
+
+    def cleanup():
+        db.close()
+        admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
+    return db, cleanup
+
+
+# --- Sinh dữ liệu ---
+
+def executemany(db, query, rows):
+    if db.db_type == 'postgres':
+        query = query.replace('?', '%s')
+    cursor = db.get_cursor()
+    for i in range(0, len(rows), BATCH):
+        cursor.executemany(query, rows[i:i + BATCH])
+    db.conn.commit()
+
+
+def seed_friends(db, pairs):
+    """pairs: list (requester, target, status); mỗi cặp thành 2 cạnh có hướng."""
+    edges = []
+    for requester, target, status in pairs:
+        edges.append((requester, target, status, 'out'))
+        edges.append((target, requester, status, 'in'))
+    executemany(db, "INSERT INTO friend_edges (owner, peer, status, direction) VALUES (?, ?, ?, ?)", edges)
+
+
+def seed(db, args, rng):
+    users = [f"user{i}" for i in range(args.users)]
+    pw = db._hash_password('pw')
+    executemany(db, "INSERT INTO users (username, password_hash, display_name) VALUES (?, ?, ?)",
+                [(u, pw, u.upper()) for u in users])
+
+    # Bạn bè: mỗi user có ~friends bạn, một phần còn pending
+    seen = set()
+    pairs = []
+    for i, u in enumerate(users):
+        for _ in range(args.friends):
+            j = rng.randrange(args.users)
+            if j == i or (i, j) in seen or (j, i) in seen:
+                continue
+            seen.add((i, j))
+            status = 'pending' if rng.random() < 0.1 else 'accepted'
+            pairs.append((u, users[j], status))
+    seed_friends(db, pairs)
+
+    executemany(db, "INSERT INTO groups (name, creator) VALUES (?, ?)",
+                [(f"Group {g}", users[rng.randrange(args.users)]) for g in range(args.groups)])
+    cursor = db.execute_query("SELECT id FROM groups")
+    group_ids = [row['id'] for row in cursor.fetchall()]
+    members = set()
+    for gid in group_ids:
+        for u in rng.sample(users, min(args.group_members, len(users))):
+            members.add((gid, u))
+    executemany(db, "INSERT INTO group_members (group_id, username) VALUES (?, ?)", sorted(members))
+    # name_lower / member_count như khi tạo qua create_group
+    db._backfill_groups(db.get_cursor())
+
+    messages = []
+    for m in range(args.messages):
+        r = rng.random()
+        sender = users[rng.randrange(args.users)]
+        if r < 0.1:
+            messages.append((sender, None, f"public {m}", 'public'))
+        elif r < 0.6:
+            messages.append((sender, users[rng.randrange(args.users)], f"private {m}", 'private'))
+        else:
+            messages.append((sender, str(rng.choice(group_ids)), f"group {m}", 'group'))
+    executemany(db, "INSERT INTO messages (sender, receiver, content, message_type) VALUES (?, ?, ?, ?)",
+                messages)
+    return {
+        'users': users,
+        'group_ids': group_ids,
+        'friend_pairs': [(a, b) for a, b, s in pairs if s == 'accepted'],
+    }
+
+
+# --- Benchmark ---
+
+def bench_ops(db, data, rng):
+    users = data['users']
+    group_ids = data['group_ids']
+    friend_pairs = data['friend_pairs'] or [(users[0], users[1])]
+
+    def user():
+        return rng.choice(users)
+
+    def cold(fn):
+        # Bỏ qua FriendCache để đo đúng query trên database
+        def run():
+            db.friend_cache.clear()
+            return fn()
+        return run
+
+    return {
+        'save_message': lambda: db.save_message(user(), 'bench', receiver=user(), message_type='private'),
+        'get_history.public': lambda: db.get_history(20, message_type='public'),
+        'get_history.private': lambda: db.get_history(50, message_type='private', username=user()),
+        'get_history.group': lambda: db.get_history(50, message_type='group', group_id=rng.choice(group_ids)),
+        'get_history.user_all': lambda: db.get_history(50, message_type='all', username=user()),
+        'get_history.all': lambda: db.get_history(50, message_type='all'),
+        'get_friends_with_status': lambda: db.get_friends_with_status(user()),
+        'get_friends_with_status.cold': cold(lambda: db.get_friends_with_status(user())),
+        'get_pending_requests': lambda: db.get_pending_requests(user()),
+        'get_sent_requests': lambda: db.get_sent_requests(user()),
+        'get_user_groups': lambda: db.get_user_groups(user()),
+        # 'private' khớp ~một nửa số tin (xếp hạng cả tập), số thứ tự khớp đúng một tin
+        'search_messages.common': lambda: db.search_messages(user(), "private"),
+        'search_messages.rare': lambda: db.search_messages(user(), str(rng.randrange(len(users) * 10))),
+        'get_discoverable_groups': lambda: db.get_discoverable_groups(user(), limit=20),
+        'get_discoverable_groups.page': lambda: db.get_discoverable_groups(
+            user(), limit=20, after=(f"group {rng.randrange(len(group_ids))}", 0)),
+        'get_discoverable_groups.prefix': lambda: db.get_discoverable_groups(
+            user(), query=f"Group {rng.randrange(100)}", limit=20),
+        'get_discoverable_groups.substring': lambda: db.get_discoverable_groups(
+            user(), query=f"{rng.randrange(1000)}", limit=20, match='substring'),
+        'are_friends.hit': lambda: db.are_friends(*rng.choice(friend_pairs)),
+        'are_friends.miss': lambda: db.are_friends(user(), user()),
+        'are_friends.cold': cold(lambda: db.are_friends(*rng.choice(friend_pairs))),
+    }
+
+
+def run_op(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        'iterations': iterations,
+        'min_us': samples[0],
+        'median_us': statistics.median(samples),
+        'mean_us': statistics.fmean(samples),
+        'p95_us': samples[int(0.95 * (len(samples) - 1))],
+        'max_us': samples[-1],
+        'ops_per_sec': 1e6 / statistics.fmean(samples),
+    }
+
+
+def run_backend(name, opener, args):
+    rng = random.Random(args.seed)
+    db, cleanup = opener()
+    try:
+        start = time.perf_counter()
+        data = seed(db, args, rng)
+        print(f"[bench] {name}: seeded in {time.perf_counter() - start:.1f}s")
+        results = {}
+        ops = bench_ops(db, data, random.Random(args.seed + 1))
+        for op_name, fn in ops.items():
+            if args.only and not any(op_name.startswith(p) for p in args.only):
+                continue
+            results[op_name] = run_op(fn, args.iterations, args.warmup)
+            r = results[op_name]
+            print(f"  {op_name:<28} median {r['median_us']:>10.1f}µs  p95 {r['p95_us']:>10.1f}µs  "
+                  f"{r['ops_per_sec']:>10.0f} ops/s")
+        return results
+    finally:
+        cleanup()
+
+
+def compare(current, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\n=== So sánh với {baseline_path} (commit {baseline.get('meta', {}).get('commit')}) ===")
+    for backend, ops in current['results'].items():
+        old_ops = baseline.get('results', {}).get(backend, {})
+        for op_name, r in ops.items():
+            old = old_ops.get(op_name)
+            if not old:
+                continue
+            delta = (r['median_us'] - old['median_us']) / old['median_us'] * 100 if old['median_us'] else 0
+            print(f"  {backend:<9}{op_name:<28}{old['median_us']:>10.1f} -> {r['median_us']:>10.1f}µs "
+                  f"({delta:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Database hot paths")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--friends', type=int, default=20, help="friend requests per user")
+    parser.add_argument('--groups', type=int, default=500)
+    parser.add_argument('--group-members', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', nargs='*', help="only run ops with these name prefixes")
+    parser.add_argument('--no-sqlite', action='store_true')
+    parser.add_argument('--postgres', default=os.environ.get('BENCH_POSTGRES_URL'),
+                        help="Postgres URL (a temporary schema is created and dropped)")
+    parser.add_argument('--json', help="write results as JSON to this path")
+    parser.add_argument('--compare', help="previous JSON result to diff against")
+    args = parser.parse_args(argv)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'dataset': {k: getattr(args, k) for k in ('users', 'friends', 'groups', 'group_members',
+                                                     'messages', 'seed')},
+            'iterations': args.iterations,
+        },
+        'results': {},
+    }
+    if not args.no_sqlite:
+        report['results']['sqlite'] = run_backend('sqlite', open_sqlite, args)
+    if args.postgres:
+        report['results']['postgres'] = run_backend('postgres', lambda: open_postgres(args.postgres), args)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(report, args.compare)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark CPU cho một lần fan-out tới nhiều kết nối (mặc định 1000 người nhận).
+
+So sánh:
+  loop    emit từng người nhận với dict dựng mới (cách cũ: thông báo bạn bè, file riêng...)
+  room    emit tới room của Socket.IO
+  fanout  OutboundQueues.fanout: dựng và encode packet một lần cho mọi người nhận
+
+Engine.IO được thay bằng bản giả chỉ gom packet vào list nên số đo là phần việc của server
+(dựng dict, encode JSON, đưa vào hàng đợi), không gồm I/O mạng.
+
+Ví dụ:
+  python tests/bench_fanout.py
+  python tests/bench_fanout.py --recipients 5000 --rounds 20 --json fanout.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+import socketio
+
+from src.server.outbound import OutboundQueues
+from src.common import protocol
+
+
+class _Queue(list):
+    def qsize(self):
+        return len(self)
+
+
+class _Socket:
+    def __init__(self):
+        self.queue = _Queue()
+        self.closed = False
+
+
+class _Engine:
+    def __init__(self, eio_sids):
+        self.sockets = {eio_sid: _Socket() for eio_sid in eio_sids}
+
+    def send(self, sid, data):
+        self.sockets[sid].queue.append(data)
+
+    def start_background_task(self, target, *args):
+        pass
+
+    def drain(self):
+        for socket in self.sockets.values():
+            socket.queue.clear()
+
+
+def make_server(recipients):
+    server = socketio.Server(async_mode='threading')
+    eio_sids = [f'eio{i}' for i in range(recipients)]
+    sids = [server.manager.connect(eio_sid, '/') for eio_sid in eio_sids]
+    for sid in sids:
+        server.manager.enter_room(sid, '/', 'group_1')
+    server.eio = _Engine(eio_sids)
+    outbound = OutboundQueues(server).install()
+    return server, outbound, sids
+
+
+def status(username):
+    return {'type': protocol.MSG_USER_STATUS, 'payload': {'username': username, 'status': 'online'}}
+
+
+def run(recipients, rounds):
+    server, outbound, sids = make_server(recipients)
+
+    def loop():
+        for sid in sids:
+            server.emit('message', status('alice'), to=sid)
+
+    def room():
+        server.emit('message', status('alice'), room='group_1')
+
+    def fanout():
+        outbound.fanout(status('alice'), sids=sids)
+
+    results = {}
+    for name, fn in (('loop', loop), ('room', room), ('fanout', fanout)):
+        samples = []
+        for _ in range(rounds):
+            start = time.process_time()
+            fn()
+            samples.append(time.process_time() - start)
+            delivered = sum(len(s.queue) for s in server.eio.sockets.values())
+            assert delivered == recipients, (name, delivered)
+            server.eio.drain()
+        per_message = [s / recipients * 1e6 for s in samples]
+        results[name] = {
+            'cpu_us_per_message': round(statistics.median(per_message), 3),
+            'cpu_ms_per_fanout': round(statistics.median(samples) * 1e3, 3),
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipients', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--json', help='ghi kết quả ra file JSON')
+    args = parser.parse_args(argv)
+
+    results = run(args.recipients, args.rounds)
+    print(f"{'cách gửi':<8} {'µs CPU/tin':>12} {'ms CPU/lần':>12}   ({args.recipients} người nhận)")
+    for name, r in results.items():
+        print(f"{name:<8} {r['cpu_us_per_message']:>12} {r['cpu_ms_per_fanout']:>12}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'recipients': args.recipients, 'rounds': args.rounds, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Tiện ích dùng chung cho các test chạy trên server thật (test client của Flask-SocketIO).
+
+Import module này trước src.server.server: server tạo Database lúc import nên DB_PATH phải
+trỏ tới file SQLite tạm trước đó.
+"""
+import unittest
+import sys
+import os
+import tempfile
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+import src.server.db as db_module
+test_db_fd, test_db_path = tempfile.mkstemp(suffix='.db')
+os.close(test_db_fd)
+db_module.DB_PATH = test_db_path
+
+from src.server.server import app, socketio, db
+from src.common import protocol
+
+
+def received(client):
+    """Các message {'type', 'payload'} client đã nhận (args có thể là list hoặc dict)."""
+    out = []
+    for msg in client.get_received():
+        args = msg.get('args')
+        out.append(args[0] if isinstance(args, list) else args)
+    return out
+
+
+def of_type(messages, msg_type):
+    return [m['payload'] for m in messages if m.get('type') == msg_type]
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Mỗi test chạy trên database SQLite trống của `db` trong server (bảng dựng lại, cache bạn
+    bè / nhóm đã xoá); các client mở bằng login() được ngắt trong tearDown.
+    """
+
+    def setUp(self):
+        # Các module test khác có thể đổi DB_PATH lúc import; dùng file tạm của helpers
+        self._old_path = db_module.DB_PATH
+        db_module.DB_PATH = test_db_path
+        db.close()
+        db.connect_sqlite()
+        db.create_tables()
+        db.friend_cache.clear()
+        db.group_cache.clear()
+        self.clients = []
+
+    def tearDown(self):
+        for c in self.clients:
+            c.disconnect()
+        db.close()
+        db_module.DB_PATH = self._old_path
+        try:
+            os.remove(test_db_path)
+        except OSError:
+            pass
+
+    def login(self, name, password='pw', **extra):
+        """Mở một phiên mới và đăng nhập; trả về (client, các message nhận được)."""
+        c = socketio.test_client(app)
+        c.emit('message', {'type': protocol.MSG_LOGIN,
+                           'payload': dict({'username': name, 'password': password}, **extra)})
+        self.clients.append(c)
+        return c, received(c)
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Load generator: mô phỏng N người dùng đồng thời trên một event loop (AsyncChatClient).
+
+Ví dụ:
+  python tests/loadgen.py --spawn-server --users 500 --duration 60
+  python tests/loadgen.py --port 8000 --users 2000 --mix dm=5,group=2,typing=4,history=1,file=0.1,login=0.2
+  python tests/loadgen.py --spawn-server --users 200 --json result.json
+
+Hành vi (trọng số trong --mix):
+  dm       ping-pong tin nhắn riêng giữa hai người bạn
+  group    gửi tin nhắn vào nhóm (đo độ trễ ở từng người nhận)
+  typing   gửi TYPING / STOP_TYPING liên tục
+  history  cuộn lịch sử (HISTORY_REQUEST -> HISTORY_END)
+  file     upload file nhỏ
+  login    ngắt kết nối rồi đăng nhập lại (login storm)
+
+Báo cáo: throughput theo loại message, phân vị độ trễ end-to-end, tỉ lệ lỗi và RSS của server.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+# Add project root to path
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.append(ROOT)
+
+from src.client.async_client import AsyncChatClient, ChatRequestError
+from src.common import protocol
+
+DEFAULT_MIX = 'dm=5,group=2,typing=3,history=1,file=0.1,login=0.1'
+BEHAVIORS = ('dm', 'group', 'typing', 'history', 'file', 'login')
+
+# Chạy server thật trong process riêng với database tạm
+SERVER_BOOT = (
+    "import sys; sys.path.insert(0, sys.argv[1]);"
+    "import src.server.db as db_module; db_module.DB_PATH = sys.argv[2];"
+    "from src.server.main import main; main()"
+)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in BEHAVIORS:
+            raise ValueError(f"Unknown behavior '{name}' (expected one of {', '.join(BEHAVIORS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def read_rss_kb(pid):
+    """RSS của process (KB) đọc từ /proc, None nếu không đọc được."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def raise_fd_limit():
+    # Mỗi user là một socket: nâng soft limit lên hard limit
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+class Stats:
+    """Bộ đếm theo loại message: gửi, nhận, lỗi và mẫu độ trễ (ms)."""
+
+    def __init__(self):
+        self.sent = {}
+        self.received = {}
+        self.errors = {}
+        self.latencies = {}
+        self.rss_samples = []
+
+    def on_sent(self, kind, n=1):
+        self.sent[kind] = self.sent.get(kind, 0) + n
+
+    def on_received(self, kind, latency_ms=None):
+        self.received[kind] = self.received.get(kind, 0) + 1
+        if latency_ms is not None:
+            self.latencies.setdefault(kind, []).append(latency_ms)
+
+    def on_error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, elapsed):
+        kinds = sorted(set(self.sent) | set(self.received) | set(self.errors))
+        rows = {}
+        for kind in kinds:
+            lat = sorted(self.latencies.get(kind, []))
+            sent = self.sent.get(kind, 0)
+            errors = self.errors.get(kind, 0)
+            rows[kind] = {
+                'sent': sent,
+                'received': self.received.get(kind, 0),
+                'errors': errors,
+                'error_rate': (errors / sent) if sent else 0.0,
+                'sent_per_sec': sent / elapsed if elapsed else 0.0,
+                'received_per_sec': self.received.get(kind, 0) / elapsed if elapsed else 0.0,
+                'p50_ms': percentile(lat, 50),
+                'p90_ms': percentile(lat, 90),
+                'p99_ms': percentile(lat, 99),
+                'max_ms': lat[-1] if lat else None,
+            }
+        rss = [kb for _, kb in self.rss_samples if kb is not None]
+        return {
+            'elapsed_sec': elapsed,
+            'types': rows,
+            'server_rss_kb': {
+                'start': rss[0] if rss else None,
+                'peak': max(rss) if rss else None,
+                'end': rss[-1] if rss else None,
+            },
+        }
+
+
+def print_report(report):
+    def fmt(v):
+        return '-' if v is None else f"{v:.1f}"
+
+    print(f"\n=== Load test: {report['elapsed_sec']:.1f}s ===")
+    print(f"{'type':<14}{'sent':>9}{'recv':>9}{'err':>7}{'err%':>7}{'sent/s':>9}{'recv/s':>9}"
+          f"{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}")
+    for kind, r in report['types'].items():
+        print(f"{kind:<14}{r['sent']:>9}{r['received']:>9}{r['errors']:>7}{r['error_rate'] * 100:>6.1f}%"
+              f"{r['sent_per_sec']:>9.1f}{r['received_per_sec']:>9.1f}"
+              f"{fmt(r['p50_ms']):>8}{fmt(r['p90_ms']):>8}{fmt(r['p99_ms']):>8}{fmt(r['max_ms']):>8}")
+    rss = report['server_rss_kb']
+    if rss['peak'] is not None:
+        print(f"server RSS (MB): start {rss['start'] / 1024:.1f}, peak {rss['peak'] / 1024:.1f}, "
+              f"end {rss['end'] / 1024:.1f}")
+
+
+def stamp():
+    return time.perf_counter()
+
+
+class SimUser:
+    """Một người dùng mô phỏng với partner (bạn) và các nhóm đã tham gia."""
+
+    def __init__(self, harness, index):
+        self.harness = harness
+        self.index = index
+        self.username = f"{harness.prefix}_{index}"
+        self.password = 'pw'
+        self.partner = None
+        self.groups = []
+        self.client = None
+
+    def _new_client(self):
+        client = AsyncChatClient(self.harness.host, self.harness.port,
+                                 request_timeout=self.harness.args.timeout)
+        client.on(protocol.MSG_PRIVATE, self._on_private)
+        client.on(protocol.MSG_GROUP, self._on_group)
+        client.on('ERROR', self._on_error)
+        return client
+
+    # Payload tin nhắn: "<kind>|<perf_counter lúc gửi>|<nội dung>"
+    def _on_private(self, payload):
+        self._record(payload)
+
+    def _on_group(self, payload):
+        self._record(payload)
+
+    def _on_error(self, payload):
+        self.harness.stats.on_error('server_error')
+
+    def _record(self, payload):
+        content = payload.get('content') if isinstance(payload, dict) else None
+        if not isinstance(content, str) or 'timestamp' in payload:
+            return
+        parts = content.split('|', 2)
+        if len(parts) != 3:
+            return
+        kind, sent_at, body = parts
+        try:
+            latency = (stamp() - float(sent_at)) * 1000
+        except ValueError:
+            return
+        self.harness.stats.on_received(kind, latency)
+        if kind == 'dm' and body == 'ping' and payload.get('sender') == self.partner and self.harness.running:
+            # Ping-pong: trả lời ngay cho partner
+            asyncio.ensure_future(self._reply())
+
+    async def _reply(self):
+        try:
+            await self.client.send_private(self.partner, f"dm|{stamp()}|pong")
+            self.harness.stats.on_sent('dm')
+        except Exception:
+            self.harness.stats.on_error('dm')
+
+    async def setup(self):
+        self.client = self._new_client()
+        ok, _ = await self.client.register(self.username, self.password)
+        if not ok:
+            raise RuntimeError(f"register failed for {self.username}")
+        await self.client.disconnect()
+
+    async def login(self):
+        self.client = self._new_client()
+        start = stamp()
+        self.harness.stats.on_sent('login')
+        try:
+            ok, _ = await self.client.login(self.username, self.password)
+        except Exception:
+            ok = False
+        if ok:
+            self.harness.stats.on_received('login', (stamp() - start) * 1000)
+        else:
+            self.harness.stats.on_error('login')
+        return ok
+
+    async def act(self, behavior):
+        stats = self.harness.stats
+        client = self.client
+        try:
+            if behavior == 'dm' and self.partner:
+                stats.on_sent('dm')
+                await client.send_private(self.partner, f"dm|{stamp()}|ping")
+            elif behavior == 'group' and self.groups:
+                stats.on_sent('group')
+                await client.send_group(random.choice(self.groups), f"group|{stamp()}|hello")
+            elif behavior == 'typing':
+                mode, target = ('private', self.partner) if self.partner else ('public', None)
+                if self.groups and random.random() < 0.5:
+                    mode, target = 'group', random.choice(self.groups)
+                stats.on_sent('typing', 2)
+                await client.send_typing(mode, target, True)
+                await client.send_typing(mode, target, False)
+            elif behavior == 'history':
+                if self.groups and random.random() < 0.5:
+                    history_type, target = 'group', random.choice(self.groups)
+                else:
+                    history_type, target = 'private', self.username
+                stats.on_sent('history')
+                start = stamp()
+                _, before_id = await client.get_history(history_type, target, limit=20)
+                if before_id is not None:
+                    await client.get_history(history_type, target, before_id=before_id, limit=20)
+                stats.on_received('history', (stamp() - start) * 1000)
+            elif behavior == 'file':
+                stats.on_sent('file')
+                start = stamp()
+                receiver = self.partner if self.partner else None
+                await client.send_file(self.harness.sample_file, receiver=receiver)
+                stats.on_received('file', (stamp() - start) * 1000)
+            elif behavior == 'login':
+                await client.disconnect()
+                await self.login()
+        except (ChatRequestError, asyncio.TimeoutError, ConnectionError, OSError):
+            stats.on_error(behavior)
+        except Exception:
+            stats.on_error(behavior)
+
+    async def run(self, deadline, mix):
+        names = list(mix)
+        weights = [mix[n] for n in names]
+        think = self.harness.args.think
+        while self.harness.running and time.time() < deadline:
+            await asyncio.sleep(random.expovariate(1.0 / think) if think > 0 else 0)
+            if not self.harness.running:
+                break
+            await self.act(random.choices(names, weights)[0])
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.host = args.host
+        self.port = args.port
+        self.prefix = f"lt{uuid.uuid4().hex[:6]}"
+        self.stats = Stats()
+        self.users = []
+        self.running = False
+        self.server_proc = None
+        self.server_pid = args.server_pid
+        self.sample_file = None
+        self._tmp_db = None
+
+    # --- Server cục bộ ---
+
+    def spawn_server(self):
+        fd, self._tmp_db = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        if not self.port:
+            s = socket.socket()
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+            s.close()
+        env = dict(os.environ, PORT=str(self.port))
+        env.pop('DATABASE_URL', None)
+        self.server_proc = subprocess.Popen([sys.executable, '-c', SERVER_BOOT, ROOT, self._tmp_db],
+                                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.server_pid = self.server_proc.pid
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                socket.create_connection((self.host, self.port), timeout=0.2).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("server did not start")
+
+    def stop_server(self):
+        if self.server_proc:
+            self.server_proc.terminate()
+            self.server_proc.wait(timeout=10)
+        if self._tmp_db:
+            try:
+                os.remove(self._tmp_db)
+            except OSError:
+                pass
+
+    async def sample_rss(self):
+        while self.running:
+            if self.server_pid:
+                self.stats.rss_samples.append((time.time(), read_rss_kb(self.server_pid)))
+            await asyncio.sleep(1.0)
+
+    # --- Các giai đoạn ---
+
+    async def _bounded(self, coros):
+        sem = asyncio.Semaphore(self.args.concurrency)
+
+        async def run(coro):
+            async with sem:
+                return await coro
+
+        return await asyncio.gather(*(run(c) for c in coros), return_exceptions=True)
+
+    async def setup(self):
+        args = self.args
+        self.users = [SimUser(self, i) for i in range(args.users)]
+        print(f"[loadgen] registering {args.users} users...")
+        await self._bounded([u.setup() for u in self.users])
+
+        print("[loadgen] login storm...")
+        start = stamp()
+        results = await self._bounded([u.login() for u in self.users])
+        ok = sum(1 for r in results if r is True)
+        print(f"[loadgen] {ok}/{len(self.users)} logged in in {stamp() - start:.2f}s")
+
+        # Kết bạn theo cặp (0-1, 2-3, ...)
+        pairs = [(self.users[i], self.users[i + 1]) for i in range(0, len(self.users) - 1, 2)]
+
+        async def befriend(a, b):
+            await a.client.request_friend(b.username)
+            await b.client.accept_friend(a.username)
+            a.partner, b.partner = b.username, a.username
+
+        await self._bounded([befriend(a, b) for a, b in pairs])
+
+        # Tạo nhóm (mỗi nhóm tối thiểu 3 thành viên)
+        size = max(3, args.group_size)
+
+        async def make_group(members):
+            creator = members[0]
+            name = f"{self.prefix}_g{creator.index}"
+            await creator.client.create_group(name, [m.username for m in members[1:]])
+            for g in await creator.client.get_groups():
+                if g['name'] == name:
+                    for m in members:
+                        m.groups.append(g['id'])
+                    return
+
+        chunks = [self.users[i:i + size] for i in range(0, len(self.users), size)]
+        await self._bounded([make_group(c) for c in chunks if len(c) >= 3])
+
+        fd, self.sample_file = tempfile.mkstemp(suffix='.bin')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(args.file_size))
+
+    async def run(self):
+        args = self.args
+        mix = parse_mix(args.mix)
+        await self.setup()
+        # Không tính các message của giai đoạn setup (trừ login)
+        login_stats = (self.stats.sent.get('login', 0), self.stats.received.get('login', 0),
+                       self.stats.errors.get('login', 0), self.stats.latencies.get('login', []))
+        self.stats = Stats()
+        self.stats.sent['login'], self.stats.received['login'], self.stats.errors['login'], lat = login_stats
+        self.stats.latencies['login'] = list(lat)
+
+        self.running = True
+        rss_task = asyncio.ensure_future(self.sample_rss())
+        print(f"[loadgen] running mix {mix} for {args.duration}s...")
+        start = time.time()
+        deadline = start + args.duration
+        await asyncio.gather(*(u.run(deadline, mix) for u in self.users), return_exceptions=True)
+        # Chờ các tin nhắn đang bay tới nơi
+        await asyncio.sleep(args.drain)
+        elapsed = time.time() - start
+        self.running = False
+        await rss_task
+        if self.server_pid:
+            self.stats.rss_samples.append((time.time(), read_rss_kb(self.server_pid)))
+
+        await self._bounded([u.client.disconnect() for u in self.users if u.client])
+        os.remove(self.sample_file)
+        return self.stats.report(elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate many concurrent chat users")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 0)) or None)
+    parser.add_argument('--spawn-server', action='store_true', help="start a local server with a temp database")
+    parser.add_argument('--server-pid', type=int, help="pid of an already running server (for RSS sampling)")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--think', type=float, default=1.0, help="mean seconds between actions per user")
+    parser.add_argument('--group-size', type=int, default=5)
+    parser.add_argument('--file-size', type=int, default=16 * 1024)
+    parser.add_argument('--concurrency', type=int, default=200, help="max concurrent setup/login operations")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to wait for in-flight messages")
+    parser.add_argument('--json', help="write the report as JSON to this path")
+    args = parser.parse_args(argv)
+
+    if not args.spawn_server and not args.port:
+        parser.error("--port is required unless --spawn-server is given")
+    parse_mix(args.mix)
+    raise_fd_limit()
+
+    harness = Harness(args)
+    if args.spawn_server:
+        harness.spawn_server()
+    try:
+        report = asyncio.run(harness.run())
+    finally:
+        harness.stop_server()
+
+    report['config'] = {k: v for k, v in vars(args).items() if k != 'json'}
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+
+import unittest
+import sys
+import os
+import asyncio
+import socket
+import subprocess
+import tempfile
+import time
+
+# Add project root to path
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.append(ROOT)
+
+try:
+    import aiohttp  # socketio.AsyncClient cần aiohttp
+except ImportError:
+    aiohttp = None
+
+from src.common import protocol
+
+# Chạy server thật trong process riêng với database tạm
+SERVER_BOOT = (
+    "import sys; sys.path.insert(0, sys.argv[1]);"
+    "import src.server.db as db_module; db_module.DB_PATH = sys.argv[2];"
+    "from src.server.main import main; main()"
+)
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp is required for socketio.AsyncClient")
+class TestAsyncChatClient(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        fd, cls.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        cls.port = free_port()
+        env = dict(os.environ, PORT=str(cls.port))
+        env.pop('DATABASE_URL', None)
+        cls.proc = subprocess.Popen([sys.executable, '-c', SERVER_BOOT, ROOT, cls.db_path],
+                                    env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', cls.port), timeout=0.2).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proc.terminate()
+        cls.proc.wait(timeout=10)
+        try:
+            os.remove(cls.db_path)
+        except OSError:
+            pass
+
+    def test_login_private_and_history_paging(self):
+        from src.client.async_client import AsyncChatClient, ChatRequestError
+
+        async def scenario():
+            alice = AsyncChatClient(port=self.port)
+            bob = AsyncChatClient(port=self.port)
+            ok, _ = await alice.register('alice_async', 'pw')
+            self.assertTrue(ok)
+            await alice.disconnect()
+            ok, _ = await bob.register('bob_async', 'pw')
+            self.assertTrue(ok)
+            await bob.disconnect()
+
+            alice = AsyncChatClient(port=self.port)
+            bob = AsyncChatClient(port=self.port)
+            ok, _ = await alice.login('alice_async', 'pw')
+            self.assertTrue(ok)
+            ok, _ = await bob.login('bob_async', 'pw')
+            self.assertTrue(ok)
+
+            # Sai mật khẩu -> (False, lỗi)
+            mallory = AsyncChatClient(port=self.port)
+            ok, err = await mallory.login('alice_async', 'wrong')
+            self.assertFalse(ok)
+            self.assertIn('Invalid', err)
+            await mallory.disconnect()
+
+            await alice.request_friend('bob_async')
+            await bob.accept_friend('alice_async')
+
+            received = bob.wait_for(protocol.MSG_PRIVATE)
+            for i in range(5):
+                await alice.send_private('bob_async', f'msg {i}')
+            msg = await received
+            self.assertEqual(msg['payload']['sender'], 'alice_async')
+
+            # Đợi bob nhận đủ 5 tin trước khi đọc lịch sử
+            await asyncio.sleep(0.3)
+            rows, next_before = await alice.get_history('private', 'alice_async', limit=3)
+            self.assertEqual([r['content'] for r in rows], ['msg 2', 'msg 3', 'msg 4'])
+            self.assertIsNotNone(next_before)
+            rows, next_before = await alice.get_history('private', 'alice_async', before_id=next_before, limit=3)
+            self.assertEqual([r['content'] for r in rows], ['msg 0', 'msg 1'])
+            self.assertIsNone(next_before)
+            # before_id không phải số: ERROR ngay, không treo tới timeout
+            for bad in ('abc', [1]):
+                with self.assertRaises(ChatRequestError):
+                    await alice.get_history('private', 'alice_async', before_id=bad, limit=3)
+
+            await alice.disconnect()
+            await bob.disconnect()
+
+        asyncio.run(scenario())
+
+    def test_file_upload(self):
+        from src.client.async_client import AsyncChatClient
+
+        async def scenario():
+            client = AsyncChatClient(port=self.port)
+            await client.register('carol_async', 'pw')
+            ok, _ = await client.login('carol_async', 'pw')
+            self.assertTrue(ok)
+            fd, path = tempfile.mkstemp(suffix='.bin')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(os.urandom(10000))
+            try:
+                info = await client.send_file(path)
+                self.assertEqual(info['filename'], os.path.basename(path))
+                self.assertEqual(info['filesize'], 10000)
+            finally:
+                os.remove(path)
+                await client.disconnect()
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+from helpers import ServerTestCase, received, of_type, db
+from src.common import protocol
+
+
+class TestBootstrap(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('alice', 'bob', 'carol', 'dave'):
+            db.register_user(name, 'pw')
+        db.update_user_display_name('bob', 'Bob B.')
+        db.request_friend('alice', 'bob')
+        db.accept_friend('bob', 'alice')
+        db.request_friend('carol', 'alice')
+        db.request_friend('alice', 'dave')
+        self.gid = db.create_group('Team', 'bob')
+        db.add_member_to_group(self.gid, 'bob')
+        db.add_member_to_group(self.gid, 'alice')
+        db.save_message('bob', 'chào', receiver='alice', message_type='private', deliver_later=True)
+        db.save_message('bob', 'họp', receiver=self.gid, message_type='group')
+
+    def query_count(self):
+        return sum(r['calls'] for r in db.query_stats.snapshot())
+
+    def test_login_sends_one_bootstrap_frame(self):
+        self.login('bob')
+        db.friend_cache.clear()
+        db.group_cache.clear()
+        before = self.query_count()
+        _, messages = self.login('alice', bootstrap=True)
+        login_queries = self.query_count() - before
+
+        (boot,) = of_type(messages, protocol.MSG_BOOTSTRAP)
+        self.assertEqual(boot['friends'], [{'username': 'bob', 'display_name': 'Bob B.',
+                                            'last_login': boot['friends'][0]['last_login'], 'status': 'online'}])
+        self.assertEqual(boot['pending'], [{'username': 'carol', 'display_name': 'carol'}])
+        self.assertEqual(boot['sent'], [{'username': 'dave', 'display_name': 'dave'}])
+        self.assertEqual(([g['name'] for g in boot['groups']], boot['group_ids']), (['Team'], [self.gid]))
+        self.assertEqual([(c['type'], c['target'], c['unread']) for c in boot['conversations']],
+                         [('group', self.gid, 1), ('private', 'bob', 1)])
+        self.assertCountEqual(boot['unread'], [{'type': 'private', 'target': 'bob', 'count': 1},
+                                               {'type': 'group', 'target': self.gid, 'count': 1}])
+        # Thay cho FRIEND_LIST / USER_GROUPS; tin chờ giao vẫn tới, không lặp lại số chưa đọc
+        self.assertEqual(of_type(messages, protocol.MSG_FRIEND_LIST) + of_type(messages, 'USER_GROUPS'), [])
+        (offline,) = of_type(messages, protocol.MSG_OFFLINE_MESSAGES)
+        self.assertEqual(([m['content'] for m in offline['messages']], offline['unread']), (['chào'], None))
+
+        # login (1), bootstrap (3), hàng chờ (1), display name cho users list (1)
+        self.assertLessEqual(login_queries, 6)
+        # Cache bạn bè / nhóm đã được nạp sẵn
+        before = self.query_count()
+        self.assertEqual(db.get_friend_names('alice'), {'bob'})
+        self.assertEqual(db.get_user_group_ids('alice'), {self.gid})
+        self.assertEqual(self.query_count(), before)
+
+        # Phòng nhóm đã được join
+        self.clients[0].emit('message', {'type': protocol.MSG_GROUP, 'payload': {'group_id': self.gid, 'content': 'hi'}})
+        self.assertEqual([p['content'] for p in of_type(received(self.clients[1]), protocol.MSG_GROUP)], ['hi'])
+
+    def test_login_without_bootstrap_keeps_old_frames(self):
+        _, messages = self.login('alice')
+        self.assertEqual(of_type(messages, protocol.MSG_BOOTSTRAP), [])
+        self.assertEqual(of_type(messages, 'USER_GROUPS'), [[self.gid]])
+        (friends,) = of_type(messages, protocol.MSG_FRIEND_LIST)
+        self.assertEqual([f['username'] for f in friends['friends']], ['bob'])
+        self.assertIsNotNone(of_type(messages, protocol.MSG_OFFLINE_MESSAGES)[0]['unread'])
+
+    def test_wrong_password_is_rejected_in_one_statement(self):
+        self.assertFalse(db.login_user('alice', 'sai'))
+        self.assertFalse(db.login_user('nobody', 'pw'))
+        db.execute_query("UPDATE users SET is_active = 0 WHERE username = 'dave'")
+        db.conn.commit()
+        self.assertFalse(db.login_user('dave', 'pw'))
+        self.assertTrue(db.login_user('alice', 'pw'))
+
+
+if __name__ == '__main__':
+    unittest.main()
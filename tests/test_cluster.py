@@ -0,0 +1,121 @@
+import unittest
+import sys
+import os
+import asyncio
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+
+# Add project root to path
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.append(ROOT)
+
+try:
+    import aiohttp  # socketio.AsyncClient cần aiohttp
+except ImportError:
+    aiohttp = None
+
+from src.server.cluster import route_slot
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def child_pids(pid):
+    """Các process con trực tiếp của pid (đọc /proc)."""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+class TestRouting(unittest.TestCase):
+    def test_same_ip_same_worker(self):
+        self.assertEqual(route_slot('10.0.0.7', 16), route_slot('10.0.0.7', 16))
+        slots = {route_slot(f'10.0.{i // 256}.{i % 256}', 8) for i in range(1000)}
+        self.assertEqual(slots, set(range(8)))
+
+
+@unittest.skipIf(aiohttp is None or not sys.platform.startswith('linux'),
+                 "needs aiohttp and Linux /proc")
+class TestClusterLauncher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.port = free_port()
+        env = dict(os.environ, CHAT_DB_PATH=os.path.join(cls.tmp, 'chat.db'),
+                   CHAT_FILES_DIR=os.path.join(cls.tmp, 'files'))
+        env.pop('DATABASE_URL', None)
+        env.pop('CHAT_MESSAGE_QUEUE', None)
+        cls.proc = subprocess.Popen([sys.executable, '-m', 'src.server.cluster', '--workers', '2',
+                                     '--host', '127.0.0.1', '--port', str(cls.port),
+                                     '--graceful-timeout', '5'],
+                                    cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 30
+        while time.time() < deadline and len(child_pids(cls.proc.pid)) < 2:
+            time.sleep(0.1)
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', cls.port), timeout=0.2).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.proc.poll() is None:
+            cls.proc.kill()
+            cls.proc.wait()
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def login_roundtrip(self, username):
+        from src.client.async_client import AsyncChatClient
+
+        async def scenario():
+            client = AsyncChatClient(port=self.port)
+            await client.register(username, 'pw')
+            ok, _ = await client.login(username, 'pw')
+            await client.disconnect()
+            return ok
+
+        return asyncio.run(scenario())
+
+    def test_rolling_restart_and_shutdown(self):
+        self.assertTrue(self.login_roundtrip('cluster_a'))
+        before = child_pids(self.proc.pid)
+        self.assertEqual(len(before), 2)
+
+        self.proc.send_signal(signal.SIGHUP)
+        deadline = time.time() + 30
+        after = before
+        while time.time() < deadline:
+            after = child_pids(self.proc.pid)
+            if len(after) == 2 and not set(after) & set(before):
+                break
+            time.sleep(0.2)
+        self.assertEqual(len(after), 2)
+        self.assertFalse(set(after) & set(before))
+        self.assertTrue(self.login_roundtrip('cluster_b'))
+
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(timeout=20), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import os
+import tempfile
+
+from helpers import ServerTestCase, received, of_type, db
+import src.server.db as db_module
+from src.common import protocol
+
+
+def summary(conversations):
+    return [(c['type'], c['target'], c['last_sender'], c['preview'], c['unread']) for c in conversations]
+
+
+class TestConversationsTable(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self._old_path = db_module.DB_PATH
+        db_module.DB_PATH = os.path.join(self.dir.name, 'chat.db')
+        self.db = db_module.Database()
+        for name in ('alice', 'bob', 'carol'):
+            self.db.register_user(name, 'pw')
+        self.db.update_user_display_name('bob', 'Bob B.')
+        self.gid = self.db.create_group('Team', 'alice')
+        self.db.add_member_to_group(self.gid, 'bob')
+
+    def tearDown(self):
+        self.db.close()
+        db_module.DB_PATH = self._old_path
+        self.dir.cleanup()
+
+    def test_updated_with_each_message_and_sorted_by_last_message(self):
+        self.db.save_message('alice', 'chào bob', receiver='bob', message_type='private')
+        self.db.save_message('bob', 'x' * 300, receiver=self.gid, message_type='group')
+        self.db.save_message('carol', 'chào alice', receiver='alice', message_type='private')
+        self.db.save_message('bob', 'trả lời', receiver='alice', message_type='private')
+
+        conversations, cursor = self.db.get_conversations('alice')
+        self.assertIsNone(cursor)
+        self.assertEqual(summary(conversations), [
+            ('private', 'bob', 'bob', 'trả lời', 1),
+            ('private', 'carol', 'carol', 'chào alice', 1),
+            ('group', self.gid, 'bob', 'x' * self.db.PREVIEW_CHARS, 1),
+        ])
+        self.assertEqual([c['name'] for c in conversations], ['Bob B.', 'carol', 'Team'])
+        # Tin của chính mình không tính là chưa đọc (tin của alice trước đó vẫn còn)
+        self.assertEqual([c['unread'] for c in self.db.get_conversations('bob')[0]], [1, 0])
+
+        page, cursor = self.db.get_conversations('alice', limit=2)
+        self.assertEqual(len(page), 2)
+        rest, cursor = self.db.get_conversations('alice', limit=2, before=cursor)
+        self.assertEqual(([c['target'] for c in rest], cursor), ([self.gid], None))
+
+        # Thành viên mới thấy ngay nhóm với tin cuối, chưa đọc = 0
+        self.db.add_member_to_group(self.gid, 'carol')
+        self.assertEqual(summary(self.db.get_conversations('carol')[0])[1], ('group', self.gid, 'bob', 'x' * 100, 0))
+
+        plan = ' '.join(self.db.explain(
+            "SELECT kind FROM conversations WHERE username = ? AND last_message_id IS NOT NULL "
+            "ORDER BY last_message_id DESC LIMIT ?", ('alice', 50)))
+        self.assertIn('idx_conversations_recent', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_failed_membership_change_is_rolled_back(self):
+        self.db.execute_query("DROP TABLE conversations")
+        self.assertFalse(self.db.add_member_to_group(self.gid, 'carol'))
+        self.assertFalse(self.db.remove_member_from_group(self.gid, 'bob'))
+        # Lần ghi tiếp theo không commit nốt phần dở dang của hai lệnh trên
+        self.db.register_user('dave', 'pw')
+        self.assertCountEqual(self.db.get_group_members(self.gid), ['alice', 'bob'])
+        count = self.db.execute_query("SELECT member_count FROM groups WHERE id = ?", (self.gid,)).fetchone()
+        self.assertEqual(count['member_count'], 2)
+
+    def test_old_table_is_migrated_and_backfilled(self):
+        self.db.save_message('alice', 'một', receiver='bob', message_type='private')
+        self.db.save_message('bob', 'hai', receiver=self.gid, message_type='group')
+        # Bảng conversations kiểu cũ: chỉ có số chưa đọc
+        self.db.execute_query("DROP TABLE conversations")
+        self.db.execute_query("CREATE TABLE conversations (username TEXT NOT NULL, kind TEXT NOT NULL, "
+                              "target TEXT NOT NULL, unread_count INTEGER NOT NULL DEFAULT 0, "
+                              "PRIMARY KEY (username, kind, target))")
+        self.db.execute_query("INSERT INTO conversations VALUES ('bob', 'private', 'alice', 3)")
+        self.db.conn.commit()
+        self.db.close()
+
+        self.db = db_module.Database()
+        self.assertEqual(summary(self.db.get_conversations('bob')[0]), [
+            ('group', self.gid, 'bob', 'hai', 0),
+            ('private', 'alice', 'alice', 'một', 3),
+        ])
+        self.assertEqual(summary(self.db.get_conversations('alice')[0])[1], ('private', 'bob', 'alice', 'một', 0))
+
+
+class TestConversationsRequest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('alice', 'bob'):
+            db.register_user(name, 'pw')
+        db.request_friend('alice', 'bob')
+        db.accept_friend('bob', 'alice')
+        self.client, _ = self.login('alice')
+
+    def test_request_returns_sorted_list(self):
+        self.client.emit('message', {'type': protocol.MSG_PRIVATE, 'payload': {'receiver': 'bob', 'content': 'chào'}})
+        self.client.emit('message', {'type': protocol.MSG_CONVERSATIONS, 'payload': None})
+        (result,) = of_type(received(self.client), protocol.MSG_CONVERSATIONS_RESULT)
+        self.assertEqual(summary(result['conversations']), [('private', 'bob', 'alice', 'chào', 0)])
+        self.assertIsNone(result['next_cursor'])
+
+        self.client.emit('message', {'type': protocol.MSG_CONVERSATIONS, 'payload': {'cursor': 'x'}})
+        self.assertEqual(of_type(received(self.client), 'ERROR'), ['Invalid message format'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+
+from helpers import ServerTestCase, received, of_type, db
+from src.server.server import message_log
+from src.server.delivery import RecentMessages
+from src.common import protocol
+
+
+def message(seq, sender='alice', receiver='bob', message_type='private'):
+    return {'id': seq, 'sender': sender, 'receiver': receiver, 'content': f'tin {seq}',
+            'message_type': message_type, 'timestamp': '2025-01-01 00:00:00'}
+
+
+class TestRecentMessages(unittest.TestCase):
+    def test_answers_only_when_every_message_after_since_is_known(self):
+        log = RecentMessages(size=4)
+        self.assertIsNone(log.since(0, 'bob', set(), 10))
+        for seq in (10, 11, 12):
+            log.record(message(seq))
+        log.record(message(13, receiver='5', message_type='group'))
+        self.assertEqual([m['id'] for m in log.since(10, 'bob', {'5'}, 10)], [11, 12, 13])
+        self.assertEqual([m['id'] for m in log.since(9, 'bob', set(), 10)], [10, 11, 12])
+        self.assertEqual([m['id'] for m in log.since(9, 'bob', set(), 2)], [10, 11])
+        # Tin của chính mình cũng được replay (cho các phiên khác); tin của người khác thì không
+        self.assertEqual([m['id'] for m in log.since(9, 'alice', set(), 10)], [10, 11, 12])
+        self.assertEqual(log.since(9, 'carol', set(), 10), [])
+        self.assertIsNone(log.since(8, 'bob', set(), 10))
+
+        # Tràn vòng: tin cũ nhất bị đẩy ra, mốc trước nó không còn trả lời được
+        log.record(message(14))
+        self.assertIsNone(log.since(9, 'bob', set(), 10))
+        self.assertEqual([m['id'] for m in log.since(10, 'bob', set(), 10)], [11, 12, 14])
+
+        # Nhảy id (tin 15 ghi ở nơi khác): chỉ trả lời từ sau chỗ hở
+        log.record(message(16))
+        self.assertIsNone(log.since(14, 'bob', set(), 10))
+        self.assertEqual(log.since(15, 'bob', set(), 10), [message(16)])
+        self.assertEqual(log.stats(), {'size': 4, 'floor': 15, 'newest': 16})
+
+
+class TestSync(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        message_log.clear()
+        for name in ('alice', 'bob', 'carol'):
+            db.register_user(name, 'pw')
+        db.request_friend('alice', 'bob')
+        db.accept_friend('bob', 'alice')
+        self.gid = db.create_group('Team', 'carol')
+        db.add_member_to_group(self.gid, 'bob')
+
+    def tearDown(self):
+        super().tearDown()
+        message_log.clear()
+
+    def send(self, client, msg_type, payload):
+        client.emit('message', {'type': msg_type, 'payload': payload})
+
+    def test_reconnect_replays_exactly_the_missed_messages(self):
+        alice, _ = self.login('alice')
+        carol, _ = self.login('carol')
+        bob, _ = self.login('bob')
+        self.send(alice, protocol.MSG_PRIVATE, {'receiver': 'bob', 'content': 'một'})
+        (live,) = of_type(received(bob), protocol.MSG_PRIVATE)
+        last_seq = live['seq']
+
+        # Mạng chập chờn: server vẫn tưởng bob online nên tin không vào hàng chờ
+        self.send(alice, protocol.MSG_PRIVATE, {'receiver': 'bob', 'content': 'hai'})
+        self.send(carol, protocol.MSG_GROUP, {'group_id': self.gid, 'content': 'ba'})
+        bob.disconnect()
+        self.clients.remove(bob)
+        self.send(alice, protocol.MSG_PRIVATE, {'receiver': 'bob', 'content': 'bốn'})
+        self.assertEqual(db.get_pending_messages('bob')[0][0]['content'], 'bốn')
+
+        bob, messages = self.login('bob', since_seq=last_seq)
+        (frame,) = of_type(messages, protocol.MSG_OFFLINE_MESSAGES)
+        self.assertEqual([m['content'] for m in frame['messages']], ['hai', 'ba', 'bốn'])
+        self.assertEqual(frame['messages'][1]['receiver'], str(self.gid))
+        self.send(bob, protocol.MSG_ACK, {'seq': frame['seq']})
+        self.assertEqual(db.get_pending_messages('bob')[0], [])
+
+        # SYNC giữa phiên: từ vòng trong bộ nhớ, rồi từ database khi vòng không đủ
+        self.send(bob, protocol.MSG_SYNC, {'since_seq': last_seq, 'limit': 2})
+        (page,) = of_type(received(bob), protocol.MSG_SYNC_RESULT)
+        self.assertEqual(([m['content'] for m in page['messages']], page['more'], page['source']),
+                         (['hai', 'ba'], True, 'buffer'))
+        message_log.clear()
+        self.send(bob, protocol.MSG_SYNC, {'since_seq': page['seq']})
+        (page,) = of_type(received(bob), protocol.MSG_SYNC_RESULT)
+        self.assertEqual(([m['content'] for m in page['messages']], page['more'], page['source']),
+                         (['bốn'], False, 'db'))
+        self.assertEqual(page['seq'], frame['seq'])
+
+        self.send(bob, protocol.MSG_SYNC, {'since_seq': 'x'})
+        self.assertEqual(of_type(received(bob), 'ERROR'), ['Invalid message format'])
+
+    def test_reconnect_replays_own_messages_sent_from_another_session(self):
+        alice, _ = self.login('alice')
+        alice_web, _ = self.login('alice')
+        self.login('bob')
+        self.login('carol')
+        self.send(alice_web, protocol.MSG_PRIVATE, {'receiver': 'bob', 'content': 'chào'})
+        (live,) = of_type(received(alice), protocol.MSG_PRIVATE)
+        last_seq = live['seq']
+        # Phiên gửi không nhận lại tin, chỉ nhận seq của nó
+        self.assertEqual(of_type(received(alice_web), protocol.MSG_SENT), [{'seq': last_seq}])
+
+        alice.disconnect()
+        self.clients.remove(alice)
+        self.send(alice_web, protocol.MSG_PRIVATE, {'receiver': 'bob', 'content': 'một'})
+        self.send(self.clients[-1], protocol.MSG_GROUP, {'group_id': self.gid, 'content': 'nhóm'})
+        self.send(self.clients[-2], protocol.MSG_PRIVATE, {'receiver': 'alice', 'content': 'hai'})
+
+        _, messages = self.login('alice', since_seq=last_seq)
+        (frame,) = of_type(messages, protocol.MSG_OFFLINE_MESSAGES)
+        self.assertEqual([(m['sender'], m['content']) for m in frame['messages']], [('alice', 'một'), ('bob', 'hai')])
+        # Database (ngoài vòng trong bộ nhớ) trả về cùng các tin
+        message_log.clear()
+        self.assertEqual(db.get_messages_since('alice', last_seq), frame['messages'])
+        self.assertEqual([m['content'] for m in db.get_messages_since('bob', last_seq)], ['một', 'nhóm', 'hai'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+
+import unittest
+import sys
+import os
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+from src.server.dispatcher import Dispatcher, LatencyHistogram
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.sessions = {'sid-1': 'alice'}
+        self.rejected = []
+        self.dispatcher = Dispatcher(
+            get_username=self.sessions.get,
+            on_unauthorized=lambda ctx: self.rejected.append(('auth', ctx.msg_type)),
+            on_invalid=lambda ctx: self.rejected.append(('invalid', ctx.msg_type)),
+        )
+
+    def test_routes_by_type_with_username(self):
+        seen = []
+
+        @self.dispatcher.route('PING', payload=dict)
+        def on_ping(ctx):
+            seen.append((ctx.sid, ctx.username, ctx.payload))
+            return 'pong'
+
+        result = self.dispatcher.dispatch('sid-1', {'type': 'PING', 'payload': {'x': 1}})
+        self.assertEqual(result, 'pong')
+        self.assertEqual(seen, [('sid-1', 'alice', {'x': 1})])
+        # Unknown type and non-dict frames are ignored
+        self.assertIsNone(self.dispatcher.dispatch('sid-1', {'type': 'NOPE'}))
+        self.assertIsNone(self.dispatcher.dispatch('sid-1', 'garbage'))
+
+    def test_auth_and_validation_middleware(self):
+        calls = []
+
+        @self.dispatcher.route('SECRET', payload=dict)
+        def on_secret(ctx):
+            calls.append(ctx.username)
+
+        @self.dispatcher.route('OPEN', auth=False)
+        def on_open(ctx):
+            calls.append(ctx.username)
+
+        self.dispatcher.dispatch('sid-unknown', {'type': 'SECRET', 'payload': {}})
+        self.dispatcher.dispatch('sid-1', {'type': 'SECRET', 'payload': 'not a dict'})
+        self.dispatcher.dispatch('sid-unknown', {'type': 'OPEN', 'payload': None})
+        self.assertEqual(self.rejected, [('auth', 'SECRET'), ('invalid', 'SECRET')])
+        self.assertEqual(calls, [None])
+
+    def test_custom_middleware_order(self):
+        order = []
+
+        def outer(ctx, call_next):
+            order.append('outer')
+            return call_next(ctx)
+
+        def inner(ctx, call_next):
+            order.append('inner')
+            return call_next(ctx)
+
+        @self.dispatcher.route('X', middleware=(outer, inner))
+        def on_x(ctx):
+            order.append('handler')
+
+        self.dispatcher.dispatch('sid-1', {'type': 'X'})
+        self.assertEqual(order, ['outer', 'inner', 'handler'])
+
+    def test_per_handler_histogram_counts_errors(self):
+        @self.dispatcher.route('BOOM')
+        def on_boom(ctx):
+            raise RuntimeError('boom')
+
+        @self.dispatcher.route('OK')
+        def on_ok(ctx):
+            pass
+
+        with self.assertRaises(RuntimeError):
+            self.dispatcher.dispatch('sid-1', {'type': 'BOOM'})
+        self.dispatcher.dispatch('sid-1', {'type': 'OK'})
+        self.dispatcher.dispatch('sid-1', {'type': 'OK'})
+
+        stats = self.dispatcher.snapshot()
+        self.assertEqual(stats['BOOM']['count'], 1)
+        self.assertEqual(stats['BOOM']['errors'], 1)
+        self.assertEqual(stats['OK']['count'], 2)
+        self.assertEqual(stats['OK']['buckets']['+Inf'], 2)
+
+    def test_duplicate_registration_rejected(self):
+        self.dispatcher.route('DUP')(lambda ctx: None)
+        with self.assertRaises(ValueError):
+            self.dispatcher.route('DUP')(lambda ctx: None)
+
+    def test_histogram_quantile(self):
+        h = LatencyHistogram(buckets=(0.01, 0.1, 1.0))
+        for v in (0.005, 0.005, 0.05, 0.5):
+            h.observe(v)
+        self.assertEqual(h.quantile(0.5), 0.01)
+        self.assertEqual(h.quantile(0.75), 0.1)
+        self.assertEqual(h.quantile(1.0), 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import sys
+import os
+import json
+import gzip
+import tempfile
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+import src.server.db as db_module
+
+
+class TestExportImport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self._old_path = db_module.DB_PATH
+        self.source = self.open_db('source.db')
+        self.source.save_message('alice', 'Xin chào "mọi người"\ndòng 2', message_type='public')
+        self.source.save_message('alice', 'hi bob', receiver='bob', message_type='private')
+        self.source.save_message('bob', 'họp nhóm', receiver=7, message_type='group')
+
+    def tearDown(self):
+        self.source.close()
+        db_module.DB_PATH = self._old_path
+        self.dir.cleanup()
+
+    def open_db(self, name):
+        db_module.DB_PATH = os.path.join(self.dir.name, name)
+        return db_module.Database()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def messages(self, db):
+        return db.execute_query("SELECT id, sender, receiver, content, message_type, timestamp "
+                                "FROM messages ORDER BY id").fetchall()
+
+    def test_gzip_round_trip_keeps_ids_and_is_resumable(self):
+        progress = []
+        count = self.source.export_messages(self.path('out.ndjson.gz'), batch_size=2,
+                                            progress=lambda n, last_id: progress.append((n, last_id)))
+        self.assertEqual(count, 3)
+        self.assertEqual(progress, [(2, 2), (3, 3)])
+        with gzip.open(self.path('out.ndjson.gz'), 'rt', encoding='utf-8') as f:
+            self.assertEqual([json.loads(line)['id'] for line in f], [1, 2, 3])
+
+        target = self.open_db('target.db')
+        try:
+            self.assertEqual(target.import_messages(self.path('out.ndjson.gz'), batch_size=2), 3)
+            # Chạy lại (như sau khi bị ngắt) không nhân đôi tin nào
+            self.assertEqual(target.import_messages(self.path('out.ndjson.gz')), 0)
+            self.assertEqual([tuple(r) for r in self.messages(target)],
+                             [tuple(r) for r in self.messages(self.source)])
+            # id mới tiếp tục sau id đã nhập; tin nhập vào cũng tìm được
+            target.save_message('carol', 'mới', message_type='public')
+            self.assertEqual(self.messages(target)[-1]['id'], 4)
+            if target.search_backend:
+                results, _ = target.search_messages('bob', 'hi')
+                self.assertEqual([r['id'] for r in results], [2])
+        finally:
+            target.close()
+
+    def test_new_ids_with_skip_and_bad_line(self):
+        self.source.export_messages(self.path('out.ndjson'), after_id=1)
+        with open(self.path('out.ndjson'), 'a', encoding='utf-8') as f:
+            f.write('\n{"sender": "x"}\n')
+
+        target = self.open_db('target.db')
+        try:
+            target.save_message('zed', 'có sẵn', message_type='public')
+            lines = []
+            with self.assertRaises(ValueError) as ctx:
+                target.import_messages(self.path('out.ndjson'), batch_size=1, keep_ids=False,
+                                       progress=lambda n, added: lines.append(n))
+            self.assertIn(':4:', str(ctx.exception))
+            # Các lô trước dòng lỗi đã được commit; chạy tiếp bỏ qua các dòng đã nhập và dòng lỗi
+            self.assertEqual(lines, [1, 2])
+            self.assertEqual([r['content'] for r in self.messages(target)], ['có sẵn', 'hi bob', 'họp nhóm'])
+            with open(self.path('out.ndjson'), 'a', encoding='utf-8') as f:
+                f.write('{"sender": "x", "content": "cuối"}\n')
+            self.assertEqual(target.import_messages(self.path('out.ndjson'), keep_ids=False, skip=4), 1)
+            self.assertEqual([r['id'] for r in self.messages(target)], [1, 2, 3, 4])
+        finally:
+            target.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+
+import unittest
+import sys
+import os
+import tempfile
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+import src.server.db as db_module
+
+class TestFriendCache(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self._old_path = db_module.DB_PATH
+        db_module.DB_PATH = self.path
+        self.db = db_module.Database()
+        for name in ('alice', 'bob', 'carol'):
+            self.db.register_user(name, 'pw')
+
+    def tearDown(self):
+        self.db.close()
+        db_module.DB_PATH = self._old_path
+        os.remove(self.path)
+
+    def query_count(self):
+        return sum(r['calls'] for r in self.db.query_stats.snapshot())
+
+    def test_incremental_accept_updates_cached_sets(self):
+        # Nạp cache trước khi hai người thành bạn
+        self.assertFalse(self.db.are_friends('alice', 'bob'))
+        self.assertEqual(self.db.get_friend_names('bob'), set())
+        self.db.request_friend('alice', 'bob')
+        self.assertFalse(self.db.are_friends('alice', 'bob'))
+        self.assertTrue(self.db.accept_friend('bob', 'alice'))
+
+        before = self.query_count()
+        self.assertTrue(self.db.are_friends('alice', 'bob'))
+        self.assertTrue(self.db.are_friends('bob', 'alice'))
+        self.assertFalse(self.db.are_friends('alice', 'carol'))
+        self.assertEqual(self.query_count(), before)
+
+    def test_friend_list_served_from_cache_and_profiles_invalidated(self):
+        self.db.request_friend('alice', 'bob')
+        self.db.accept_friend('bob', 'alice')
+        self.assertEqual([f['username'] for f in self.db.get_friends_with_status('alice')], ['bob'])
+
+        before = self.query_count()
+        friends = self.db.get_friends_with_status('alice')
+        self.assertEqual(self.query_count(), before)
+        self.assertEqual(friends[0]['display_name'], 'bob')
+
+        self.db.update_user_display_name('bob', 'Bobby')
+        self.assertEqual(self.db.get_friends_with_status('alice')[0]['display_name'], 'Bobby')
+
+    def test_requests_listed_per_direction(self):
+        self.db.request_friend('alice', 'bob')
+        ok, _ = self.db.request_friend('bob', 'alice')
+        self.assertFalse(ok)
+        self.assertEqual([r['username'] for r in self.db.get_pending_requests('bob')], ['alice'])
+        self.assertEqual([r['username'] for r in self.db.get_sent_requests('alice')], ['bob'])
+        self.assertEqual(self.db.get_pending_requests('alice'), [])
+        # Người gửi không tự accept được lời mời của mình
+        self.assertFalse(self.db.accept_friend('alice', 'bob'))
+        self.assertTrue(self.db.accept_friend('bob', 'alice'))
+        self.assertEqual(self.db.get_sent_requests('alice'), [])
+
+    def test_friend_queries_use_indexes(self):
+        queries = [
+            ("SELECT peer FROM friend_edges WHERE owner = ? AND status = 'accepted'", ('alice',)),
+            ("SELECT status FROM friend_edges WHERE owner = ? AND peer = ?", ('alice', 'bob')),
+            ("SELECT e.peer, u.display_name FROM friend_edges e JOIN users u ON u.username = e.peer "
+             "WHERE e.owner = ? AND e.status = 'pending' AND e.direction = 'in'", ('alice',)),
+        ]
+        for query, params in queries:
+            plan = ' '.join(self.db.explain(query, params))
+            self.assertNotIn('SCAN', plan, plan)
+
+    def test_legacy_friends_table_migrated(self):
+        self.db.execute_query("CREATE TABLE friends (user1 TEXT, user2 TEXT, status TEXT, "
+                              "created_at DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (user1, user2))")
+        self.db.execute_query("INSERT INTO friends (user1, user2, status) VALUES ('alice', 'bob', 'accepted')")
+        self.db.execute_query("INSERT INTO friends (user1, user2, status) VALUES ('carol', 'alice', 'pending')")
+        self.db.conn.commit()
+        self.db.close()
+
+        self.db = db_module.Database()
+        self.assertTrue(self.db.are_friends('bob', 'alice'))
+        self.assertEqual([r['username'] for r in self.db.get_pending_requests('alice')], ['carol'])
+        self.assertEqual([r['username'] for r in self.db.get_sent_requests('carol')], ['alice'])
+
+    def test_lru_bound(self):
+        cache = db_module.FriendCache(max_users=2)
+        cache.put_friends('a', {'x'})
+        cache.put_friends('b', {'y'})
+        cache.friends('a')
+        cache.put_friends('c', {'z'})
+        self.assertIsNone(cache.friends('b'))
+        self.assertEqual(cache.friends('a'), {'x'})
+
+    def test_remote_edge_applied(self):
+        cache = db_module.FriendCache()
+        sent = []
+        cache.publish = sent.append
+        cache.put_friends('a', set())
+        cache.add_edge('a', 'b')
+        self.assertEqual(sent, [{'op': 'edge', 'users': ['a', 'b']}])
+
+        other = db_module.FriendCache()
+        other.put_friends('b', set())
+        other.apply(sent[0])
+        self.assertEqual(other.friends('b'), {'a'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+from helpers import ServerTestCase, received, db
+from src.common import protocol
+
+
+def types(client):
+    return [m.get('type') for m in received(client)]
+
+
+class TestGroupCache(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('alice', 'bob', 'carol'):
+            db.register_user(name, 'pw')
+        self.gid = db.create_group('Team', 'alice')
+        db.add_member_to_group(self.gid, 'bob')
+
+    def query_count(self):
+        return sum(r['calls'] for r in db.query_stats.snapshot())
+
+    def test_membership_kept_in_sync(self):
+        self.assertEqual(db.get_user_group_ids('bob'), {self.gid})
+        self.assertEqual(db.get_group_member_set(self.gid), {'alice', 'bob'})
+
+        before = self.query_count()
+        self.assertTrue(db.is_group_member(self.gid, 'bob'))
+        self.assertTrue(db.is_group_member(str(self.gid), 'alice'))
+        self.assertEqual(self.query_count(), before)
+
+        db.add_member_to_group(str(self.gid), 'carol')
+        db.remove_member_from_group(self.gid, 'bob')
+        self.assertTrue(db.is_group_member(self.gid, 'carol'))
+        self.assertFalse(db.is_group_member(self.gid, 'bob'))
+        self.assertEqual(db.get_user_group_ids('bob'), set())
+
+        self.assertTrue(db.delete_group(self.gid, 'alice'))
+        self.assertEqual(db.get_user_group_ids('alice'), set())
+        self.assertFalse(db.is_group_member(self.gid, 'carol'))
+
+    def test_login_joins_rooms_and_group_send_requires_membership(self):
+        (alice, _), (bob, bob_messages), (carol, _) = (self.login(name) for name in ('alice', 'bob', 'carol'))
+        groups = [m['payload'] for m in bob_messages if m.get('type') == 'USER_GROUPS']
+        self.assertEqual(groups, [[self.gid]])
+        alice.get_received()
+        carol.get_received()
+
+        carol.emit('message', {'type': protocol.MSG_GROUP, 'payload': {'group_id': self.gid, 'content': 'hi'}})
+        self.assertEqual(types(carol), ['ERROR'])
+        self.assertNotIn(protocol.MSG_GROUP, types(bob))
+
+        alice.emit('message', {'type': protocol.MSG_GROUP, 'payload': {'group_id': self.gid, 'content': 'hi'}})
+        self.assertIn(protocol.MSG_GROUP, types(bob))
+        self.assertNotIn(protocol.MSG_GROUP, types(carol))
+
+if __name__ == '__main__':
+    unittest.main()
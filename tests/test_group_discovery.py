@@ -0,0 +1,136 @@
+import unittest
+import os
+import tempfile
+
+from helpers import ServerTestCase, received, of_type, db
+import src.server.db as db_module
+from src.common import protocol
+
+
+class TestGroupDeltas(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = {}
+        for name in ('alice', 'bob', 'carol', 'dave'):
+            db.register_user(name, 'pw')
+            self.users[name], _ = self.login(name)
+        for c in self.clients:
+            c.get_received()
+
+    def send(self, name, msg_type, payload):
+        self.users[name].emit('message', {'type': msg_type, 'payload': payload})
+        return received(self.users[name])
+
+    def test_create_join_leave_delete_send_deltas_to_members_only(self):
+        out = self.send('alice', protocol.MSG_GROUP_CREATE, {'name': 'Team', 'members': ['bob', 'carol']})
+        (groups,) = of_type(out, protocol.MSG_GROUPS_LIST)
+        gid = groups[0]['id']
+        self.assertEqual([g['name'] for g in groups], ['Team'])
+
+        bob = received(self.users['bob'])
+        self.assertEqual([g['id'] for g in of_type(bob, protocol.MSG_GROUP_ADDED)], [gid])
+        # Người ngoài nhóm không nhận danh sách nhóm nào
+        dave = received(self.users['dave'])
+        self.assertEqual(of_type(dave, protocol.MSG_GROUPS_LIST) + of_type(dave, protocol.MSG_GROUP_ADDED), [])
+
+        out = self.send('dave', protocol.MSG_GROUP_JOIN, gid)
+        self.assertEqual([g['id'] for g in of_type(out, protocol.MSG_GROUP_ADDED)], [gid])
+        out = self.send('dave', protocol.MSG_GROUP_LEAVE, gid)
+        self.assertEqual(of_type(out, protocol.MSG_GROUP_REMOVED), [{'group_id': gid}])
+
+        self.send('alice', 'GROUP_DELETE', {'group_id': gid})
+        self.assertEqual(of_type(received(self.users['carol']), protocol.MSG_GROUP_REMOVED), [{'group_id': gid}])
+        self.assertEqual(of_type(received(self.users['dave']), protocol.MSG_GROUP_REMOVED), [])
+
+    def test_join_leave_reject_bad_ids_and_non_members(self):
+        gid = db.create_group('Team', 'alice')
+        for payload in ('abc', {'group_id': gid}, 999):
+            out = self.send('dave', protocol.MSG_GROUP_JOIN, payload)
+            self.assertEqual(of_type(out, 'SUCCESS') + of_type(out, protocol.MSG_GROUP_ADDED), [])
+            self.assertEqual(len(of_type(out, 'ERROR')), 1)
+            out = self.send('dave', protocol.MSG_GROUP_LEAVE, payload)
+            self.assertEqual(of_type(out, 'SUCCESS') + of_type(out, protocol.MSG_GROUP_REMOVED), [])
+            self.assertEqual(len(of_type(out, 'ERROR')), 1)
+        # Không phải thành viên: không có dòng nào bị xoá, member_count giữ nguyên
+        self.assertFalse(db.remove_member_from_group(gid, 'dave'))
+        out = self.send('dave', protocol.MSG_GROUP_LEAVE, str(gid))
+        self.assertEqual(of_type(out, protocol.MSG_GROUP_REMOVED), [])
+        self.assertEqual(db.get_discoverable_groups('dave')[0]['member_count'], 1)
+
+    def test_discover_pages_and_search(self):
+        for i in range(5):
+            db.create_group(f"Book club {i}", 'alice')
+        db.create_group("Chess", 'alice')
+        mine = db.create_group("Mine", 'bob')
+
+        out = self.send('bob', protocol.MSG_GROUPS_DISCOVER, {'query': 'BOOK', 'limit': 2})
+        (page,) = of_type(out, protocol.MSG_GROUPS_DISCOVER_RESULT)
+        names = [g['name'] for g in page['groups']]
+        while page['next_cursor'] is not None:
+            out = self.send('bob', protocol.MSG_GROUPS_DISCOVER,
+                            {'query': 'BOOK', 'limit': 2, 'cursor': page['next_cursor']})
+            (page,) = of_type(out, protocol.MSG_GROUPS_DISCOVER_RESULT)
+            names += [g['name'] for g in page['groups']]
+        self.assertEqual(names, [f"Book club {i}" for i in range(5)])
+
+        out = self.send('bob', protocol.MSG_GROUPS_DISCOVER, None)
+        (page,) = of_type(out, protocol.MSG_GROUPS_DISCOVER_RESULT)
+        self.assertEqual(len(page['groups']), 6)
+        self.assertNotIn(mine, [g['id'] for g in page['groups']])
+
+    def test_member_counts_substring_and_index_plan(self):
+        gid = db.create_group("Đội Bóng", 'alice')
+        db.add_member_to_group(gid, 'bob')
+        db.add_member_to_group(gid, 'bob')
+        db.add_member_to_group(gid, 'carol')
+        db.remove_member_from_group(gid, 'carol')
+        db.create_group("100% fun_club", 'alice')
+
+        (group,) = db.get_discoverable_groups('dave', query='đội')
+        self.assertEqual(group['member_count'], 2)
+        self.assertEqual([g['name'] for g in db.get_discoverable_groups('dave', query='BÓNG', match='substring')],
+                         ["Đội Bóng"])
+        # % và _ trong từ khoá là ký tự thường, không phải wildcard
+        self.assertEqual(db.get_discoverable_groups('dave', query='0_f', match='substring'), [])
+        self.assertEqual(len(db.get_discoverable_groups('dave', query='% fun_', match='substring')), 1)
+
+        plan = ' '.join(db.explain(
+            "SELECT g.id FROM groups g WHERE g.name_lower >= ? AND g.name_lower < ? AND (g.name_lower, g.id) > (?, ?) "
+            "AND NOT EXISTS (SELECT 1 FROM group_members gm WHERE gm.group_id = g.id AND gm.username = ?) "
+            "ORDER BY g.name_lower, g.id LIMIT 20", ('a', 'b', 'a', 0, 'dave')))
+        self.assertIn('idx_groups_name_lower', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class TestGroupMigration(unittest.TestCase):
+    def test_old_groups_table_backfilled(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        old_path = db_module.DB_PATH
+        db_module.DB_PATH = path
+        try:
+            import sqlite3
+            conn = sqlite3.connect(path)
+            conn.executescript('''
+                CREATE TABLE groups (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL,
+                                     creator TEXT NOT NULL, created_at DATETIME DEFAULT CURRENT_TIMESTAMP);
+                CREATE TABLE group_members (group_id INTEGER, username TEXT,
+                                            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                                            PRIMARY KEY (group_id, username));
+                INSERT INTO groups (name, creator) VALUES ('ĐẠI Học', 'a');
+                INSERT INTO group_members (group_id, username) VALUES (1, 'a'), (1, 'b');
+            ''')
+            conn.commit()
+            conn.close()
+
+            migrated = db_module.Database()
+            (group,) = migrated.get_discoverable_groups('c', query='đại')
+            self.assertEqual(group['member_count'], 2)
+            migrated.close()
+        finally:
+            db_module.DB_PATH = old_path
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
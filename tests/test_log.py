@@ -0,0 +1,62 @@
+
+import unittest
+import sys
+import os
+import io
+import json
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+from src.server import log
+
+class TestStructuredLogging(unittest.TestCase):
+    def setUp(self):
+        log.shutdown_logging()
+        self.stream = io.StringIO()
+
+    def tearDown(self):
+        log.shutdown_logging()
+
+    def read_lines(self):
+        # stop() flush hàng đợi trước khi đọc stream
+        log.shutdown_logging()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_json_fields_truncation_and_redaction(self):
+        log.setup_logging(level='INFO', levels={}, fmt='json', stream=self.stream, max_field=10)
+        log.get_logger('server').info("message received", extra=log.fields(
+            type='FILE_CHUNK', payload={'data': 'A' * 5000, 'chunk_num': 3, 'note': 'x' * 50}))
+        lines = self.read_lines()
+        self.assertEqual(len(lines), 1)
+        entry = lines[0]
+        self.assertEqual(entry['logger'], 'chat.server')
+        self.assertEqual(entry['type'], 'FILE_CHUNK')
+        self.assertEqual(entry['payload']['data'], '<redacted>')
+        self.assertEqual(entry['payload']['chunk_num'], 3)
+        self.assertTrue(entry['payload']['note'].startswith('x' * 10 + '...'))
+
+    def test_per_subsystem_levels(self):
+        log.setup_logging(level='INFO', levels={'db': 'WARNING', 'server.file': 'DEBUG'},
+                          fmt='json', stream=self.stream)
+        log.get_logger('db').info("hidden")
+        log.get_logger('db').warning("shown db")
+        log.get_logger('server').debug("hidden")
+        log.get_logger('server.file').debug("shown file")
+        msgs = [e['msg'] for e in self.read_lines()]
+        self.assertEqual(msgs, ['shown db', 'shown file'])
+
+    def test_sampling(self):
+        log.setup_logging(level='DEBUG', levels={}, fmt='json', stream=self.stream)
+        logger = log.get_logger('server')
+        for i in range(100):
+            logger.debug("chunk", extra=log.fields(i=i, sample_rate=0.1))
+        lines = self.read_lines()
+        self.assertEqual([e['i'] for e in lines], list(range(0, 100, 10)))
+        self.assertTrue(all(e['sampled'] == 10 for e in lines))
+
+    def test_parse_levels(self):
+        self.assertEqual(log.parse_levels("db=warning, server=DEBUG,bad"), {'db': 'WARNING', 'server': 'DEBUG'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+
+import unittest
+import sys
+import os
+import tempfile
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+# Monkeypatch DB_PATH to use a test database
+import src.server.db as db_module
+test_db_fd, test_db_path = tempfile.mkstemp(suffix='.db')
+os.close(test_db_fd)
+db_module.DB_PATH = test_db_path
+
+from src.server.server import app, socketio, db
+from src.server.metrics import Registry
+from src.common import protocol
+
+class TestRegistryRender(unittest.TestCase):
+    def test_text_format(self):
+        reg = Registry()
+        c = reg.counter('x_total', 'X count', ('type',))
+        g = reg.gauge('y', 'Y value')
+        h = reg.histogram('z_seconds', 'Z latency', buckets=(0.1, 1.0))
+        c.labels('A').inc()
+        c.labels('A').inc(2)
+        g.set_function(lambda: 7)
+        h.observe(0.05)
+        h.observe(5)
+
+        text = reg.render()
+        self.assertIn('# TYPE x_total counter', text)
+        self.assertIn('x_total{type="A"} 3', text)
+        self.assertIn('y 7', text)
+        self.assertIn('z_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('z_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('z_seconds_count 2', text)
+        with self.assertRaises(ValueError):
+            reg.counter('x_total', 'dup')
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def setUp(self):
+        db.close()
+        db.connect_sqlite()
+        db.create_tables()
+        self.client = socketio.test_client(app)
+
+    def tearDown(self):
+        self.client.disconnect()
+        db.close()
+        try:
+            os.remove(test_db_path)
+        except:
+            pass
+
+    def test_hot_paths_are_instrumented(self):
+        self.client.emit('message', {'type': protocol.MSG_REGISTER,
+                                     'payload': {'username': 'MetricUser', 'password': 'pw'}})
+        self.client.emit('message', {'type': protocol.MSG_LOGIN,
+                                     'payload': {'username': 'MetricUser', 'password': 'pw'}})
+        self.client.emit('message', {'type': 'NOT_A_TYPE'})
+
+        resp = app.test_client().get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        text = resp.get_data(as_text=True)
+        self.assertIn('chat_messages_received_total{type="LOGIN"}', text)
+        self.assertIn('chat_messages_received_total{type="unknown"}', text)
+        self.assertIn('chat_handler_duration_seconds_count{type="LOGIN"}', text)
+        self.assertIn('chat_db_query_duration_seconds_count{op="SELECT"}', text)
+        self.assertIn('chat_broadcast_fanout_count{kind="users_list"}', text)
+        self.assertIn('chat_logged_in_sessions 1', text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import unittest
+import sys
+import os
+import re
+import tempfile
+import uuid
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+import src.server.db as db_module
+from src.server import migrate_pg
+
+_UNESCAPE = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', 'v': '\v'}
+
+
+def parse_copy_field(field):
+    if field == '\\N':
+        return None
+    return re.sub(r'\\(.)', lambda m: _UNESCAPE[m.group(1)], field)
+
+
+class FakeCopyTarget:
+    """Connection Postgres giả: COPY FROM STDIN đọc file theo từng khúc như psycopg2."""
+
+    def __init__(self):
+        self.statements = []
+        self.data = b''
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, sql, file, size=8192):
+        self.statements.append(sql)
+        while True:
+            chunk = file.read(size)
+            if not chunk:
+                break
+            self.data += chunk
+
+    def close(self):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+    def rows(self):
+        lines = self.data.decode('utf-8').split('\n')[:-1]
+        return [tuple(parse_copy_field(f) for f in line.split('\t')) for line in lines]
+
+
+class TestCopyEncoding(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self._old_path = db_module.DB_PATH
+        db_module.DB_PATH = self.path
+        db = db_module.Database()
+        db.register_user('alice', 'pw')
+        tricky = ['tab\there', 'dòng 1\ndòng 2\r\n', 'back\\slash \\N', '', 'ctrl \b\f\v', '😀 tiếng Việt']
+        for i, content in enumerate(tricky * 300):
+            db.save_message('alice', content, receiver='bob' if i % 2 else None,
+                            message_type='private' if i % 2 else 'public')
+        db.close()
+        self.source = migrate_pg.open_source(self.path)
+
+    def tearDown(self):
+        self.source.close()
+        db_module.DB_PATH = self._old_path
+        os.remove(self.path)
+
+    def test_copy_stream_round_trips_and_checksums_match(self):
+        columns = ['id', 'sender', 'receiver', 'content', 'message_type', 'timestamp']
+        target = FakeCopyTarget()
+        rows, checksum = migrate_pg.copy_chunk(self.source, target, 'messages', columns, batch_size=97)
+        self.assertEqual(rows, 1800)
+        self.assertEqual(target.statements, [f"COPY messages ({', '.join(columns)}) FROM STDIN"])
+        self.assertEqual(target.commits, 1)
+
+        expected = [tuple(None if v is None else str(v) for v in row)
+                    for row in self.source.execute(f"SELECT {', '.join(columns)} FROM messages")]
+        self.assertEqual(target.rows(), expected)
+
+        # Postgres trả lại đúng các byte đó khi COPY TO, theo thứ tự bất kỳ, chia khúc tuỳ ý
+        lines = target.data.split(b'\n')[:-1]
+        payload = b'\n'.join(reversed(lines)) + b'\n'
+        sink = migrate_pg.HashSink()
+        for i in range(0, len(payload), 1000):
+            sink.write(payload[i:i + 1000])
+        self.assertEqual((sink.rows, sink.checksum), (rows, checksum))
+
+    def test_id_ranges_cover_table(self):
+        columns = ['id', 'content']
+        total, checksum = 0, 0
+        for lo in range(1, 1801, 700):
+            n, c = migrate_pg.copy_chunk(self.source, FakeCopyTarget(), 'messages', columns, (lo, lo + 700))
+            total += n
+            checksum = (checksum + c) & ((1 << 64) - 1)
+        self.assertEqual((total, checksum), migrate_pg.copy_chunk(self.source, FakeCopyTarget(), 'messages', columns))
+
+
+@unittest.skipUnless(os.environ.get('CHAT_TEST_POSTGRES_URL') and migrate_pg.psycopg2,
+                     "set CHAT_TEST_POSTGRES_URL to run against Postgres")
+class TestMigrationPostgres(unittest.TestCase):
+    def test_full_migration(self):
+        import psycopg2
+        url = os.environ['CHAT_TEST_POSTGRES_URL']
+        schema = f"migrate_{uuid.uuid4().hex[:8]}"
+        admin = psycopg2.connect(url)
+        admin.autocommit = True
+        admin.cursor().execute(f"CREATE SCHEMA {schema}")
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        old_path = db_module.DB_PATH
+        try:
+            db_module.DB_PATH = path
+            db = db_module.Database()
+            for name in ('alice', 'bob'):
+                db.register_user(name, 'pw')
+            gid = db.create_group('Team', 'alice')
+            db.add_member_to_group(gid, 'bob')
+            db.request_friend('alice', 'bob')
+            for i in range(50):
+                db.save_message('alice', f'tin {i}\t\\', receiver=str(gid), message_type='group')
+            db.close()
+
+            sep = '&' if '?' in url else '?'
+            pg_url = f"{url}{sep}options=-csearch_path%3D{schema}"
+            report = migrate_pg.Migration(path, pg_url, jobs=2, chunk_rows=20).run()
+            self.assertTrue(all(entry['ok'] for entry in report.values()), report)
+            self.assertEqual(report['messages']['rows'], 50)
+
+            target = psycopg2.connect(pg_url)
+            cursor = target.cursor()
+            cursor.execute("INSERT INTO messages (sender, content) VALUES ('bob', 'x') RETURNING id")
+            self.assertEqual(cursor.fetchone()[0], 51)
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'messages'")
+            self.assertIn('idx_messages_sender', {r[0] for r in cursor.fetchall()})
+            target.close()
+        finally:
+            db_module.DB_PATH = old_path
+            os.remove(path)
+            admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+            admin.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+import os
+
+from helpers import ServerTestCase, received, of_type, db
+from src.server.server import FILES_DIR
+from src.common import protocol
+
+
+class TestOfflineQueue(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('alice', 'bob'):
+            db.register_user(name, 'pw')
+        db.request_friend('alice', 'bob')
+        db.accept_friend('bob', 'alice')
+        self.gid = db.create_group('Team', 'alice')
+        db.add_member_to_group(self.gid, 'bob')
+
+    def test_messages_queued_while_offline_arrive_in_one_frame(self):
+        alice, _ = self.login('alice')
+        for text in ('chào bob', 'bob ơi'):
+            alice.emit('message', {'type': protocol.MSG_PRIVATE, 'payload': {'receiver': 'bob', 'content': text}})
+        alice.emit('message', {'type': protocol.MSG_GROUP, 'payload': {'group_id': self.gid, 'content': 'họp'}})
+        self.assertEqual(of_type(received(alice), 'ERROR'), [])
+
+        bob, messages = self.login('bob')
+        (frame,) = of_type(messages, protocol.MSG_OFFLINE_MESSAGES)
+        self.assertEqual([m['content'] for m in frame['messages']], ['chào bob', 'bob ơi'])
+        self.assertEqual(frame['seq'], frame['messages'][-1]['id'])
+        self.assertFalse(frame['more'])
+        self.assertCountEqual(frame['unread'], [{'type': 'private', 'target': 'alice', 'count': 2},
+                                                {'type': 'group', 'target': self.gid, 'count': 1}])
+        # Không còn phát lại 20 tin công khai + 20 tin riêng như trước
+        self.assertEqual(of_type(messages, protocol.MSG_PRIVATE), [])
+
+        # Tin đang online đi thẳng, không vào hàng chờ
+        alice.emit('message', {'type': protocol.MSG_PRIVATE, 'payload': {'receiver': 'bob', 'content': 'online'}})
+        self.assertEqual([p['content'] for p in of_type(received(bob), protocol.MSG_PRIVATE)], ['online'])
+        # Hàng chờ chỉ được xoá khi client ACK
+        self.assertEqual(len(db.get_pending_messages('bob')[0]), 2)
+        bob.emit('message', {'type': protocol.MSG_ACK, 'payload': {'seq': frame['seq']}})
+        self.assertEqual(db.get_pending_messages('bob'), ([], 0, False))
+
+        # Mở lịch sử nhóm và đánh dấu cuộc trò chuyện riêng đã đọc
+        bob.emit('message', {'type': protocol.MSG_HISTORY_REQUEST,
+                             'payload': {'history_type': 'group', 'target': self.gid}})
+        bob.emit('message', {'type': protocol.MSG_MARK_READ, 'payload': {'type': 'private', 'target': 'alice'}})
+        self.assertEqual(db.get_unread_counts('bob'), [])
+        self.assertEqual(db.get_unread_counts('alice'), [])
+
+    def test_private_reaches_every_session(self):
+        alice, _ = self.login('alice')
+        alice_web, _ = self.login('alice')
+        bob, _ = self.login('bob')
+        bob_web, _ = self.login('bob')
+        for c in self.clients:
+            c.get_received()
+
+        alice.emit('message', {'type': protocol.MSG_PRIVATE, 'payload': {'receiver': 'bob', 'content': 'chào'}})
+        for c in (bob, bob_web, alice_web):
+            (p,) = of_type(received(c), protocol.MSG_PRIVATE)
+            self.assertEqual((p['sender'], p['receiver'], p['content']), ('alice', 'bob', 'chào'))
+        self.assertEqual(of_type(received(alice), protocol.MSG_PRIVATE), [])
+        # Người nhận đang online: không vào hàng chờ giao
+        self.assertEqual(db.get_pending_messages('bob')[0], [])
+
+        alice.emit('message', {'type': protocol.MSG_TYPING, 'payload': {'mode': 'private', 'target': 'bob'}})
+        self.assertEqual([len(of_type(received(c), protocol.MSG_TYPING)) for c in (bob, bob_web, alice_web)],
+                         [1, 1, 0])
+
+    def test_private_file_queued_only_when_receiver_has_no_session(self):
+        alice, _ = self.login('alice')
+        bob, _ = self.login('bob')
+        bob_web, _ = self.login('bob')
+        for c in self.clients:
+            c.get_received()
+
+        def send_file(name):
+            alice.emit('message', {'type': protocol.MSG_FILE_REQUEST,
+                                   'payload': {'filename': name, 'filesize': 2, 'receiver': 'bob'}})
+            alice.emit('message', {'type': protocol.MSG_FILE_CHUNK, 'payload': {'data': 'aGk='}})
+            alice.emit('message', {'type': protocol.MSG_FILE_END, 'payload': {'filename': name}})
+            self.addCleanup(os.remove, os.path.join(FILES_DIR, name))
+
+        send_file('offline_queue_test_1.txt')
+        for c in (bob, bob_web):
+            self.assertEqual(len(of_type(received(c), protocol.MSG_FILE)), 1)
+        self.assertEqual(db.get_pending_messages('bob')[0], [])
+
+        for c in (bob, bob_web):
+            self.clients.remove(c)
+            c.disconnect()
+        send_file('offline_queue_test_2.txt')
+        (pending,) = db.get_pending_messages('bob')[0]
+        self.assertIn('offline_queue_test_2.txt', pending['content'])
+
+    def test_friend_request_and_accept_reach_every_session(self):
+        db.register_user('carol', 'pw')
+        alice, _ = self.login('alice')
+        alice_web, _ = self.login('alice')
+        carol, _ = self.login('carol')
+        carol_web, _ = self.login('carol')
+        for c in self.clients:
+            c.get_received()
+
+        carol.emit('message', {'type': protocol.MSG_FRIEND_REQUEST, 'payload': {'target': 'alice'}})
+        for c in (alice, alice_web):
+            self.assertEqual(of_type(received(c), protocol.MSG_FRIEND_REQUEST), [{'requester': 'carol'}])
+
+        alice.emit('message', {'type': protocol.MSG_FRIEND_ACCEPT, 'payload': {'requester': 'carol'}})
+        for c in (carol, carol_web):
+            messages = received(c)
+            self.assertEqual(of_type(messages, protocol.MSG_FRIEND_ACCEPT), [{'accepter': 'alice'}])
+            (friends,) = of_type(messages, protocol.MSG_FRIEND_LIST)
+            self.assertEqual([(f['username'], f['status']) for f in friends['friends']], [('alice', 'online')])
+        for c in (alice, alice_web):
+            (friends,) = of_type(received(c), protocol.MSG_FRIEND_LIST)
+            self.assertEqual(sorted(f['username'] for f in friends['friends']), ['bob', 'carol'])
+
+    def test_pending_batches_and_group_leave_clears_counter(self):
+        db.PENDING_BATCH = 3
+        try:
+            for i in range(7):
+                db.save_message('alice', f'tin {i}', receiver='bob', message_type='private', deliver_later=True)
+            db.save_message('alice', 'nhóm', receiver=self.gid, message_type='group')
+            db.remove_member_from_group(self.gid, 'bob')
+            _, messages = self.login('bob')
+        finally:
+            del db.PENDING_BATCH
+        frames = of_type(messages, protocol.MSG_OFFLINE_MESSAGES)
+        self.assertEqual([len(f['messages']) for f in frames], [3, 3, 1])
+        self.assertEqual([f['more'] for f in frames], [True, True, False])
+        self.assertEqual(frames[0]['unread'], [{'type': 'private', 'target': 'alice', 'count': 7}])
+        self.assertEqual([m['content'] for f in frames for m in f['messages']], [f'tin {i}' for i in range(7)])
+        # Chưa ACK: đăng nhập lại nhận lại đủ
+        _, messages = self.login('bob')
+        self.assertEqual(sum(len(f['messages']) for f in of_type(messages, protocol.MSG_OFFLINE_MESSAGES)), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
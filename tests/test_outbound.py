@@ -0,0 +1,156 @@
+import unittest
+import sys
+import os
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+import socketio
+from socketio import packet
+
+from src.server.outbound import OutboundQueues
+from src.common import protocol
+
+
+class FakeQueue:
+    def __init__(self):
+        self.items = []
+
+    def qsize(self):
+        return len(self.items)
+
+
+class FakeSocket:
+    def __init__(self):
+        self.queue = FakeQueue()
+        self.closed = False
+
+
+class FakeEngine:
+    def __init__(self):
+        self.sockets = {}
+        self.disconnected = []
+
+    def send(self, sid, data):
+        self.sockets[sid].queue.items.append(data)
+
+    def disconnect(self, sid):
+        self.disconnected.append(sid)
+
+    def start_background_task(self, target, *args):
+        pass
+
+
+class FakeServer:
+    """Đủ phần python-socketio Server mà OutboundQueues dùng; task nền không tự chạy."""
+
+    def __init__(self):
+        self.eio = FakeEngine()
+        self.tasks = []
+
+    def _send_packet(self, eio_sid, pkt):
+        self.eio.send(eio_sid, pkt.encode())
+
+    def start_background_task(self, target, *args):
+        self.tasks.append((target, args))
+
+    def sleep(self, seconds):
+        pass
+
+
+def event(msg_type, payload):
+    return packet.Packet(packet.EVENT, data=['message', {'type': msg_type, 'payload': payload}])
+
+
+def types(items):
+    return [item.split('"type":"')[1].split('"')[0] for item in items]
+
+
+class TestOutboundQueues(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.server = FakeServer()
+        self.queues = OutboundQueues(self.server, max_bytes=10_000, max_messages=5, evict_after=5,
+                                     high_water=2, clock=lambda: self.now).install()
+        self.socket = self.server.eio.sockets['s1'] = FakeSocket()
+
+    def send(self, msg_type, payload):
+        self.server._send_packet('s1', event(msg_type, payload))
+
+    def test_backlog_is_prioritised_coalesced_and_shed(self):
+        self.send(protocol.MSG_TEXT, 'một')
+        self.send(protocol.MSG_TEXT, 'hai')
+        self.assertEqual(self.queues.queues, {})  # transport còn chỗ: gửi thẳng
+
+        # Transport đầy: tin mới vào hàng đợi của kết nối
+        self.send(protocol.MSG_TYPING, {'sender': 'bob', 'mode': 'private'})
+        self.send(protocol.MSG_USERS_LIST, ['a'])
+        self.send(protocol.MSG_USER_STATUS, {'username': 'bob', 'status': 'online'})
+        self.send(protocol.MSG_PRIVATE, {'content': 'ba'})
+        self.send(protocol.MSG_USERS_LIST, ['a', 'b'])
+        self.send(protocol.MSG_STOP_TYPING, {'sender': 'bob', 'mode': 'private'})
+        self.assertEqual(self.queues.stats()['messages'], 4)
+        self.assertEqual(len(self.server.tasks), 1)
+
+        # Vượt giới hạn số tin: typing bị bỏ trước, rồi presence cũ nhất; chat giữ nguyên
+        for i in range(3):
+            self.send(protocol.MSG_GROUP, {'content': f'nhóm {i}'})
+        self.assertEqual(self.queues.stats()['messages'], 5)
+
+        self.socket.queue.items.clear()
+        self.assertTrue(self.queues.drain('s1'))
+        self.assertEqual(types(self.socket.queue.items), [protocol.MSG_PRIVATE, protocol.MSG_GROUP])
+        self.socket.queue.items.clear()
+        self.assertTrue(self.queues.drain('s1'))
+        self.socket.queue.items.clear()
+        self.assertFalse(self.queues.drain('s1'))
+        self.assertEqual(types(self.socket.queue.items), [protocol.MSG_USER_STATUS])
+        self.assertEqual(self.queues.stats(), {'sessions': 0, 'bytes': 0, 'messages': 0, 'max_bytes': 0})
+
+    def test_consumer_over_cap_too_long_is_evicted(self):
+        for i in range(2 + 7):
+            self.send(protocol.MSG_PRIVATE, {'content': f'tin {i}'})
+        self.assertEqual(self.queues.stats()['messages'], 7)
+        self.assertEqual(self.server.eio.disconnected, [])
+
+        self.now = 4.9
+        self.assertTrue(self.queues.drain('s1'))
+        self.now = 5.0
+        self.assertFalse(self.queues.drain('s1'))
+        target, args = self.server.tasks[-1]
+        target(*args)
+        self.assertEqual(self.server.eio.disconnected, ['s1'])
+        self.assertEqual(self.queues.queues, {})
+
+    def test_socket_closed_drops_queue(self):
+        for i in range(3):
+            self.send(protocol.MSG_PRIVATE, {'content': f'tin {i}'})
+        self.socket.closed = True
+        self.assertFalse(self.queues.drain('s1'))
+        self.assertEqual(self.queues.queues, {})
+
+
+class TestFanout(unittest.TestCase):
+    def test_payload_is_encoded_once_for_every_recipient(self):
+        server = socketio.Server(async_mode='threading')
+        sids = [server.manager.connect(f'e{i}', '/') for i in range(4)]
+        server.eio = FakeEngine()
+        for i in range(4):
+            server.eio.sockets[f'e{i}'] = FakeSocket()
+        queues = OutboundQueues(server, high_water=2).install()
+        for sid in sids[:3]:
+            server.manager.enter_room(sid, '/', 'group_1')
+        # e2 đang nghẽn: bản encode dùng chung vào hàng đợi của nó
+        server.eio.sockets['e2'].queue.items.extend(['x', 'y'])
+
+        n = queues.fanout({'type': protocol.MSG_GROUP, 'payload': {'content': 'chào'}},
+                          sids=[sids[0], sids[3], 'không-có'], rooms=['group_1'], skip_sids=[sids[1]])
+        self.assertEqual(n, 3)
+        self.assertEqual(server.eio.sockets['e1'].queue.items, [])
+        first = server.eio.sockets['e0'].queue.items[0]
+        self.assertIs(server.eio.sockets['e3'].queue.items[0], first)
+        self.assertIs(queues.queues['e2'].lanes[0][0][1], first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+
+import unittest
+import sys
+import os
+import tempfile
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+import src.server.db as db_module
+
+class TestQueryStats(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self._old_path = db_module.DB_PATH
+        db_module.DB_PATH = self.path
+        self.db = db_module.Database()
+        self.db.query_stats.reset()
+
+    def tearDown(self):
+        self.db.close()
+        db_module.DB_PATH = self._old_path
+        os.remove(self.path)
+
+    def test_normalize_query(self):
+        self.assertEqual(
+            db_module.normalize_query("SELECT *\n  FROM t WHERE a = 'x' AND b IN (?, ?, ?) LIMIT 10"),
+            "SELECT * FROM t WHERE a = ? AND b IN (...) LIMIT ?")
+
+    def test_aggregates_calls_and_rows(self):
+        for name in ('alice', 'bob', 'carol'):
+            self.db.register_user(name, 'pw')
+        self.db.get_all_users()
+        self.db.get_all_users()
+
+        stats = {r['query']: r for r in self.db.query_stats.snapshot()}
+        users = [r for q, r in stats.items() if q.startswith('SELECT username, display_name FROM users WHERE is_active')]
+        self.assertEqual(len(users), 1)
+        self.assertEqual(users[0]['calls'], 2)
+        self.assertEqual(users[0]['rows'], 6)
+        inserts = [r for q, r in stats.items() if q.startswith('INSERT INTO users')]
+        self.assertEqual(inserts[0]['calls'], 3)
+        self.assertEqual(inserts[0]['rows'], 3)
+        self.assertIn('calls', self.db.dump_query_stats())
+
+    def test_errors_are_counted(self):
+        with self.assertRaises(Exception):
+            self.db.execute_query("SELECT * FROM no_such_table")
+        row = self.db.query_stats.snapshot()[0]
+        self.assertEqual(row['errors'], 1)
+
+    def test_slow_query_logs_plan_once(self):
+        self.db.query_stats.slow_seconds = 0.0
+        with self.assertLogs('chat.db', level='WARNING') as logs:
+            self.db.get_all_users()
+            self.db.get_all_users()
+        plans = [r.fields['plan'] for r in logs.records if r.getMessage() == 'Slow query']
+        self.assertEqual(len(plans), 2)
+        self.assertTrue(plans[0])
+        self.assertIsNone(plans[1])
+
+if __name__ == '__main__':
+    unittest.main()
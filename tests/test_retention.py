@@ -0,0 +1,81 @@
+import unittest
+import sys
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+import src.server.db as db_module
+from src.server.retention import Archiver, RetentionPolicy
+
+NOW = datetime(2025, 6, 1, 12, 0, 0)
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self._old_path = db_module.DB_PATH
+        db_module.DB_PATH = os.path.join(self.dir.name, 'chat.db')
+        self.db = db_module.Database()
+        self.db.register_user('alice', 'pw')
+        for days in (400, 100, 40, 10, 1):
+            ts = (NOW - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+            for message_type, receiver in (('public', None), ('private', 'bob'), ('group', '1')):
+                self.db.execute_query(
+                    "INSERT INTO messages (sender, receiver, content, message_type, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    ('alice', receiver, f'{message_type} cách {days} ngày', message_type, ts))
+        self.db.conn.commit()
+
+    def tearDown(self):
+        self.db.close()
+        db_module.DB_PATH = self._old_path
+        self.dir.cleanup()
+
+    def contents(self, table):
+        cursor = self.db.execute_query(f"SELECT content FROM {table} ORDER BY id")
+        return [row['content'] for row in cursor.fetchall()]
+
+    def test_policy_per_type_moves_rows_to_archive_table(self):
+        policy = RetentionPolicy({'public': 30, 'group': 365})
+        result = Archiver(self.db, policy, batch_size=2).run_once(NOW)
+        self.assertEqual(result, {'public': 3, 'group': 1})
+        self.assertEqual(self.contents('messages_archive'),
+                         ['public cách 400 ngày', 'group cách 400 ngày', 'public cách 100 ngày', 'public cách 40 ngày'])
+        self.assertEqual(len(self.contents('messages')), 11)
+        self.assertNotIn('public cách 40 ngày', self.contents('messages'))
+        # Chạy lại không còn gì để chuyển; tin đã archive không còn trong index tìm kiếm
+        self.assertEqual(Archiver(self.db, policy).run_once(NOW), {'public': 0, 'group': 0})
+        if self.db.search_backend:
+            results, _ = self.db.search_messages('alice', 'public')
+            self.assertEqual(len(results), 2)
+
+    def test_archive_to_files_round_trips(self):
+        archive_dir = os.path.join(self.dir.name, 'archive')
+        os.makedirs(archive_dir)
+        result = Archiver(self.db, RetentionPolicy({'private': 50}), archive_dir).run_once(NOW)
+        self.assertEqual(result, {'private': 2})
+        self.assertEqual(self.contents('messages_archive'), [])
+        (name,) = os.listdir(archive_dir)
+        self.assertEqual(name, 'messages-private-20250601-120000.ndjson.gz')
+
+        # File nhập lại được (giữ id gốc)
+        self.assertEqual(self.db.import_messages(os.path.join(archive_dir, name)), 2)
+        self.assertEqual(len(self.contents('messages')), 15)
+
+    def test_policy_from_env_and_index_plan(self):
+        policy = RetentionPolicy.from_env({'CHAT_RETENTION_PUBLIC_DAYS': '7', 'CHAT_RETENTION_GROUP_DAYS': ''})
+        self.assertEqual(policy.days, {'public': 7.0, 'private': None, 'group': None})
+        self.assertEqual(policy.cutoffs(NOW), {'public': NOW - timedelta(days=7)})
+        self.assertFalse(RetentionPolicy.from_env({}))
+
+        plan = ' '.join(self.db.explain(
+            "SELECT id FROM messages WHERE message_type = ? AND timestamp < ? ORDER BY timestamp LIMIT ?",
+            ('public', '2025-01-01', 10)))
+        self.assertIn('idx_messages_type_ts', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import unittest
+import sys
+import os
+import asyncio
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+# Add project root to path
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.append(ROOT)
+
+try:
+    import aiohttp  # socketio.AsyncClient cần aiohttp
+except ImportError:
+    aiohttp = None
+
+from src.server.presence import ReplicatedPresence, PRESENCE_EXPIRE
+from src.server.bus import BusBroker
+from src.common import protocol
+
+SERVER_BOOT = (
+    "import sys; sys.path.insert(0, sys.argv[1]);"
+    "import src.server.db as db_module; db_module.DB_PATH = sys.argv[2];"
+    "from src.server.main import main; main()"
+)
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class TestReplicatedPresence(unittest.TestCase):
+    def setUp(self):
+        # Hai node nối với nhau qua một "bus" trong bộ nhớ
+        self.nodes = [ReplicatedPresence('n1'), ReplicatedPresence('n2')]
+        for node in self.nodes:
+            node.publish = self.deliver
+
+    def deliver(self, message):
+        for node in self.nodes:
+            node.apply(dict(message))
+
+    def test_add_remove_visible_on_other_node(self):
+        n1, n2 = self.nodes
+        n1.add('s1', 'alice')
+        n2.add('s2', 'bob')
+        self.assertEqual(n2.sid_for('alice'), 's1')
+        self.assertEqual(sorted(n1.online_usernames()), ['alice', 'bob'])
+        # username_of chỉ thấy socket cục bộ
+        self.assertIsNone(n2.username_of('s1'))
+        # Ưu tiên sid cục bộ khi user có nhiều phiên
+        n2.add('s3', 'alice')
+        self.assertEqual(n2.sid_for('alice'), 's3')
+        n1.remove('s1')
+        self.assertEqual(n2.sids_for('alice'), {'s3'})
+
+    def test_new_node_learns_state_and_dead_node_expires(self):
+        n1, n2 = self.nodes
+        n1.add('s1', 'alice')
+        n3 = ReplicatedPresence('n3')
+        n3.publish = self.deliver
+        self.nodes.append(n3)
+        n3.hello()
+        self.assertTrue(n3.is_online('alice'))
+        n3.expire(now=time.monotonic() + PRESENCE_EXPIRE + 1)
+        self.assertFalse(n3.is_online('alice'))
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp is required for socketio.AsyncClient")
+class TestTwoNodes(unittest.TestCase):
+    """Hai process server dùng chung database, nối qua chatbus: tin nhắn đi được giữa các node."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.db_path = os.path.join(cls.tmp, 'chat.db')
+        bus_url = f"chatbus+unix://{os.path.join(cls.tmp, 'bus.sock')}"
+        cls.broker = BusBroker(bus_url).start()
+        cls.ports = [free_port(), free_port()]
+        cls.procs = []
+        for port in cls.ports:
+            env = dict(os.environ, PORT=str(port), CHAT_MESSAGE_QUEUE=bus_url,
+                       CHAT_FILES_DIR=os.path.join(cls.tmp, 'files'))
+            env.pop('DATABASE_URL', None)
+            cls.procs.append(subprocess.Popen([sys.executable, '-c', SERVER_BOOT, ROOT, cls.db_path],
+                                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            # Server đầu tiên tạo bảng trước khi server thứ hai mở database
+            cls.wait_port(port)
+        deadline = time.time() + 10
+        while cls.broker.peer_count() < 4 and time.time() < deadline:
+            time.sleep(0.1)
+
+    @staticmethod
+    def wait_port(port):
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        for proc in cls.procs:
+            proc.terminate()
+            proc.wait(timeout=10)
+        cls.broker.stop()
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def test_private_message_across_nodes(self):
+        from src.client.async_client import AsyncChatClient
+
+        async def scenario():
+            alice = AsyncChatClient(port=self.ports[0])
+            bob = AsyncChatClient(port=self.ports[1])
+            await alice.register('alice_node', 'pw')
+            await bob.register('bob_node', 'pw')
+            ok, _ = await alice.login('alice_node', 'pw')
+            self.assertTrue(ok)
+            ok, _ = await bob.login('bob_node', 'pw')
+            self.assertTrue(ok)
+
+            await alice.request_friend('bob_node')
+            await bob.accept_friend('alice_node')
+
+            received = bob.wait_for(protocol.MSG_PRIVATE, timeout=5)
+            await alice.send_private('bob_node', 'hello from node 1')
+            msg = await received
+            payload = dict(msg['payload'])
+            self.assertIsInstance(payload.pop('seq'), int)
+            self.assertEqual(payload, {'sender': 'alice_node', 'receiver': 'bob_node', 'content': 'hello from node 1'})
+
+            await alice.disconnect()
+            await bob.disconnect()
+
+        asyncio.run(scenario())
+
+    def test_group_rooms_joined_on_the_node_holding_the_socket(self):
+        from src.client.async_client import AsyncChatClient
+
+        async def scenario():
+            # node 0: alice, carol, dave; node 1: bob và phiên thứ hai của dave
+            alice, carol, dave = (AsyncChatClient(port=self.ports[0]) for _ in range(3))
+            bob, dave2 = AsyncChatClient(port=self.ports[1]), AsyncChatClient(port=self.ports[1])
+            for client, name in ((alice, 'alice_room'), (bob, 'bob_room'), (carol, 'carol_room'), (dave, 'dave_room')):
+                await client.register(name, 'pw')
+                ok, _ = await client.login(name, 'pw')
+                self.assertTrue(ok)
+            ok, _ = await dave2.login('dave_room', 'pw')
+            self.assertTrue(ok)
+            dave2_groups = []
+            dave2.on(protocol.MSG_GROUP, lambda payload: dave2_groups.append(payload['content']))
+
+            added = asyncio.create_task(bob.wait_for(protocol.MSG_GROUP_ADDED, timeout=5))
+            await alice.create_group('Cross', ['bob_room', 'carol_room'])
+            gid = (await added)['payload']['id']
+
+            received = asyncio.create_task(bob.wait_for(protocol.MSG_GROUP, timeout=5))
+            await carol.send_group(gid, 'một')
+            self.assertEqual((await received)['payload']['content'], 'một')
+
+            # dave vào nhóm từ node 0: phiên trên node 1 cũng nhận tin nhóm
+            await dave.join_group(gid)
+            received = asyncio.create_task(dave2.wait_for(protocol.MSG_GROUP, timeout=5))
+            await carol.send_group(gid, 'hai')
+            self.assertEqual((await received)['payload']['content'], 'hai')
+
+            # Rời nhóm từ node 0: phiên trên node 1 không nhận nữa
+            await dave.leave_group(gid)
+            received = asyncio.create_task(bob.wait_for(protocol.MSG_GROUP, timeout=5))
+            await carol.send_group(gid, 'ba')
+            self.assertEqual((await received)['payload']['content'], 'ba')
+            await asyncio.sleep(0.3)
+            self.assertEqual(dave2_groups, ['hai'])
+
+            for client in (alice, bob, carol, dave, dave2):
+                await client.disconnect()
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
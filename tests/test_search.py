@@ -0,0 +1,92 @@
+import unittest
+import sys
+import os
+import sqlite3
+import tempfile
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
+import src.server.db as db_module
+
+
+class TestMessageSearch(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self._old_path = db_module.DB_PATH
+        db_module.DB_PATH = self.path
+        self.db = db_module.Database()
+        if self.db.search_backend is None:
+            self.skipTest("SQLite build without FTS5")
+        for name in ('alice', 'bob', 'carol'):
+            self.db.register_user(name, 'pw')
+        self.gid = self.db.create_group('Team', 'alice')
+        self.db.save_message('alice', 'Họp nhóm lúc 9 giờ sáng', receiver=self.gid, message_type='group')
+        self.db.save_message('alice', 'hop rieng voi bob', receiver='bob', message_type='private')
+        self.db.save_message('carol', 'Carol họp với alice', receiver='alice', message_type='private')
+        self.db.save_message('bob', 'lịch họp công khai', message_type='public')
+
+    def tearDown(self):
+        self.db.close()
+        db_module.DB_PATH = self._old_path
+        os.remove(self.path)
+
+    def contents(self, username, query, **kwargs):
+        results, _ = self.db.search_messages(username, query, **kwargs)
+        return sorted(r['content'] for r in results)
+
+    def test_diacritics_and_access(self):
+        # 'hop' khớp cả 'họp'; mỗi user chỉ thấy tin của mình, nhóm đã tham gia và tin công khai
+        self.assertEqual(self.contents('alice', 'hop'), ['Carol họp với alice', 'Họp nhóm lúc 9 giờ sáng',
+                                                         'hop rieng voi bob', 'lịch họp công khai'])
+        self.assertEqual(self.contents('bob', 'HỌP'), ['hop rieng voi bob', 'lịch họp công khai'])
+        self.assertEqual(self.contents('carol', 'hop', scope='private'), ['Carol họp với alice'])
+        self.assertEqual(self.contents('alice', 'hop', scope='private:bob'), ['hop rieng voi bob'])
+        self.assertEqual(self.contents('bob', 'hop', scope=f'group:{self.gid}'), [])
+        # Từ cuối khớp tiền tố; ký tự đặc biệt của FTS không làm lỗi câu truy vấn
+        self.assertEqual(self.contents('alice', 'nhóm sá'), ['Họp nhóm lúc 9 giờ sáng'])
+        self.assertEqual(self.contents('alice', '"OR* (NEAR'), [])
+
+    def test_paging_and_index_kept_in_sync(self):
+        for i in range(25):
+            self.db.save_message('bob', f'spam {i}', message_type='public')
+        results, cursor = self.db.search_messages('alice', 'spam', limit=10)
+        seen = [r['id'] for r in results]
+        while cursor is not None:
+            results, cursor = self.db.search_messages('alice', 'spam', cursor=cursor, limit=10)
+            seen += [r['id'] for r in results]
+        self.assertEqual(len(set(seen)), 25)
+
+        self.db.delete_group(self.gid, 'alice')
+        self.assertEqual(self.contents('alice', 'nhóm'), [])
+
+    def test_paging_continues_past_candidate_window(self):
+        self.db.SEARCH_CANDIDATES = 10
+        ids = [self.db.save_message('bob', f'spam {i}', message_type='public') for i in range(25)]
+        results, cursor = self.db.search_messages('alice', 'spam', limit=4)
+        pages = [[r['id'] for r in results]]
+        while cursor is not None:
+            results, cursor = self.db.search_messages('alice', 'spam', cursor=cursor, limit=4)
+            pages.append([r['id'] for r in results])
+        seen = [i for page in pages for i in page]
+        self.assertEqual(sorted(seen), sorted(ids))
+        # Cửa sổ mới nhất được trả hết trước cửa sổ cũ hơn
+        self.assertEqual(set(seen[:10]), set(ids[-10:]))
+        # Cursor cũ dạng offset vẫn dùng được (trong cửa sổ đầu)
+        self.assertEqual(len(self.db.search_messages('alice', 'spam', cursor=8, limit=4)[0]), 2)
+
+    def test_existing_messages_indexed_on_upgrade(self):
+        self.db.close()
+        conn = sqlite3.connect(self.path)
+        conn.executescript('''
+            DROP TRIGGER messages_fts_ai; DROP TRIGGER messages_fts_ad; DROP TRIGGER messages_fts_au;
+            DROP TABLE messages_fts;
+        ''')
+        conn.close()
+        self.db = db_module.Database()
+        self.assertEqual(self.contents('bob', 'lich'), ['lịch họp công khai'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+
+from helpers import ServerTestCase, received, of_type, db
+from src.server.server import typing_state, expire_typing
+from src.server.typing_state import TypingCoalescer
+from src.server import metrics
+from src.common import protocol
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTypingCoalescer(unittest.TestCase):
+    def test_debounce_duplicate_expiry_and_public_cap(self):
+        clock = FakeClock()
+        state = TypingCoalescer(debounce=3, expire=6, public_max=1, clock=clock)
+        self.assertEqual(state.typing('alice', 'group', '5'), 'forwarded')
+        clock.now += 1
+        self.assertEqual(state.typing('alice', 'group', '5'), 'debounced')
+        # Target khác là trạng thái riêng
+        self.assertEqual(state.typing('alice', 'private', 'bob'), 'forwarded')
+        clock.now += 2.5
+        self.assertEqual(state.typing('alice', 'group', '5'), 'forwarded')
+
+        self.assertEqual(state.stop('alice', 'private', 'bob'), 'forwarded')
+        self.assertEqual(state.stop('alice', 'private', 'bob'), 'duplicate')
+
+        # Mỗi TYPING (kể cả bị debounce) gia hạn; im lặng quá 6 giây thì hết hạn
+        self.assertEqual(state.expired(clock.now + 5.9), [])
+        self.assertEqual(state.expired(clock.now + 6), [('alice', 'group', '5')])
+        self.assertEqual(state.stop('alice', 'group', '5'), 'duplicate')
+
+        self.assertEqual(state.typing('alice', 'public', None), 'forwarded')
+        self.assertEqual(state.typing('bob', 'public', None), 'capped')
+        self.assertEqual(state.drop_user('alice'), [('alice', 'public', None)])
+        self.assertEqual(state.typing('bob', 'public', None), 'forwarded')
+        self.assertEqual(len(state), 1)
+
+
+class TestTypingForwarding(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        typing_state.clear()
+        self.clock = FakeClock()
+        self._old_clock = typing_state.clock
+        typing_state.clock = self.clock
+        for name in ('alice', 'bob', 'carol'):
+            db.register_user(name, 'pw')
+        self.gid = db.create_group('Team', 'alice')
+        db.add_member_to_group(self.gid, 'bob')
+        self.users = {}
+        for name in ('alice', 'bob', 'carol'):
+            self.users[name], _ = self.login(name)
+
+    def tearDown(self):
+        super().tearDown()
+        typing_state.clock = self._old_clock
+        typing_state.clear()
+
+    def send(self, name, msg_type, payload):
+        self.users[name].emit('message', {'type': msg_type, 'payload': payload})
+
+    def typing_frames(self, name):
+        messages = received(self.users[name])
+        return [(m['type'], m['payload']) for m in messages
+                if m.get('type') in (protocol.MSG_TYPING, protocol.MSG_STOP_TYPING)]
+
+    def test_keystrokes_are_coalesced_and_expire(self):
+        counter = metrics.TYPING_EVENTS.labels('received')
+        before = counter.value
+        for _ in range(10):
+            self.send('alice', protocol.MSG_TYPING, {'mode': 'group', 'target': self.gid})
+            self.clock.now += 0.2
+        group_typing = {'sender': 'alice', 'mode': 'group', 'group_id': self.gid}
+        self.assertEqual(self.typing_frames('bob'), [(protocol.MSG_TYPING, group_typing)])
+        self.assertEqual(self.typing_frames('alice'), [])
+        self.assertEqual(counter.value - before, 10)
+
+        # Client mất kết nối giữa chừng: server tự phát STOP_TYPING khi hết hạn
+        self.assertEqual(expire_typing(self.clock.now + 1), 0)
+        self.assertEqual(expire_typing(self.clock.now + typing_state.expire), 1)
+        self.assertEqual(self.typing_frames('bob'), [(protocol.MSG_STOP_TYPING, group_typing)])
+
+        # STOP lặp lại không được chuyển tiếp
+        self.send('alice', protocol.MSG_TYPING, {'mode': 'private', 'target': 'carol'})
+        self.send('alice', protocol.MSG_STOP_TYPING, {'mode': 'private', 'target': 'carol'})
+        self.send('alice', protocol.MSG_STOP_TYPING, {'mode': 'private', 'target': 'carol'})
+        self.assertEqual([t for t, _ in self.typing_frames('carol')],
+                         [protocol.MSG_TYPING, protocol.MSG_STOP_TYPING])
+
+        self.send('alice', protocol.MSG_TYPING, {'mode': 'private', 'target': ['carol']})
+        self.assertEqual(of_type(received(self.users['alice']), 'ERROR'), ['Invalid message format'])
+
+    def test_public_typing_is_capped_and_cleared_on_disconnect(self):
+        typing_state.public_max = 1
+        try:
+            self.send('alice', protocol.MSG_TYPING, {'mode': 'public'})
+            self.send('bob', protocol.MSG_TYPING, {'mode': 'public'})
+            self.assertEqual(self.typing_frames('carol'),
+                             [(protocol.MSG_TYPING, {'sender': 'alice', 'mode': 'public'})])
+            alice = self.users.pop('alice')
+            self.clients.remove(alice)
+            alice.disconnect()
+            self.assertEqual(self.typing_frames('carol'),
+                             [(protocol.MSG_STOP_TYPING, {'sender': 'alice', 'mode': 'public'})])
+            # Chỗ trống được giải phóng cho người khác
+            self.send('bob', protocol.MSG_TYPING, {'mode': 'public'})
+            self.assertEqual(len(self.typing_frames('carol')), 1)
+        finally:
+            typing_state.public_max = TypingCoalescer().public_max
+
+
+if __name__ == '__main__':
+    unittest.main()